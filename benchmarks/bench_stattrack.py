@@ -0,0 +1,372 @@
+"""Benchmarks for StatTrack's sampling loop and SQLite driver, without connecting to Discord.
+
+Guilds and members are synthetic objects with the attributes StatTrack reads, and databases are
+filled with synthetic minutes of every metric. Everything is written to a temporary folder.
+
+This needs the dev requirements and Red installed. From the root of the repo::
+
+    python benchmarks/bench_stattrack.py
+    python benchmarks/bench_stattrack.py --members 1000 --days 1 30 --json baseline.json
+    python benchmarks/bench_stattrack.py --compare baseline.json
+
+With ``--compare``, the exit code is 1 if any benchmark's median time got slower than the
+threshold (by default 1.25x) compared to the baseline, so it can be used to catch regressions.
+
+Times are medians of ``--repeat`` runs. Peak memory is the peak of Python allocations during a
+run (from tracemalloc), so memory used by SQLite itself is not included.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import datetime
+import json
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from stattrack.buffer import SampleBuffer  # noqa: E402
+from stattrack.counter import STATUSES, MemberCounter  # noqa: E402
+from stattrack.driver import StatTrackSQLiteDriver  # noqa: E402
+from stattrack.histogram import CommandTimings  # noqa: E402
+from stattrack.lag import LagMonitor  # noqa: E402
+from stattrack.stattrack import FLUSH_INTERVAL, StatTrack  # noqa: E402
+
+MEMBER_COUNTS = [1_000, 100_000, 1_000_000]
+DAY_COUNTS = [1, 30, 365, 730]
+
+# members per synthetic guild, and the share of memberships that are users already in another
+GUILD_SIZE = 1000
+SHARED_USERS = 0.2
+
+METRICS = [
+    "ping",
+    "loop_time_s",
+    "guilds",
+    "channels_total",
+    "channels_text",
+    "channels_voice",
+    "channels_cat",
+    "channels_stage",
+    "sys_mem",
+    "sys_cpu",
+    "command_count",
+    "message_count",
+    "status_online",
+    "status_idle",
+    "status_offline",
+    "status_dnd",
+    "users_total",
+    "users_unique",
+    "users_bots",
+    "users_humans",
+]
+
+Result = Dict[str, float]
+
+
+# ---------------------------------------------------------------------------------------------
+# fixtures
+
+
+class FakeMember:
+    __slots__ = ("id", "bot", "raw_status")
+
+    def __init__(self, id: int, bot: bool, raw_status: str) -> None:
+        self.id = id
+        self.bot = bot
+        self.raw_status = raw_status
+
+
+class FakeGuild:
+    def __init__(self, shard_id: int, members: List[FakeMember]) -> None:
+        self.shard_id = shard_id
+        self.members = members
+        self.member_count = len(members)
+        self.text_channels = [object()] * 20
+        self.voice_channels = [object()] * 5
+        self.categories = [object()] * 4
+        self.stage_channels = [object()] * 1
+        self.channels = (
+            self.text_channels + self.voice_channels + self.categories + self.stage_channels
+        )
+
+
+class FakeBot:
+    def __init__(self, guilds: List[FakeGuild], shard_count: int = 1) -> None:
+        self.guilds = guilds
+        self.shard_count = shard_count
+        self.latency = 0.05
+        self.latencies = [(i, 0.05) for i in range(shard_count)]
+
+
+def make_guilds(members: int, shard_count: int = 1, seed: int = 0) -> List[FakeGuild]:
+    """Split a number of memberships into guilds, with some users in more than one guild."""
+    rng = random.Random(seed)
+    statuses = list(STATUSES)
+    users: List[FakeMember] = []
+    guilds = []
+    remaining = members
+    while remaining > 0:
+        size = min(GUILD_SIZE, remaining)
+        guild_members = []
+        for _ in range(size):
+            if users and rng.random() < SHARED_USERS:
+                guild_members.append(rng.choice(users))
+            else:
+                user = FakeMember(rng.getrandbits(63), rng.random() < 0.05, rng.choice(statuses))
+                users.append(user)
+                guild_members.append(user)
+        guilds.append(FakeGuild(len(guilds) % shard_count, guild_members))
+        remaining -= size
+    return guilds
+
+
+def make_frame(days: int, seed: int = 0) -> pd.DataFrame:
+    """Minutes of every metric, ending at the start of today."""
+    rng = np.random.default_rng(seed)
+    minutes = days * 1440
+    end = datetime.datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    index = pd.date_range(end=end, periods=minutes, freq="1min")
+    data = {metric: rng.integers(0, 10_000, minutes) for metric in METRICS}
+    data["loop_time_s"] = rng.random(minutes)
+    return pd.DataFrame(data, index=index)
+
+
+class BenchCog:
+    """The parts of StatTrack that the sampling loop uses, with StatTrack's own methods."""
+
+    update_stats = StatTrack.update_stats
+    flush_samples = StatTrack.flush_samples
+
+    def __init__(self, bot: FakeBot, driver: StatTrackSQLiteDriver, folder: Path) -> None:
+        self.bot = bot
+        self.driver = driver
+        self.folder = folder
+        self.members = MemberCounter()
+        self.lag_monitor = LagMonitor()
+        self.command_timings = CommandTimings()
+        self.command_stats: List[Any] = []
+        self.graph_cache: Dict[Any, Any] = {}
+        self.flush_lock = asyncio.Lock()
+        self.cmd_count = 0
+        self.msg_count = 0
+        self.last_loop_raw: Optional[float] = None
+        self.last_loop_time = ""
+        self.latest_sample = None
+        self.loops_since_reconcile: Optional[int] = None
+        self.samples: Optional[SampleBuffer] = None
+        self.new_samples()
+
+    def new_samples(self) -> None:
+        """Start with an empty buffer, so the next loop isn't skipped as already collected.
+        With one sample, the buffer is never flushed, so the loop doesn't write to the
+        database. Writes are benchmarked separately."""
+        if self.samples is not None:
+            self.samples.close()
+        path = self.folder / f"samples-{time.monotonic_ns()}.journal"
+        self.samples = SampleBuffer(str(path))
+        self.samples.load()
+
+
+# ---------------------------------------------------------------------------------------------
+# benchmarks
+
+
+async def measure(
+    func: Callable[[], Awaitable[Any]],
+    repeat: int,
+    setup: Callable[[], Awaitable[Any]] | None = None,
+) -> Result:
+    """Run a coroutine function ``repeat`` times, with an optional setup before each that is
+    not timed."""
+    times = []
+    peaks = []
+    for _ in range(repeat):
+        if setup is not None:
+            await setup()
+        tracemalloc.start()
+        start = time.perf_counter()
+        await func()
+        times.append(time.perf_counter() - start)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return {
+        "median_ms": statistics.median(times) * 1000,
+        "min_ms": min(times) * 1000,
+        "peak_mib": max(peaks) / 2**20,
+    }
+
+
+async def bench_loop(members: int, repeat: int, folder: Path) -> Dict[str, Result]:
+    guilds = make_guilds(members)
+    driver = StatTrackSQLiteDriver(path=str(folder / f"loop-{members}.db"))
+    await driver.connect()
+    await driver.migrate_to_epoch()
+    cog = BenchCog(FakeBot(guilds), driver, folder)
+    results = {}
+
+    async def reconcile() -> None:
+        cog.new_samples()
+        cog.loops_since_reconcile = None
+
+    async def events() -> None:
+        cog.new_samples()
+        cog.loops_since_reconcile = 0
+
+    try:
+        for name, setup, compact in (
+            ("reconcile", reconcile, False),
+            ("events", events, False),
+            ("compact", reconcile, True),
+        ):
+            cog.members.set_compact(compact)
+            loop_times = []
+
+            async def run() -> None:
+                await cog.update_stats()
+                assert cog.last_loop_raw is not None
+                loop_times.append(cog.last_loop_raw)
+
+            result = await measure(run, repeat, setup)
+            # update_stats waits a second to measure CPU usage, so use the time it measures itself
+            result["median_ms"] = statistics.median(loop_times) * 1000
+            result["min_ms"] = min(loop_times) * 1000
+            results[f"loop {name}, {members:,} members"] = result
+    finally:
+        cog.samples.close()
+        await driver.close()
+    return results
+
+
+async def bench_driver(days: int, repeat: int, folder: Path) -> Dict[str, Result]:
+    driver = StatTrackSQLiteDriver(path=str(folder / f"driver-{days}.db"))
+    await driver.connect()
+    await driver.migrate_to_epoch()
+    results = {}
+    try:
+
+        async def build() -> None:
+            # the frame is made inside, so it's freed before the rest of the benchmarks
+            await driver.write(make_frame(days))
+
+        results[f"generate and write, {days} days"] = await measure(build, 1)
+
+        last = (await driver.get_last_index()).to_pydatetime()
+        next_time = last
+
+        async def append() -> None:
+            nonlocal next_time
+            rows = []
+            for _ in range(FLUSH_INTERVAL):
+                next_time += datetime.timedelta(minutes=1)
+                rows.append((next_time, {metric: 1 for metric in METRICS}))
+            # what StatTrack.flush_samples does
+            await driver.append_rows(rows)
+            await driver.update_rollups(rows[0][0], rows[-1][0])
+
+        results[f"append {FLUSH_INTERVAL} rows, {days} days"] = await measure(append, repeat)
+
+        end = next_time
+        for label, delta in (("1 day", datetime.timedelta(days=1)), ("all", None)):
+            results[f"read_partial {label}, {days} days"] = await measure(
+                lambda: driver.read_partial(["ping"], delta, end), repeat
+            )
+
+        async def graph() -> None:
+            # the query behind an all-time graph with the default maxpoints
+            frequency = max(1, int(days * 1440 // 25_000))
+            bucket = await driver.resolve_bucket(datetime.timedelta(minutes=frequency), None, end)
+            await driver.read_downsampled(["ping"], bucket, None, end)
+
+        results[f"read_downsampled all, {days} days"] = await measure(graph, repeat)
+    finally:
+        await driver.close()
+    return results
+
+
+# ---------------------------------------------------------------------------------------------
+# output
+
+
+def print_results(results: Dict[str, Result], baseline: Dict[str, Result] | None) -> None:
+    name_width = max(len(name) for name in results)
+    header = f"{'benchmark':<{name_width}}  {'median ms':>10}  {'min ms':>10}  {'peak MiB':>9}"
+    if baseline is not None:
+        header += f"  {'vs base':>8}"
+    print(header)
+    print("-" * len(header))
+    for name, result in results.items():
+        line = (
+            f"{name:<{name_width}}  {result['median_ms']:>10.2f}  {result['min_ms']:>10.2f}  "
+            f"{result['peak_mib']:>9.2f}"
+        )
+        if baseline is not None and name in baseline:
+            line += f"  {result['median_ms'] / baseline[name]['median_ms']:>7.2f}x"
+        print(line)
+
+
+def regressions(
+    results: Dict[str, Result], baseline: Dict[str, Result], threshold: float
+) -> List[str]:
+    return [
+        name
+        for name, result in results.items()
+        if name in baseline and result["median_ms"] > baseline[name]["median_ms"] * threshold
+    ]
+
+
+async def main(args: argparse.Namespace) -> int:
+    results: Dict[str, Result] = {}
+    with tempfile.TemporaryDirectory(prefix="stattrack-bench-") as tmp:
+        folder = Path(tmp)
+        for members in args.members:
+            print(f"Sampling loop with {members:,} members...", file=sys.stderr)
+            results.update(await bench_loop(members, args.repeat, folder))
+        for days in args.days:
+            print(f"Driver with {days} days of data...", file=sys.stderr)
+            results.update(await bench_driver(days, args.repeat, folder))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as fp:
+            baseline = json.load(fp)
+    print_results(results, baseline)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fp:
+            json.dump(results, fp, indent=2)
+
+    if baseline is not None:
+        slower = regressions(results, baseline, args.threshold)
+        if slower:
+            print(f"\nSlower than {args.threshold}x the baseline: {', '.join(slower)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--members", type=int, nargs="*", default=MEMBER_COUNTS, help="member counts for the loop"
+    )
+    parser.add_argument(
+        "--days", type=int, nargs="*", default=DAY_COUNTS, help="days of data for the driver"
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="runs of each benchmark")
+    parser.add_argument("--json", help="save the results to this file")
+    parser.add_argument("--compare", help="compare to results saved with --json")
+    parser.add_argument(
+        "--threshold", type=float, default=1.25, help="slowdown to fail --compare at"
+    )
+    sys.exit(asyncio.run(main(parser.parse_args())))
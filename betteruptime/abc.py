@@ -1,16 +1,18 @@
 import asyncio
+import datetime
 from abc import ABC, ABCMeta, abstractmethod
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, List, Optional
 
 import pandas
 from redbot.core.bot import Red
 from redbot.core.commands import CogMeta
 from redbot.core.config import Config
 
+from .driver import BetterUptimeSQLiteDriver
 from .vexutils.loop import VexLoop
 
 if TYPE_CHECKING:
-    from betteruptime.utils import UptimeData
+    from betteruptime.utils import Outage, UptimeData
 
 
 class CompositeMetaClass(CogMeta, ABCMeta):
@@ -25,6 +27,7 @@ class MixinMeta(ABC):
 
     bot: Red
     config: Config
+    driver: BetterUptimeSQLiteDriver
 
     main_loop_meta: VexLoop
     main_loop: asyncio.Task
@@ -33,6 +36,8 @@ class MixinMeta(ABC):
     last_ping_change: float
 
     first_load: float
+    outages_since: float
+    disconnected_since: Optional[float]
 
     cog_loaded_cache: pandas.Series
     connected_cache: pandas.Series
@@ -43,6 +48,12 @@ class MixinMeta(ABC):
     async def get_data(self, num_days: int) -> "UptimeData":
         raise NotImplementedError
 
+    @abstractmethod
+    async def get_outages(
+        self, start: datetime.datetime, end: datetime.datetime
+    ) -> List["Outage"]:
+        raise NotImplementedError
+
     @abstractmethod
     async def async_init(self) -> None:
         raise NotImplementedError
@@ -1,15 +1,15 @@
 import asyncio
-import os
 import sys
+from typing import Optional
 
 import pandas
 from redbot.core import Config, commands
 from redbot.core.bot import Red
-from redbot.core.data_manager import cog_data_path
 from redbot.core.utils.chat_formatting import pagify
 
 from .abc import CompositeMetaClass
 from .commands import BUCommands
+from .driver import BetterUptimeSQLiteDriver
 from .loop import BULoop
 from .utils import Utils
 from .vexutils import format_help, format_info, get_vex_logger
@@ -32,7 +32,7 @@ class BetterUptime(commands.Cog, BUCommands, BULoop, Utils, metaclass=CompositeM
     data to become available.
     """
 
-    __version__ = "2.1.3"
+    __version__ = "2.2.0"
     __author__ = "Vexed#0714"
 
     def __init__(self, bot: Red) -> None:
@@ -40,13 +40,23 @@ class BetterUptime(commands.Cog, BUCommands, BULoop, Utils, metaclass=CompositeM
 
         default: dict = {}
         self.config: Config = Config.get_conf(self, 418078199982063626, force_registration=True)
+        # cog_loaded and connected are only used to migrate to the database (v4)
         self.config.register_global(
-            version=1, cog_loaded=default, connected=default, first_load=None
+            version=1,
+            cog_loaded=default,
+            connected=default,
+            first_load=None,
+            last_seen=None,
+            disconnected_since=None,
+            outages_since=None,
         )
+        self.driver = BetterUptimeSQLiteDriver(bot, type(self).__name__, "uptime.db", "daily")
         self.last_known_ping = 0.0
         self.last_ping_change = 0.0
 
         self.first_load = 0.0
+        self.outages_since = 0.0
+        self.disconnected_since: Optional[float] = None
 
         self.cog_loaded_cache = pandas.Series(dtype="float64")
         self.connected_cache = pandas.Series(dtype="float64")
@@ -74,6 +84,8 @@ class BetterUptime(commands.Cog, BUCommands, BULoop, Utils, metaclass=CompositeM
         if self.main_loop:
             self.main_loop.cancel()
 
+        self.bot.loop.create_task(self.driver.close())
+
         global old_uptime
         if old_uptime:
             try:
@@ -90,7 +102,7 @@ class BetterUptime(commands.Cog, BUCommands, BULoop, Utils, metaclass=CompositeM
     @commands.command(hidden=True)
     async def betteruptimeinfo(self, ctx: commands.Context):
         loops = [self.main_loop_meta] if self.main_loop_meta else []
-        disk_usage = os.path.getsize(cog_data_path(self) / "settings.json")
+        disk_usage = self.driver.storage_usage()
         memory_usage = sys.getsizeof(self.connected_cache) + sys.getsizeof(self.cog_loaded_cache)
 
         await ctx.send(
@@ -13,12 +13,18 @@ from redbot.core import commands
 from redbot.core.utils.chat_formatting import humanize_timedelta, inline, pagify, text_to_file
 
 from .abc import MixinMeta
-from .consts import SECONDS_IN_DAY, WARN
+from .consts import DISCONNECTED, SECONDS_IN_DAY, UNLOADED, WARN
 from .plot import plot
+from .utils import humanize_duration, outages_by_day
 from .vexutils.chat import datetime_to_timestamp
 
 old_uptime = None
 
+OUTAGE_KINDS = {
+    UNLOADED: "offline or cog unloaded",
+    DISCONNECTED: "disconnected from Discord",
+}
+
 
 class BUCommands(MixinMeta):
     @commands.command(name="uptime")
@@ -96,6 +102,9 @@ class BUCommands(MixinMeta):
         """
         Check [botname] downtime over the last 30 days.
 
+        Each outage is listed with when it happened and how long it lasted, including today's.
+        Days from before outages started being logged only show the total.
+
         The default value for `num_days` is `30`. You can put `0` days for all-time data.
         Otherwise, it needs to be `5` or more.
 
@@ -110,34 +119,50 @@ class BUCommands(MixinMeta):
         else:
             data = await self.get_data(num_days)
 
-        midnight = datetime.datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-        if data.first_load > midnight:  # cog was first loaded today
-            return await ctx.send(
-                "It looks like there's been no recorded downtime.\n_This excludes any downtime "
-                "today._"
-            )
+        now = datetime.datetime.utcnow()
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+
+        # days fully covered by the outage log are reported from it, older days from the totals
+        logged_since = datetime.datetime.utcfromtimestamp(self.outages_since)
+        first_logged_day = logged_since.replace(hour=0, minute=0, second=0, microsecond=0)
+        if first_logged_day < logged_since:
+            first_logged_day += datetime.timedelta(days=1)
+
+        window_start = data.expected_index[0] if len(data.expected_index) else midnight
+        outages = outages_by_day(await self.get_outages(max(window_start, logged_since), now))
+
         msg = ""
         date: pandas.Timestamp
-        for date in data.expected_index:
-            if date == midnight:
+        for date in data.expected_index.union([pandas.Timestamp(midnight)]):
+            date_fmted = date.strftime("%Y-%m-%d")
+            if date < first_logged_day and date != midnight:
+                if SECONDS_IN_DAY - data.daily_connected_data[date] > 60:
+                    msg += (
+                        f"\n**{date_fmted}**: `{data.date_downtime(date)}`, of which "
+                        f"`{data.date_net_downtime(date)}` was due to network issues."
+                    )
                 continue
-            if SECONDS_IN_DAY - data.daily_connected_data[date] > 60:
-                date_fmted = date.strftime("%Y-%m-%d")
+
+            # dont want to include stupidly small downtime
+            day = [outage for outage in outages.get(date, []) if outage.seconds >= 60]
+            if not day:
+                continue
+            total = sum(outage.seconds for outage in day)
+            network = sum(outage.seconds for outage in day if outage.kind == DISCONNECTED)
+            msg += (
+                f"\n**{date_fmted}**: `{humanize_duration(total)}`, of which "
+                f"`{humanize_duration(network)}` was due to network issues."
+            )
+            for outage in day:
                 msg += (
-                    f"\n**{date_fmted}**: `{data.date_downtime(date)}`, of which "
-                    f"`{data.date_net_downtime(date)}` was due to network issues."
+                    f"\n- {outage.start.strftime('%H:%M')} to {outage.end.strftime('%H:%M')} "
+                    f"(`{humanize_duration(outage.seconds)}`): {OUTAGE_KINDS[outage.kind]}"
                 )
 
         if not msg:
-            await ctx.send(
-                "It looks like there's been no recorded downtime.\n_This excludes any downtime "
-                "today._"
-            )
+            await ctx.send("It looks like there's been no recorded downtime.")
         else:
-            full = (
-                "_Timezone: UTC, date format: Year-Month-Day_\n_This excludes any "
-                f"downtime today._\n\n{msg}"
-            )
+            full = f"_Timezone: UTC, date format: Year-Month-Day_\n\n{msg}"
             paged = pagify(full, page_length=1000)
             await ctx.send_interactive(paged)
 
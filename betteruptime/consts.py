@@ -6,3 +6,9 @@ SECONDS_IN_DAY = 86400
 CROSS = "\N{CROSS MARK}"
 
 WARN = "\N{WARNING SIGN}"
+
+# kinds of outage in the outage log
+UNLOADED = "unloaded"
+DISCONNECTED = "disconnected"
+
+OUTAGES_TABLE = "outages"
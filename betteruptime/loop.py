@@ -1,13 +1,15 @@
 import asyncio
 import datetime
+import io
 import json
 from time import time
 from typing import Dict
 
 import pandas
+from redbot.core.data_manager import cog_data_path
 
 from .abc import MixinMeta
-from .consts import INF, SECONDS_IN_DAY
+from .consts import DISCONNECTED, INF, OUTAGES_TABLE, SECONDS_IN_DAY, UNLOADED
 from .vexutils import get_vex_logger
 from .vexutils.loop import VexLoop
 
@@ -24,22 +26,41 @@ class BULoop(MixinMeta):
             await self.config.first_load.set(time())
             self.first_load = time()
 
-        if await self.config.version() == 1:
+        version = await self.config.version()
+        if version == 1:
             _log.info("Migrating BetterUptime config to new format (1 -> 3)...")
             await self.migrate_v1_to_v3()
-            await self.config.version.set(3)
-        elif await self.config.version() == 2:
+        elif version == 2:
             _log.info("Migrating BetterUptime config to new format (2 -> 3)...")
             await self.migate_v2_to_v3()
-            await self.config.version.set(3)
-        else:
+        elif version == 3:
             self.cog_loaded_cache = pandas.Series(
-                pandas.read_json(json.dumps(await self.config.cog_loaded()), typ="series")
+                pandas.read_json(
+                    io.StringIO(json.dumps(await self.config.cog_loaded())), typ="series"
+                )
             )
             self.connected_cache = pandas.Series(
-                pandas.read_json(json.dumps(await self.config.connected()), typ="series")
+                pandas.read_json(
+                    io.StringIO(json.dumps(await self.config.connected())), typ="series"
+                )
             )
 
+        if version < 4:
+            _log.info("Migrating BetterUptime data from config to SQLite (3 -> 4)...")
+            await self.migrate_v3_to_v4()
+        else:
+            df = await self.driver.read()
+            # days with no connection have no value, same as when this was stored in config
+            self.cog_loaded_cache = df["cog_loaded"].dropna().rename_axis(None).rename(None)
+            self.connected_cache = df["connected"].dropna().rename_axis(None).rename(None)
+
+        if version < 5:
+            _log.info("Starting the BetterUptime outage log (4 -> 5)...")
+            await self.migrate_v4_to_v5()
+
+        self.outages_since = await self.config.outages_since()
+        await self.log_downtime_while_unloaded()
+
         _log.debug("[BU SETUP] Config setup finished, waiting to start loops")
 
         self.main_loop = self.bot.loop.create_task(self.betteruptime_main_loop())
@@ -58,8 +79,6 @@ class BULoop(MixinMeta):
         }
         self.connected_cache = pandas.Series(data=partially_converted, dtype=float)
 
-        await self.write_to_config()
-
     async def migate_v2_to_v3(self):
         # i had bad code when making v2 so config was a mixtre of v1 and v2 format.... congrats me
         old_cog_loaded = await self.config.cog_loaded()
@@ -83,7 +102,66 @@ class BULoop(MixinMeta):
         self.cog_loaded_cache = convert(old_cog_loaded)
         self.connected_cache = convert(old_connected)
 
-        await self.write_to_config()
+    async def migrate_v3_to_v4(self):
+        # each minute used to rewrite all the data as JSON in config, now only today's row is
+        # written to the database
+        df = pandas.DataFrame(
+            {"cog_loaded": self.cog_loaded_cache, "connected": self.connected_cache}, dtype=float
+        )
+        df.index = pandas.to_datetime(df.index)
+        await self.driver.write(df)
+
+        data = {
+            "cog_loaded": await self.config.cog_loaded(),
+            "connected": await self.config.connected(),
+        }
+        if data["cog_loaded"] or data["connected"]:
+
+            def backup() -> None:
+                with open(cog_data_path(self) / "v3_to_v4_backup.json", "w") as fp:
+                    json.dump(data, fp)
+
+            await self.bot.loop.run_in_executor(None, backup)
+
+        # version first, so the data isn't lost if this is interrupted
+        await self.config.version.set(4)
+        await self.config.cog_loaded.clear()
+        await self.config.connected.clear()
+
+    async def migrate_v4_to_v5(self):
+        # outages before this are only in the daily counters
+        empty = pandas.DataFrame(
+            {"start": pandas.Series(dtype="int64"), "kind": pandas.Series(dtype=object)},
+            index=pandas.DatetimeIndex([]),
+        )
+        await self.driver.write(empty, OUTAGES_TABLE)
+        await self.config.outages_since.set(time())
+        await self.config.version.set(5)
+
+    async def log_downtime_while_unloaded(self) -> None:
+        """Log the outages from when the cog was last running until now, including a
+        disconnection that was still going on when it stopped."""
+        last_seen = await self.config.last_seen()
+        disconnected_since = await self.config.disconnected_since()
+        if last_seen is None:
+            return
+
+        if disconnected_since is not None:
+            await self.log_outage(disconnected_since, last_seen, DISCONNECTED)
+            await self.config.disconnected_since.clear()
+        await self.log_outage(last_seen, time(), UNLOADED)
+
+    async def log_outage(self, start: float, end: float, kind: str) -> None:
+        """Append an outage to the log, once it's over. Times are UNIX timestamps."""
+        if end <= start:
+            return
+        # the log is indexed by the end of each outage, so the outages overlapping a range can be
+        # found by looking up the ones that end after its start. this also keeps it append-only
+        row = pandas.DataFrame(
+            {"start": [int(start)], "kind": [kind]},
+            index=pandas.DatetimeIndex([datetime.datetime.utcfromtimestamp(end)]),
+        )
+        await self.driver.append(row, OUTAGES_TABLE)
 
     async def betteruptime_main_loop(self):
         self.last_known_ping = self.bot.latency
@@ -109,7 +187,7 @@ class BULoop(MixinMeta):
                 self.main_loop_meta.iter_start()
                 await self.update_uptime()
                 self.main_loop_meta.iter_finish()
-                _log.debug("Loop has finished, saved to config")
+                _log.debug("Loop has finished, saved to database")
             except Exception:
                 _log.exception(
                     "Something went wrong in the main BetterUptime loop. The loop will try again "
@@ -118,15 +196,19 @@ class BULoop(MixinMeta):
 
             await self.main_loop_meta.sleep_until_next()
 
-    async def write_to_config(self) -> None:
-        if not self.cog_loaded_cache.empty:
-            data = json.loads(self.cog_loaded_cache.to_json())  # type: ignore
-            await self.config.cog_loaded.set(data)
-        if not self.connected_cache.empty:
-            data = json.loads(self.connected_cache.to_json())  # type: ignore
-            await self.config.connected.set(data)
+    async def write_day(self, day: datetime.datetime) -> None:
+        """Write a day's counters to the database, leaving the other days untouched."""
+        row = pandas.DataFrame(
+            {
+                "cog_loaded": [self.cog_loaded_cache.get(day, float("nan"))],
+                "connected": [self.connected_cache.get(day, float("nan"))],
+            },
+            index=pandas.DatetimeIndex([day]),
+        )
+        await self.driver.upsert(row)
 
     async def update_uptime(self):
+        now = time()
         utcdatetoday = datetime.datetime.utcnow().replace(
             microsecond=0, second=0, minute=0, hour=0
         )
@@ -148,4 +230,16 @@ class BULoop(MixinMeta):
             except KeyError:
                 self.connected_cache[utcdatetoday] = 60.0
 
-        await self.write_to_config()
+            if self.disconnected_since is not None:
+                await self.log_outage(self.disconnected_since, now - 60, DISCONNECTED)
+                self.disconnected_since = None
+                await self.config.disconnected_since.clear()
+        elif self.disconnected_since is None:
+            # like the counters, this iteration is for the last minute
+            self.disconnected_since = now - 60
+            await self.config.disconnected_since.set(self.disconnected_since)
+
+        await self.write_day(utcdatetoday)
+        # so outages while the cog isn't running can be logged when it's next loaded. this is
+        # tiny so the config write is cheap, unlike when all the uptime data was in config
+        await self.config.last_seen.set(now)
@@ -3,18 +3,24 @@ from __future__ import annotations
 import datetime
 from dataclasses import dataclass
 from math import ceil
+from time import time
+from typing import Dict, List
 
 import pandas as pd
 from redbot.core.utils.chat_formatting import humanize_timedelta
 
 from .abc import MixinMeta
-from .consts import SECONDS_IN_DAY
+from .consts import DISCONNECTED, OUTAGES_TABLE, SECONDS_IN_DAY
 
 
 def round_up_to_min(num: float):
     return ceil(num / 60.0) * 60
 
 
+def humanize_duration(seconds: float) -> str:
+    return humanize_timedelta(seconds=round_up_to_min(seconds)) or "none"
+
+
 @dataclass
 class UptimeData:
     total_secs_connected: float
@@ -112,7 +118,57 @@ class UptimeData:
         return new.astype(float)
 
 
+@dataclass
+class Outage:
+    start: datetime.datetime
+    end: datetime.datetime
+    kind: str
+
+    @property
+    def seconds(self) -> float:
+        return (self.end - self.start).total_seconds()
+
+
+def outages_by_day(outages: List[Outage]) -> Dict[datetime.datetime, List[Outage]]:
+    """Group outages by the UTC day they happened on, splitting any that span midnight."""
+    days: Dict[datetime.datetime, List[Outage]] = {}
+    for outage in outages:
+        start = outage.start
+        while start < outage.end:
+            midnight = start.replace(hour=0, minute=0, second=0, microsecond=0)
+            end = min(outage.end, midnight + datetime.timedelta(days=1))
+            days.setdefault(midnight, []).append(Outage(start, end, outage.kind))
+            start = end
+    return days
+
+
 class Utils(MixinMeta):
+    async def get_outages(self, start: datetime.datetime, end: datetime.datetime) -> List[Outage]:
+        """Get the outages between two naive UTC times, cut to fit them, oldest first. This
+        includes a disconnection that is still going on."""
+        # indexed by the end of each outage
+        df = await self.driver.read_range(start, None, table=OUTAGES_TABLE)
+        outages = []
+        for outage_end, outage_start, kind in zip(df.index, df["start"], df["kind"]):
+            outage = Outage(
+                max(datetime.datetime.utcfromtimestamp(outage_start), start),
+                min(outage_end.to_pydatetime(), end),
+                kind,
+            )
+            if outage.seconds > 0:
+                outages.append(outage)
+
+        if self.disconnected_since is not None:
+            ongoing = Outage(
+                max(datetime.datetime.utcfromtimestamp(self.disconnected_since), start),
+                min(datetime.datetime.utcfromtimestamp(time()), end),
+                DISCONNECTED,
+            )
+            if ongoing.seconds > 0:
+                outages.append(ongoing)
+
+        return sorted(outages, key=lambda o: o.start)
+
     async def get_data(self, num_days: int) -> UptimeData:
         await self.ready.wait()
 
@@ -1,17 +1,23 @@
 from __future__ import annotations
 
 import asyncio
+import datetime
 from abc import ABC, ABCMeta, abstractmethod
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from typing import Any
 
-import discord
 import pandas
+from cachetools import LRUCache
 from discord.ext.commands.cog import CogMeta
 from redbot.core.bot import Red
 from redbot.core.config import Config
 
+from .buffer import Sample, SampleBuffer
+from .counter import MemberCounter
 from .driver import StatTrackSQLiteDriver
+from .histogram import CommandStats, CommandTimings
+from .lag import LagMonitor
+from .openmetrics import MetricsServer
 from .vexutils.loop import VexLoop
 
 
@@ -30,18 +36,48 @@ class MixinMeta(ABC):
 
     driver: StatTrackSQLiteDriver
     plot_executor: ThreadPoolExecutor
+    plot_process_pool: ProcessPoolExecutor | None
+    plot_processes: int
+    plot_renderer: str
 
     loop_meta: VexLoop
     loop: asyncio.Task
     last_loop_time: str
+    last_compact: str
+    compact_task: asyncio.Task | None
 
     last_plot_debug: dict[str, Any] | None
+    graph_cache: LRUCache
+    graph_cache_hits: int
+    graph_cache_misses: int
 
     cmd_count: int
+    command_timings: CommandTimings
+    command_stats: list[tuple[datetime.datetime, dict[str, CommandStats]]]
+    lag_monitor: LagMonitor
     msg_count: int
 
+    members: MemberCounter
+    loops_since_reconcile: int | None
+
+    samples: SampleBuffer
+    latest_sample: Sample | None
+    metrics_server: MetricsServer
+
+    @abstractmethod
+    async def plot(self, df: pandas.DataFrame, ylabel: str, status_colours: bool) -> bytes:
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_plot_processes(self, processes: int) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def flush_samples(self) -> None:
+        raise NotImplementedError
+
     @abstractmethod
-    async def plot(self, df: pandas.DataFrame, ylabel: str, status_colours: bool) -> discord.File:
+    async def compact_storage(self) -> None:
         raise NotImplementedError
 
     @abstractmethod
@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+import datetime
+import json
+import os
+from collections import deque
+from typing import IO, Deque, Dict, List, Optional, Tuple
+
+from stattrack.driver import to_epoch
+
+from .vexutils import get_vex_logger
+
+_log = get_vex_logger(__name__)
+
+Sample = Tuple[datetime.datetime, Dict[str, float]]
+
+# a day of samples. if writing to the database keeps failing, the oldest are dropped after this
+MAX_SAMPLES = 1440
+
+
+class SampleBuffer:
+    """Hold samples in memory until they are written to the database in a batch.
+
+    Each sample is also appended to a journal file as a line of JSON, so samples are not lost if
+    the bot crashes before the batch is written. Samples left in the journal are loaded by
+    `load`. The journal is flushed to the OS, but not fsynced, on each sample.
+
+    Once `close` is called the journal belongs to whatever loads it next, for example the cog
+    after a reload, so this buffer stops touching the file. Samples written to the database after
+    that are written again by the next load, which overwrites the same rows.
+    """
+
+    def __init__(self, journal_path: str, maxlen: int = MAX_SAMPLES) -> None:
+        self.journal_path = journal_path
+        self._samples: Deque[Sample] = deque(maxlen=maxlen)
+        self._journal: Optional[IO[str]] = None
+        self._closed = False
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    @property
+    def last_time(self) -> Optional[datetime.datetime]:
+        """Time of the newest sample, or None if the buffer is empty."""
+        return self._samples[-1][0] if self._samples else None
+
+    def load(self) -> None:
+        """Load samples left in the journal, and open it for new samples."""
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, encoding="utf-8") as fp:
+                for line in fp:
+                    try:
+                        raw = json.loads(line)
+                    except json.JSONDecodeError:  # probably half-written during a crash
+                        _log.warning("Skipping a corrupt line in the StatTrack journal.")
+                        continue
+                    self._samples.append(
+                        (datetime.datetime.utcfromtimestamp(raw["time"]), raw["data"])
+                    )
+            if self._samples:
+                _log.info(f"Loaded {len(self._samples)} unsaved samples from the journal.")
+        self._rewrite_journal()
+
+    def add(self, time: datetime.datetime, data: Dict[str, float]) -> None:
+        """Add a sample at a naive UTC time."""
+        self._samples.append((time, data))
+        if self._journal is not None:
+            self._journal.write(json.dumps({"time": to_epoch(time), "data": data}) + "\n")
+            self._journal.flush()
+
+    def peek(self) -> List[Sample]:
+        """Get all samples, oldest first, without removing them."""
+        return list(self._samples)
+
+    def drop(self, count: int) -> None:
+        """Remove the oldest samples once they have been written to the database."""
+        for _ in range(min(count, len(self._samples))):
+            self._samples.popleft()
+        self._rewrite_journal()
+
+    def close(self) -> None:
+        """Close the journal and stop writing to it. Samples still in it will be loaded next time.
+
+        This must be called before another buffer loads the same journal.
+        """
+        self._close_journal()
+        self._closed = True
+
+    def _close_journal(self) -> None:
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def _rewrite_journal(self) -> None:
+        if self._closed:
+            return
+        self._close_journal()
+        tmp_path = self.journal_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fp:
+            for time, data in self._samples:
+                fp.write(json.dumps({"time": to_epoch(time), "data": data}) + "\n")
+        os.replace(tmp_path, self.journal_path)
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
@@ -2,15 +2,21 @@ from __future__ import annotations
 
 import datetime
 import json
-from io import StringIO
+import os
+from io import BytesIO, StringIO
 from time import monotonic
-from typing import Iterable, Optional
+from typing import Iterable, List, Optional
 
 import discord
 import pandas as pd
 from discord.ext.commands.cooldowns import BucketType
 from redbot.core import commands
-from redbot.core.utils.chat_formatting import box, humanize_number, humanize_timedelta
+from redbot.core.utils.chat_formatting import (
+    box,
+    humanize_list,
+    humanize_number,
+    humanize_timedelta,
+)
 
 from stattrack.abc import MixinMeta
 from stattrack.converters import (
@@ -19,6 +25,11 @@ from stattrack.converters import (
     TimespanConverter,
     UserGraphConverter,
 )
+from stattrack.export import CSVExporter, ParquetExporter, read_parquet, use_pyarrow
+from stattrack.histogram import BUCKET_COUNT, percentiles
+from stattrack.plot import CachedGraph
+from stattrack.pngplot import use_pillow
+from stattrack.summary import summarise
 
 from .vexutils import get_vex_logger
 
@@ -26,6 +37,29 @@ log = get_vex_logger(__name__)
 
 DEFAULT_DELTA = datetime.timedelta(days=1)
 
+# smallest bucket for command latency graphs, in minutes
+LATENCY_MIN_FREQUENCY = 5
+# percentile to plot, and its name
+LATENCY_PERCENTILES = {0.5: "p50", 0.95: "p95", 0.99: "p99"}
+
+TOP_COMMANDS = 10
+
+# most shards to show as separate lines on one graph
+MAX_SHARD_LINES = 10
+
+_BUCKETS = [f"b{i}" for i in range(BUCKET_COUNT)]
+
+
+def _describe_timespan(delta: datetime.timedelta) -> str:
+    if delta == datetime.timedelta(days=9000):  # "all" was entered and was replaced with 9k
+        return " all time"
+    return " for the last " + humanize_timedelta(timedelta=delta)
+
+
+def _number(value: float) -> int | float:
+    """Show whole numbers without a trailing .0 in embeds."""
+    return int(value) if float(value).is_integer() else float(value)
+
 
 class StatTrackCommands(MixinMeta):
     async def all_in_one(
@@ -40,74 +74,132 @@ class StatTrackCommands(MixinMeta):
         status_colours: bool = False,
         do_average: bool = False,
         show_total: bool = False,
+        shards: List[int] | None = None,
+        combine_shards: bool = False,
     ) -> None:
         if ylabel is None:
             ylabel = title
-        db_start = monotonic()
-        df = await self.driver.read_partial([label] if isinstance(label, str) else label, delta)
-        db_time = monotonic() - db_start
+        metrics = [label] if isinstance(label, str) else list(label)
 
-        if len(df) < 2:
-            await ctx.send("I need a little longer to collect data. Try again in a minute.")
-            return
-        if do_average and len(df) < 30:
-            await ctx.send(
-                "I need a little longer to collect data for this particular metric. "
-                "Others should still work. Try again in a few minutes."
-            )
-            return
+        # samples that haven't been written yet are read with the rest, instead of writing them
+        # early and losing the benefit of batching
+        pending = self.samples.peek()
+        maxpoints = await self.config.maxpoints()
+        # the version changes whenever anything in the timespan is written, so new data (or
+        # another cluster filling in a minute) means a new key
+        cache_key = (
+            tuple(metrics),
+            delta,
+            maxpoints,
+            await self.driver.get_data_version(delta),
+            len(pending),
+            self.samples.last_time,
+            ylabel,
+            status_colours,
+            do_average,
+            show_total,
+            tuple(shards or ()),
+            combine_shards,
+        )
+        graph = self.graph_cache.get(cache_key)
+        cache_hit = graph is not None
+        db_time = processing_time = stats_time = plot_time = 0.0
+        if cache_hit:
+            self.graph_cache_hits += 1
+        else:
+            self.graph_cache_misses += 1
+            # work out the bucket size first, so the database only returns the points to plot
+            db_start = monotonic()
+            first = await self.driver.get_first_index()
+
+            now = datetime.datetime.utcnow().replace(microsecond=0, second=0)
+            start = now - delta
+            if first is not None:
+                start = max(start, first.to_pydatetime())
+
+            delta_max_points = (now - start).total_seconds() / 60
+
+            if delta_max_points > 1440 and maxpoints != -1:  # 1 day
+                frequency = int(delta_max_points // maxpoints)
+                if frequency < 1:
+                    frequency = 1
+            else:
+                frequency = 1
+
+            # use hourly or daily rollups if the bucket is big enough, or raw data has been pruned
+            bucket = await self.driver.resolve_bucket(datetime.timedelta(minutes=frequency), delta)
+            frequency = int(bucket.total_seconds() // 60)
 
-        processing_start = monotonic()
+            aggregates = ("min", "mean", "max", "sum") if show_total else ("min", "mean", "max")
+            if combine_shards:
+                agg_df = await self.driver.read_shards_combined(
+                    metrics[0], bucket, delta, aggregates=aggregates, pending=pending
+                )
+            elif shards:
+                agg_df = await self.driver.read_shards_downsampled(
+                    metrics[0],
+                    bucket,
+                    delta,
+                    shards=shards,
+                    aggregates=aggregates,
+                    pending=pending,
+                )
+            else:
+                agg_df = await self.driver.read_downsampled(
+                    metrics, bucket, delta, aggregates=aggregates, pending=pending
+                )
+            db_time = monotonic() - db_start
 
-        # index data to desired delta
-        now = datetime.datetime.utcnow().replace(microsecond=0, second=0)
-        start = now - delta
-        start = max(start, df.first_valid_index())
+            if len(agg_df) < 2:
+                await ctx.send("I need a little longer to collect data. Try again in a minute.")
+                return
+            if do_average and len(agg_df) < 30:
+                await ctx.send(
+                    "I need a little longer to collect data for this particular metric. "
+                    "Others should still work. Try again in a few minutes."
+                )
+                return
 
-        delta_max_points = (now - start).total_seconds() / 60
+            processing_start = monotonic()
 
-        maxpoints = await self.config.maxpoints()
-        if delta_max_points > 1440 and maxpoints != -1:  # 1 day
-            frequency = int(delta_max_points // maxpoints)
-            if frequency < 1:
-                frequency = 1
-        else:
-            frequency = 1
-        expected_index = pd.date_range(start=start, end=now, freq=f"{frequency}min")
-        df = df.reindex(index=expected_index)
+            # index data to desired delta, buckets start on multiples of the frequency
+            expected_index = pd.date_range(
+                start=pd.Timestamp(start).floor(f"{frequency}min"), end=now, freq=f"{frequency}min"
+            )
+            agg_df = agg_df.reindex(index=expected_index)
 
-        df = pd.DataFrame(df)  # ensure it is a df, sometimes series
+            processing_time = monotonic() - processing_start
 
-        if show_total is True:
-            total_before_avg = df.sum().values[0]
+            # plot the bucket means, get everything for the embed at the same time
+            stats_start = monotonic()
+            summary = summarise(agg_df, 10 if do_average else 1)
+            df = summary.series
+            stats_time = monotonic() - stats_start
 
-        if do_average:
-            df = df.rolling(10, min_periods=1).mean()
+            plot_start = monotonic()
+            async with ctx.typing():
+                png = await self.plot(df, ylabel, status_colours)
+            plot_time = monotonic() - plot_start
 
-        processing_time = monotonic() - processing_start
+            fields = []
+            if len(df.columns) == 1:
+                fields.append(("Min", _number(summary.min[0])))
+                fields.append(("Max", _number(summary.max[0])))
+                fields.append(("Average", round(float(summary.mean[0]), 2)))
+                if show_total is True:
+                    fields.append(("Total", _number(summary.total[0])))
 
-        plot_start = monotonic()
-        async with ctx.typing():
-            graph = await self.plot(df, ylabel, status_colours)
-        plot_time = monotonic() - plot_start
+            graph = CachedGraph(png, fields, len(df), frequency, delta_max_points)
+            self.graph_cache[cache_key] = graph
 
         send_start = monotonic()
-        if delta == datetime.timedelta(days=9000):  # "all" was entered and was replaced with 9k
-            str_delta = " all time"
-        else:
-            str_delta = " for the last " + humanize_timedelta(timedelta=delta)
-
         embed = discord.Embed(
-            title=title + str_delta + (" (10 min averages)" if do_average else ""),
+            title=title + _describe_timespan(delta) + (" (10 min averages)" if do_average else ""),
             colour=await ctx.embed_colour(),
         )
 
-        if len(df.columns) == 1:
-            embed.add_field(name="Min", value=df.min().values[0])
-            embed.add_field(name="Max", value=df.max().values[0])
-            embed.add_field(name="Average", value=round(df.mean().values[0], 2))  # type:ignore
-            if show_total is True:
-                embed.add_field(name="Total", value=total_before_avg)  # type:ignore
+        for name, value in graph.fields:
+            embed.add_field(name=name, value=value)
 
         if more_options:
             embed.description = (
@@ -119,19 +211,21 @@ class StatTrackCommands(MixinMeta):
         embed.set_footer(text="Times are in UTC")
         embed.set_image(url="attachment://plot.png")
 
-        msg = await ctx.send(file=graph, embed=embed)
+        msg = await ctx.send(file=discord.File(BytesIO(graph.png), "plot.png"), embed=embed)
 
         send_time = monotonic() - send_start
 
         debug_info = {
             "plot_msg": msg.id,  # message id of sent plot
             "maxpoints": maxpoints,  # user set max points to plot on a graph
-            "mins": delta_max_points,  # the amount of minutes in the delta
-            "points_plotted": len(df),  # valid datapoints in the delta dataframe
-            "wanted_frequency": frequency,  # wanted frequency of the plot
+            "mins": graph.mins,  # the amount of minutes in the delta
+            "points_plotted": graph.points,  # valid datapoints in the delta dataframe
+            "wanted_frequency": graph.frequency,  # wanted frequency of the plot
+            "cache_hit": cache_hit,  # whether the plot came from the graph cache
             "plotted": label,  # metrics plotted
             "time_db": db_time,  # time taken for DB query
             "time_processing": processing_time,  # time taken for data processing
+            "time_stats": stats_time,  # time taken for rolling average and embed stats
             "time_plot": plot_time,  # time taken for plotting generation
             "send_time": send_time,  # time taken for sending the message
         }
@@ -139,6 +233,82 @@ class StatTrackCommands(MixinMeta):
         log.debug(f"Plot finished, info: {debug_info}")
         self.last_plot_debug = debug_info
 
+    async def command_latency(
+        self, ctx: commands.Context, delta: datetime.timedelta, command: str | None
+    ) -> None:
+        pending = list(self.command_stats)
+        maxpoints = await self.config.maxpoints()
+        cache_key = (
+            "command_latency",
+            command,
+            delta,
+            maxpoints,
+            await self.driver.get_data_version(delta),
+            len(pending),
+        )
+        graph = self.graph_cache.get(cache_key)
+        if graph is not None:
+            self.graph_cache_hits += 1
+        else:
+            self.graph_cache_misses += 1
+            now = datetime.datetime.utcnow().replace(microsecond=0, second=0)
+            start = now - delta
+            first = await self.driver.get_first_index()
+            if first is not None:
+                start = max(start, first.to_pydatetime())
+            mins = (now - start).total_seconds() / 60
+
+            # a few commands a minute is too few for percentiles, so buckets are at least 5 mins
+            frequency = LATENCY_MIN_FREQUENCY
+            if maxpoints != -1:
+                frequency = max(frequency, int(mins // maxpoints))
+            # use the hourly sums if the bucket is big enough, or minute data has been pruned
+            bucket = await self.driver.resolve_bucket(datetime.timedelta(minutes=frequency), delta)
+            frequency = int(bucket.total_seconds() // 60)
+
+            hist = await self.driver.read_command_histograms(
+                bucket, delta, command=command, pending=pending
+            )
+            if hist["count"].sum() == 0:
+                await ctx.send("No commands have been timed in this timespan yet.")
+                return
+
+            values = percentiles(hist[_BUCKETS].to_numpy(), list(LATENCY_PERCENTILES))
+            expected_index = pd.date_range(
+                start=pd.Timestamp(start).floor(f"{frequency}min"), end=now, freq=f"{frequency}min"
+            )
+            df = pd.DataFrame(
+                values, index=hist.index, columns=list(LATENCY_PERCENTILES.values())
+            ).reindex(index=expected_index)
+
+            async with ctx.typing():
+                png = await self.plot(df, "Execution time (ms)", False)
+
+            totals = hist.sum()
+            overall = percentiles(totals[_BUCKETS].to_numpy(), list(LATENCY_PERCENTILES))[0]
+            fields = [
+                ("Commands", humanize_number(int(totals["count"]))),
+                ("Errors", humanize_number(int(totals["errors"]))),
+                ("Average", f"{totals['total_ms'] / totals['count']:.0f}ms"),
+            ]
+            fields += [
+                (name, f"{value:.0f}ms")
+                for name, value in zip(LATENCY_PERCENTILES.values(), overall)
+            ]
+            graph = CachedGraph(png, fields, len(df), frequency, mins)
+            self.graph_cache[cache_key] = graph
+
+        embed = discord.Embed(
+            title=f"Execution time of {f'`{command}`' if command else 'all commands'}"
+            + _describe_timespan(delta),
+            colour=await ctx.embed_colour(),
+        )
+        for name, value in graph.fields:
+            embed.add_field(name=name, value=value)
+        embed.set_footer(text="Times are in UTC. Percentiles are estimated from histograms.")
+        embed.set_image(url="attachment://plot.png")
+        await ctx.send(file=discord.File(BytesIO(graph.png), "plot.png"), embed=embed)
+
     @commands.cooldown(10, 60.0, BucketType.user)
     @commands.group()
     async def stattrack(self, ctx: commands.Context):
@@ -148,17 +318,25 @@ class StatTrackCommands(MixinMeta):
     @stattrack.command(hidden=True)
     async def devimport(self, ctx: commands.Context):
         """
-        Import data from a JSON string, orient "split".
+        Import data from a Parquet file from `[p]stattrack export parquet`, or a JSON string,
+        orient "split".
 
         This is for development purposes only.
 
-        Please attack a `.json` file.
+        Please attach a `.parquet` or `.json` file.
         """
+        attachment = ctx.message.attachments[0]
+        if attachment.filename.endswith(".parquet") and not use_pyarrow:
+            await ctx.send("You need to install `pyarrow` to import Parquet files.")
+            return
         async with ctx.typing():
             self.loop.cancel()
-            await self.driver.write(
-                pd.read_json(await ctx.message.attachments[0].read(), orient="split", typ="frame")
-            )
+            data = await attachment.read()
+            if attachment.filename.endswith(".parquet"):
+                df = await self.bot.loop.run_in_executor(None, read_parquet, data)
+            else:
+                df = pd.read_json(data, orient="split", typ="frame")
+            await self.driver.write(df)
         await ctx.send("Done.")
 
     @commands.is_owner()
@@ -176,13 +354,18 @@ class StatTrackCommands(MixinMeta):
     @commands.is_owner()
     @stattrack.group()
     async def export(self, ctx: commands.Context):
-        """Export stattrack data."""
+        """
+        Export stattrack data.
+
+        Where minute-by-minute data has been deleted, hourly or daily averages are exported
+        instead.
+        """
 
     @export.command(name="json")
     async def export_json(self, ctx: commands.Context):
         """Export as JSON with pandas orient "split" """
         async with ctx.typing():
-            data = (await self.driver.read_all()).to_json(orient="split")
+            data = (await self.driver.read_all(self.samples.peek())).to_json(orient="split")
             fp = StringIO()
             fp.write(str(data))
             size = fp.tell()
@@ -201,11 +384,43 @@ class StatTrackCommands(MixinMeta):
             "Here is your file.", file=discord.File(fp, "stattrack.json")  # type:ignore
         )
 
+    @export.command(name="parquet")
+    async def export_parquet(self, ctx: commands.Context):
+        """
+        Export as a compressed Parquet file.
+
+        This is much smaller than the other formats, and can be opened with pandas, Polars,
+        DuckDB and others. `pyarrow` must be installed.
+        """
+        if not use_pyarrow:
+            await ctx.send(
+                "You need to install `pyarrow` to export Parquet files. Use "
+                f"`{ctx.clean_prefix}pipinstall pyarrow` to install it."
+            )
+            return
+        async with ctx.typing():
+            exporter = ParquetExporter()
+            async for chunk in self.driver.read_chunks(pending=self.samples.peek()):
+                await self.bot.loop.run_in_executor(None, exporter.write, chunk)
+            fp = await self.bot.loop.run_in_executor(None, exporter.close)
+            size = len(fp.getbuffer())
+            if ctx.guild:
+                max_size = ctx.guild.filesize_limit
+            else:
+                max_size = 8388608
+            if size > max_size:
+                await ctx.send(
+                    "Sorry, this file is too big to send here. Try a server with a higher upload "
+                    "file size limit."
+                )
+                return
+        await ctx.send("Here is your file.", file=discord.File(fp, "stattrack.parquet"))
+
     @export.command(name="csv")
     async def export_csv(self, ctx: commands.Context):
         """Export as CSV"""
         async with ctx.typing():
-            data = (await self.driver.read_all()).to_csv()
+            data = (await self.driver.read_all(self.samples.peek())).to_csv()
             fp = StringIO()
             fp.write(str(data))
             size = fp.tell()
@@ -222,6 +437,39 @@ class StatTrackCommands(MixinMeta):
             fp.seek(0)
         await ctx.send("Here is your file.", file=discord.File(fp, "stattrack.csv"))  # type:ignore
 
+    @export.command(name="csvgz", aliases=["csv.gz"])
+    async def export_csvgz(self, ctx: commands.Context):
+        """
+        Export as a gzipped CSV.
+
+        This is the same as the CSV export, but much smaller and works for any amount of data.
+        """
+        if ctx.guild:
+            max_size = ctx.guild.filesize_limit
+        else:
+            max_size = 8388608
+        async with ctx.typing():
+            exporter = CSVExporter()
+            try:
+                async for chunk in self.driver.read_chunks(pending=self.samples.peek()):
+                    await self.bot.loop.run_in_executor(None, exporter.write, chunk)
+                    if exporter.size > max_size:  # no point carrying on
+                        await ctx.send(
+                            "Sorry, this file is too big to send here. Try a server with a higher "
+                            "upload file size limit."
+                        )
+                        return
+                fp = await self.bot.loop.run_in_executor(None, exporter.close)
+                if exporter.size > max_size:
+                    await ctx.send(
+                        "Sorry, this file is too big to send here. Try a server with a higher "
+                        "upload file size limit."
+                    )
+                    return
+                await ctx.send("Here is your file.", file=discord.File(fp, "stattrack.csv.gz"))
+            finally:
+                exporter.fp.close()
+
     @commands.is_owner()
     @stattrack.command()
     async def maxpoints(self, ctx: commands.Context, maxpoints: int):
@@ -251,6 +499,216 @@ class StatTrackCommands(MixinMeta):
         await self.config.maxpoints.set(maxpoints)
         await ctx.send(f"Done, the maximum points to plot is now {humanize_number(maxpoints)}.")
 
+    @commands.is_owner()
+    @stattrack.command()
+    async def plotprocesses(self, ctx: commands.Context, processes: int):
+        """
+        Set how many separate processes to plot graphs in.
+
+        By default (0), graphs are plotted in threads of the bot's process. Plotting is mostly
+        Python, so while a graph is being made the rest of the bot can slow down.
+
+        With 1 or more processes, graphs are made outside of the bot's process. Each process
+        uses around 100MB of RAM, even when no graphs are being made.
+
+        **Examples:**
+            - `[p]stattrack plotprocesses 2` - plot in 2 processes
+            - `[p]stattrack plotprocesses 0` - the default, plot in the bot's process
+        """
+        if processes < 0 or processes > 8:
+            await ctx.send("The number of processes must be between 0 and 8.")
+            return
+        await self.config.plot_processes.set(processes)
+        self.set_plot_processes(processes)
+        if processes:
+            await ctx.send(f"Done, graphs will be plotted in {processes} separate processes.")
+        else:
+            await ctx.send("Done, graphs will be plotted in the bot's process.")
+
+    @commands.is_owner()
+    @stattrack.command()
+    async def renderer(self, ctx: commands.Context, renderer: str):
+        """
+        Set how graphs are drawn.
+
+        `plotly` is the default, and is what the graphs have always used.
+
+        `native` draws simple line graphs directly, which is much faster and uses less memory.
+        It needs `Pillow` 10.1 or newer to be installed. Graphs it can't draw still use plotly.
+
+        **Examples:**
+            - `[p]stattrack renderer native` - draw graphs natively
+            - `[p]stattrack renderer plotly` - the default
+        """
+        renderer = renderer.lower()
+        if renderer not in ("plotly", "native"):
+            await ctx.send("The renderer must be `plotly` or `native`.")
+            return
+        if renderer == "native" and not use_pillow:
+            await ctx.send(
+                "You need to install `Pillow` 10.1 or newer to use the native renderer. Use "
+                f"`{ctx.clean_prefix}pipinstall Pillow` to install it."
+            )
+            return
+        await self.config.plot_renderer.set(renderer)
+        self.plot_renderer = renderer
+        self.graph_cache.clear()
+        await ctx.send(f"Done, graphs will be drawn with {renderer}.")
+
+    @commands.is_owner()
+    @stattrack.command(usage="<cluster_id> <path>")
+    async def cluster(self, ctx: commands.Context, cluster_id: str, *, path: str = ""):
+        """
+        Share one database between several bot processes (clusters) on this machine.
+
+        Each process writes its own metrics with its cluster ID, and graphs show the whole
+        fleet. Counts such as servers, commands and users are added together (so users in more
+        than one cluster are counted more than once), latency and system usage are averaged,
+        and event loop lag and GC pauses show the worst cluster.
+
+        A minute is only shown once every running cluster has saved it, so graphs can be a few
+        minutes behind. A cluster that hasn't saved anything for 15 minutes isn't waited for.
+
+        Run this on every process with the same path and a different cluster ID, then reload
+        the cog. The database that was used before is kept, and is used again if you turn
+        sharing off with `[p]stattrack cluster off`.
+
+        **Examples:**
+            - `[p]stattrack cluster 0 /home/bot/stattrack.db` - this process is cluster 0
+            - `[p]stattrack cluster off` - the default, use a database for this process only
+        """
+        if cluster_id.lower() == "off":
+            await self.config.shared_db_path.clear()
+            await self.config.cluster_id.clear()
+            await ctx.send(
+                f"Done, reload the cog with `{ctx.clean_prefix}reload stattrack` to go back to a "
+                "database for this process only."
+            )
+            return
+
+        if not path or not os.path.isabs(path):
+            await ctx.send("You need to give the full path to the shared database.")
+            return
+        if not os.path.isdir(os.path.dirname(path)):
+            await ctx.send("The folder for the shared database doesn't exist.")
+            return
+
+        await self.config.shared_db_path.set(path)
+        await self.config.cluster_id.set(cluster_id)
+        await ctx.send(
+            f"Done, reload the cog with `{ctx.clean_prefix}reload stattrack` to start writing "
+            f"to the shared database as cluster {cluster_id}. Remember to do this on every "
+            "cluster, with a different ID for each."
+        )
+
+    @commands.is_owner()
+    @stattrack.command()
+    async def metricsserver(self, ctx: commands.Context, port: int, host: str = "127.0.0.1"):
+        """
+        Serve the latest metrics for Prometheus or other monitoring to scrape.
+
+        Metrics are served in the OpenMetrics text format at `/metrics`, straight from memory,
+        so scrapes don't use the database or draw graphs. They update every minute.
+
+        By default, the server only listens on this machine (`127.0.0.1`). Set the host to
+        `0.0.0.0` to listen on all interfaces. Make sure you are aware of the security risk of
+        exposing your machine to the internet.
+
+        Set the port to 0 to turn the server off. It's off by default.
+
+        **Examples:**
+            - `[p]stattrack metricsserver 9110` - serve at http://127.0.0.1:9110/metrics
+            - `[p]stattrack metricsserver 9110 0.0.0.0` - listen on all interfaces
+            - `[p]stattrack metricsserver 0` - turn the server off
+        """
+        if not 0 <= port <= 65535:
+            await ctx.send("The port must be between 0 and 65535.")
+            return
+        if port == 0:
+            await self.metrics_server.stop()
+            await self.config.metrics_port.set(0)
+            await ctx.send("Done, the metrics server has been turned off.")
+            return
+
+        try:
+            await self.metrics_server.start(host, port)
+        except OSError as e:
+            await ctx.send(
+                f"Failed to start the metrics server on {host}:{port}: ```\n{e}```\nPlease choose "
+                "a different host or port. The metrics server is not running at the moment."
+            )
+            return
+        await self.config.metrics_host.set(host)
+        await self.config.metrics_port.set(port)
+        await ctx.send(f"Done, metrics are being served at <{self.metrics_server.address}>.")
+
+    @commands.is_owner()
+    @stattrack.command()
+    async def retention(self, ctx: commands.Context, days: int, resolution: str = "minute"):
+        """
+        Set how many days of data to keep at each resolution.
+
+        Resolution can be `minute`, `hourly` or `daily`. By default, minute-by-minute data is
+        kept for 14 days and hourly and daily summaries are kept forever. If the bot was already
+        tracking stats before summaries were added, minute data is kept forever until this is set.
+
+        Graphs for longer timespans use the summaries, so they still work after minute data is
+        deleted, but they can't show each minute.
+
+        Command usage and execution times follow the minute and hourly settings. They have no
+        daily summaries.
+
+        Old data is deleted, and the space it used is freed, in the background every hour.
+
+        Set days to -1 to keep data at that resolution forever.
+
+        **Examples:**
+            - `[p]stattrack retention 30` - keep 30 days of minute data
+            - `[p]stattrack retention 365 hourly` - keep a year of hourly summaries
+            - `[p]stattrack retention -1 daily` - never delete daily summaries
+        """
+        resolutions = {
+            "minute": ("raw_retention_days", "minute-by-minute data"),
+            "hourly": ("hourly_retention_days", "hourly summaries"),
+            "daily": ("daily_retention_days", "daily summaries"),
+        }
+        if resolution.lower() not in resolutions:
+            await ctx.send("Resolution must be one of `minute`, `hourly` or `daily`.")
+            return
+        key, name = resolutions[resolution.lower()]
+        if days < 1 and days != -1:
+            await ctx.send("The minimum value is 1.")
+            return
+        await self.config.set_raw(key, value=days)
+        if days == -1:
+            await ctx.send(f"Done, {name} will be kept forever.")
+        else:
+            await ctx.send(f"Done, {name} will be kept for {humanize_number(days)} days.")
+
+    @commands.is_owner()
+    @stattrack.command()
+    async def countmode(self, ctx: commands.Context, enabled: bool):
+        """
+        Count users in compact mode, for very large bots.
+
+        By default, user and status counts are kept up to date as members join, leave and
+        change status. This is fast, but keeps a record of every user in memory.
+
+        In compact mode, all members are counted each minute instead, using much less memory
+        but more CPU.
+
+        **Examples:**
+            - `[p]stattrack countmode true` - use compact mode
+            - `[p]stattrack countmode false` - the default
+        """
+        await self.config.compact_counting.set(enabled)
+        self.members.set_compact(enabled)
+        self.loops_since_reconcile = None  # recount on the next loop
+        if enabled:
+            await ctx.send("Done, users will be counted in compact mode.")
+        else:
+            await ctx.send("Done, users will be counted as they join, leave and change status.")
+
     @stattrack.command(aliases=["ping"])
     async def latency(self, ctx: commands.Context, timespan: TimespanConverter = DEFAULT_DELTA):
         """
@@ -285,11 +743,68 @@ class StatTrackCommands(MixinMeta):
         """
         await self.all_in_one(ctx, timespan, "loop_time_s", "Loop time", "Loop time (seconds)")
 
-    @stattrack.command(name="commands")
+    @stattrack.command(aliases=["lag"])
+    async def eventloop(self, ctx: commands.Context, timespan: TimespanConverter = DEFAULT_DELTA):
+        """
+        Get event loop lag stats.
+
+        Lag is how late the bot's event loop is at running something that was scheduled, so
+        high lag means everything the bot does is delayed. The max and p99 for each minute are
+        shown.
+
+        **Arguments**
+
+        `<timespan>` How long to look for, or `all` for all-time data. Defaults to 1 day. Must be
+        at least 1 hour.
+
+        **Examples:**
+            - `[p]stattrack eventloop 3w2d`
+            - `[p]stattrack eventloop 5d`
+            - `[p]stattrack eventloop all`
+        """
+        await self.all_in_one(
+            ctx,
+            timespan,
+            ["loop_lag_max_ms", "loop_lag_p99_ms"],
+            "Event loop lag",
+            "Event loop lag (ms)",
+        )
+
+    @stattrack.command(name="gc")
+    async def garbage_collection(
+        self, ctx: commands.Context, timespan: TimespanConverter = DEFAULT_DELTA
+    ):
+        """
+        Get garbage collection pause stats.
+
+        Python pauses the whole bot while it collects garbage. The max and p99 pause for each
+        minute are shown.
+
+        **Arguments**
+
+        `<timespan>` How long to look for, or `all` for all-time data. Defaults to 1 day. Must be
+        at least 1 hour.
+
+        **Examples:**
+            - `[p]stattrack gc 3w2d`
+            - `[p]stattrack gc 5d`
+            - `[p]stattrack gc all`
+        """
+        await self.all_in_one(
+            ctx,
+            timespan,
+            ["gc_pause_max_ms", "gc_pause_p99_ms"],
+            "Garbage collection pauses",
+            "Pause (ms)",
+        )
+
+    @stattrack.group(name="commands", invoke_without_command=True)
     async def com(self, ctx: commands.Context, timespan: TimespanConverter = DEFAULT_DELTA):
         """
         Get command usage stats.
 
+        See the subcommands for how long commands take to run, and which are used most.
+
         **Arguments**
 
         `<timespan>` How long to look for, or `all` for all-time data. Defaults to 1 day. Must be
@@ -304,6 +819,78 @@ class StatTrackCommands(MixinMeta):
             ctx, timespan, "command_count", "Commands per minute", do_average=True, show_total=True
         )
 
+    @com.command(name="latency", aliases=["time"])
+    async def com_latency(
+        self,
+        ctx: commands.Context,
+        timespan: Optional[TimespanConverter] = DEFAULT_DELTA,
+        *,
+        command: Optional[str] = None,
+    ):
+        """
+        Get how long commands take to run, as the median (p50), p95 and p99 over time.
+
+        The times are from when a command is invoked to when it finishes or errors. Pass a
+        command to only show that command, otherwise all commands are shown together.
+
+        **Arguments**
+
+        `<timespan>` How long to look for, or `all` for all-time data. Defaults to 1 day. Must be
+        at least 1 hour.
+
+        `<command>` The command to show. Defaults to all commands.
+
+        **Examples:**
+            - `[p]stattrack commands latency`
+            - `[p]stattrack commands latency 5d`
+            - `[p]stattrack commands latency 1w stattrack latency`
+        """
+        if command is not None:
+            found = self.bot.get_command(command)
+            # stats are stored by qualified name, commands that no longer exist are still shown
+            command = found.qualified_name if found else command.lower()
+        await self.command_latency(ctx, timespan or DEFAULT_DELTA, command)
+
+    @com.command(name="top", aliases=["usage"])
+    async def com_top(self, ctx: commands.Context, timespan: TimespanConverter = DEFAULT_DELTA):
+        """
+        Get the most used commands, with how long they take to run.
+
+        **Arguments**
+
+        `<timespan>` How long to look for, or `all` for all-time data. Defaults to 1 day. Must be
+        at least 1 hour.
+
+        **Examples:**
+            - `[p]stattrack commands top`
+            - `[p]stattrack commands top 1w`
+            - `[p]stattrack commands top all`
+        """
+        totals = await self.driver.read_command_totals(timespan, pending=self.command_stats)
+        if totals.empty:
+            await ctx.send("No commands have been run in this timespan yet.")
+            return
+
+        top = totals.head(TOP_COMMANDS)
+        stats = percentiles(top[_BUCKETS].to_numpy(), (0.5, 0.95))
+        lines = []
+        for (name, row), (p50, p95) in zip(top.iterrows(), stats):
+            lines.append(
+                f"`{name}`: {humanize_number(int(row['count']))} uses, "
+                f"{humanize_number(int(row['errors']))} errors, p50 {p50:.0f}ms, p95 {p95:.0f}ms"
+            )
+
+        embed = discord.Embed(
+            title=f"Top commands{_describe_timespan(timespan)}",
+            description="\n".join(lines),
+            colour=await ctx.embed_colour(),
+        )
+        embed.set_footer(
+            text=f"{humanize_number(int(totals['count'].sum()))} commands run in total. "
+            "Percentiles are estimated from histograms."
+        )
+        await ctx.send(embed=embed)
+
     @stattrack.command()
     async def messages(self, ctx: commands.Context, timespan: TimespanConverter = DEFAULT_DELTA):
         """
@@ -474,6 +1061,138 @@ class StatTrackCommands(MixinMeta):
             ctx, timespan, ["channels_" + g for g in metrics], "Channels", more_options=True
         )
 
+    async def shard_graph(
+        self,
+        ctx: commands.Context,
+        timespan: datetime.timedelta,
+        metric: str,
+        shards: List[int],
+        title: str,
+        ylabel: str,
+    ) -> None:
+        available = await self.driver.get_shards(metric)
+        if not available:
+            await ctx.send(
+                "There's no data for shards yet. Shards are only tracked when I'm running more "
+                "than one."
+            )
+            return
+
+        if not shards:
+            await self.all_in_one(
+                ctx,
+                timespan,
+                metric,
+                title + " (highest, average and lowest shard)",
+                ylabel,
+                combine_shards=True,
+            )
+            return
+
+        shards = list(dict.fromkeys(shards))
+        missing = [str(shard_id) for shard_id in shards if shard_id not in available]
+        if missing:
+            await ctx.send(f"There's no data for shard {humanize_list(missing, style='or')}.")
+            return
+        if len(shards) > MAX_SHARD_LINES:
+            await ctx.send(f"You can only choose up to {MAX_SHARD_LINES} shards at once.")
+            return
+        await self.all_in_one(ctx, timespan, metric, title, ylabel, shards=shards)
+
+    @stattrack.group()
+    async def shards(self, ctx: commands.Context):
+        """
+        See stats for each shard.
+
+        Shards are only tracked when I'm running more than one.
+        """
+
+    @shards.command(name="latency", aliases=["ping"], usage="[timespan=1d] [shards]")
+    async def shards_latency(
+        self,
+        ctx: commands.Context,
+        timespan: Optional[TimespanConverter] = DEFAULT_DELTA,
+        shards: commands.Greedy[int] = None,  # type:ignore
+    ):
+        """
+        Get the latency of each shard.
+
+        If you don't choose any shards, the highest, average and lowest shard is shown, so a
+        single slow shard stands out.
+
+        **Arguments**
+
+        `<timespan>` How long to look for, or `all` for all-time data. Defaults to 1 day. Must be
+        at least 1 hour.
+
+        `<shards>` The IDs of up to 10 shards to show.
+
+        **Examples:**
+            - `[p]stattrack shards latency` - highest, average and lowest shard
+            - `[p]stattrack shards latency 5d 0 3` - shards 0 and 3 for the last 5 days
+            - `[p]stattrack shards latency all 7` - shard 7, all-time
+        """
+        await self.shard_graph(
+            ctx, timespan or DEFAULT_DELTA, "ping", shards or [], "Shard latency", "Latency (ms)"
+        )
+
+    @shards.command(name="servers", aliases=["guilds"], usage="[timespan=1d] [shards]")
+    async def shards_servers(
+        self,
+        ctx: commands.Context,
+        timespan: Optional[TimespanConverter] = DEFAULT_DELTA,
+        shards: commands.Greedy[int] = None,  # type:ignore
+    ):
+        """
+        Get how many servers are on each shard.
+
+        If you don't choose any shards, the highest, average and lowest shard is shown.
+
+        **Arguments**
+
+        `<timespan>` How long to look for, or `all` for all-time data. Defaults to 1 day. Must be
+        at least 1 hour.
+
+        `<shards>` The IDs of up to 10 shards to show.
+
+        **Examples:**
+            - `[p]stattrack shards servers` - highest, average and lowest shard
+            - `[p]stattrack shards servers 5d 0 3` - shards 0 and 3 for the last 5 days
+            - `[p]stattrack shards servers all 7` - shard 7, all-time
+        """
+        await self.shard_graph(
+            ctx, timespan or DEFAULT_DELTA, "guilds", shards or [], "Shard servers", "Servers"
+        )
+
+    @shards.command(name="members", aliases=["users"], usage="[timespan=1d] [shards]")
+    async def shards_members(
+        self,
+        ctx: commands.Context,
+        timespan: Optional[TimespanConverter] = DEFAULT_DELTA,
+        shards: commands.Greedy[int] = None,  # type:ignore
+    ):
+        """
+        Get how many members are in the servers on each shard.
+
+        Users are counted once for each server they are in. If you don't choose any shards, the
+        highest, average and lowest shard is shown.
+
+        **Arguments**
+
+        `<timespan>` How long to look for, or `all` for all-time data. Defaults to 1 day. Must be
+        at least 1 hour.
+
+        `<shards>` The IDs of up to 10 shards to show.
+
+        **Examples:**
+            - `[p]stattrack shards members` - highest, average and lowest shard
+            - `[p]stattrack shards members 5d 0 3` - shards 0 and 3 for the last 5 days
+            - `[p]stattrack shards members all 7` - shard 7, all-time
+        """
+        await self.shard_graph(
+            ctx, timespan or DEFAULT_DELTA, "members", shards or [], "Shard members", "Members"
+        )
+
     @stattrack.group(aliases=["sys"])
     async def system(self, ctx: commands.Context):
         """Get system metrics."""
@@ -0,0 +1,58 @@
+import re
+
+# nothing from the rest of the cog is imported here, so any module can use these without an
+# import cycle
+
+STATUS_COLOURS = {
+    "status_online": "#3ba55d",
+    "status_idle": "#FAA81A",
+    "status_offline": "#747f8d",
+    "status_dnd": "#ed4245",
+}
+
+TRACE_FRIENDLY_NAMES = {
+    "ping": "Latency",
+    "loop_time_s": "Loop time",
+    "loop_lag_max_ms": "Max",
+    "loop_lag_p99_ms": "p99",
+    "gc_pause_max_ms": "Max",
+    "gc_pause_p99_ms": "p99",
+    "gc_collections": "Collections",
+    "users_unique": "Unique",
+    "users_total": "Total",
+    "users_humans": "Humans",
+    "users_bots": "Bots",
+    "guilds": "Servers",
+    "channels_total": "Total",
+    "channels_text": "Text",
+    "channels_voice": "Voice",
+    "channels_stage": "Stage",
+    "channels_cat": "Categories",
+    "sys_mem": "Memory usage",
+    "sys_cpu": "CPU Usage",
+    "command_count": "Commands",
+    "message_count": "Messages",
+    "status_online": "Online",
+    "status_idle": "Idle",
+    "status_offline": "Offline",
+    "status_dnd": "DnD",
+    "shards_max": "Highest shard",
+    "shards_mean": "Average shard",
+    "shards_min": "Lowest shard",
+}
+
+# per-shard metrics are stored as shard<id>_<metric>, for example shard3_ping
+SHARD_METRIC = re.compile(r"^shard(\d+)_(\w+)$")
+
+
+def shard_metric(shard_id: int, metric: str) -> str:
+    """Get the name a metric for one shard is stored as."""
+    return f"shard{shard_id}_{metric}"
+
+
+def friendly_name(metric: str) -> str:
+    """Get the name of a metric for legends."""
+    match = SHARD_METRIC.match(metric)
+    if match:
+        return f"Shard {match.group(1)}"
+    return TRACE_FRIENDLY_NAMES.get(metric, metric)
@@ -1,93 +1,893 @@
 from __future__ import annotations
 
 import asyncio
+import calendar
 import datetime
+import math
 import os
 import sqlite3
 from concurrent.futures import ThreadPoolExecutor
-from typing import Iterable
+from contextlib import asynccontextmanager, contextmanager
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Collection,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
 
 import aiosqlite
 import pandas as pd
 from redbot.core.data_manager import cog_data_path
 
+from stattrack.consts import SHARD_METRIC, shard_metric
+from stattrack.histogram import BUCKET_COUNT
+
+T = TypeVar("T")
+
+# samples not written to the database yet, as time and metrics
+Pending = Sequence[Tuple[datetime.datetime, Dict[str, float]]]
+# command stats not written to the database yet, as time and `append_command_stats`'s stats
+PendingCommands = Sequence[Tuple[datetime.datetime, Dict[str, Sequence[float]]]]
+
+READ_POOL_SIZE = 4
+
+CHUNK_SIZE = 50_000
+
+TABLE = "stats"
+
+# rollup tables, keyed by their resolution in seconds. these hold min/max/sum/count per metric
+# per bucket in long format, so they are kept after the raw minute data is pruned
+ROLLUPS = {3600: "stats_1h", 86400: "stats_1d"}
+# every table, keyed by resolution
+TABLES = {60: TABLE, **ROLLUPS}
+
+# per-shard metrics (see `SHARD_METRIC`), in long format so any number of shards fits. the raw
+# table has a value per minute, the rollups min/max/sum/count per bucket like ROLLUPS
+SHARD_TABLE = "shard_stats"
+SHARD_ROLLUPS = {3600: "shard_stats_1h", 86400: "shard_stats_1d"}
+SHARD_TABLES = {60: SHARD_TABLE, **SHARD_ROLLUPS}
+# every (metric, shard) pair that has been stored
+SHARD_SERIES = "shard_series"
+# matches every stored series, so queries on the shard tables seek to each series' time range
+# instead of scanning the whole table for it
+ALL_SERIES = (
+    f"metric IN (SELECT metric FROM {SHARD_SERIES}) "
+    f"AND shard IN (SELECT shard FROM {SHARD_SERIES})"
+)
+
+# per-command invocation counts and execution time histograms, one row per command per minute
+COMMAND_TABLE = "command_stats"
+# the same, summed for each hour, so they are kept after the minute rows are pruned
+COMMAND_ROLLUP = "command_stats_1h"
+COMMAND_TABLES = {60: COMMAND_TABLE, 3600: COMMAND_ROLLUP}
+COMMAND_COLUMNS = ["count", "errors", "total_ms"]
+
+# in shared mode, each process (cluster) writes its own rows here, keyed by cluster ID. the stats
+# table then holds the whole fleet, so everything that reads it works unchanged
+CLUSTER_TABLE = "cluster_stats"
+# how each metric is combined across clusters for the stats table. anything else is summed
+FLEET_AGGREGATES = {
+    "ping": "AVG",
+    "sys_cpu": "AVG",
+    "sys_mem": "AVG",
+    "loop_time_s": "MAX",
+    "loop_lag_max_ms": "MAX",
+    "loop_lag_p99_ms": "MAX",
+    "gc_pause_max_ms": "MAX",
+    "gc_pause_p99_ms": "MAX",
+}
+# the last minute each cluster has written. a minute is only added to the stats table once every
+# running cluster has written it, so the fleet totals are never partial
+CLUSTERS_TABLE = "clusters"
+# seconds since a cluster last wrote, behind the newest cluster, before it counts as stopped and
+# minutes are no longer held back for it. clusters write every few minutes
+CLUSTER_TIMEOUT = 15 * 60
+# seconds to wait for another process to finish writing to a shared database
+BUSY_TIMEOUT = 30.0
+
+# how many times the data for each day has been written to, keyed by the day's start in epoch
+# seconds. a cached graph is only reused while the versions for its range are unchanged
+VERSION_TABLE = "data_versions"
+
+# rows deleted or pages freed in each step of compact(), and the seconds to wait between them
+COMPACT_BATCH_SIZE = 5000
+COMPACT_BATCH_DELAY = 0.1
+
+# SQL aggregate for each supported aggregation in read_downsampled
+AGGREGATES = {"min": "MIN", "mean": "AVG", "max": "MAX", "sum": "TOTAL"}
+
 
 class StatTrackSQLiteDriver:
-    """An asynchronous SQLite driver, working with DataFrames. Tailored to StatTrack"""
+    """An asynchronous SQLite driver, working with DataFrames. Tailored to StatTrack
+
+    Connections are opened once with `connect` and kept until `close`. The database is in WAL
+    mode so the pool of read connections can run at the same time as writes, which all go
+    through a single connection on a dedicated thread.
+
+    If a ``cluster`` ID is given, the database at ``path`` can be shared by several processes
+    on the same machine, each with a different cluster ID. SQLite's file locks coordinate the
+    writes, and the ``stats`` table holds metrics combined across all clusters.
+    """
 
-    def __init__(self) -> None:
-        self.sql_path = str(cog_data_path(raw_name="StatTrack") / "timeseries.db")
+    def __init__(
+        self,
+        pool_size: int = READ_POOL_SIZE,
+        path: str | None = None,
+        cluster: str | None = None,
+    ) -> None:
+        self.sql_path = path or str(cog_data_path(raw_name="StatTrack") / "timeseries.db")
+        self.cluster = cluster
         self.sql_write_executor = ThreadPoolExecutor(1, "stattrack_sql_write")
 
+        self.pool_size = pool_size
+        self._pool: Optional[asyncio.Queue[aiosqlite.Connection]] = None
+        self._read_conns: List[aiosqlite.Connection] = []
+        self._write_conn: Optional[sqlite3.Connection] = None
+
     def storage_usage(self) -> int:
-        """Return the size of the database file in bytes."""
-        return os.path.getsize(self.sql_path)
+        """Return the size of the database file in bytes, including the write-ahead log."""
+        size = os.path.getsize(self.sql_path)
+        if os.path.exists(self.sql_path + "-wal"):
+            size += os.path.getsize(self.sql_path + "-wal")
+        return size
+
+    async def connect(self) -> None:
+        """Open the write connection and the pool of read connections. Safe to call if already
+        connected."""
+        if self._pool is not None:
+            return
+
+        def _connect() -> sqlite3.Connection:
+            # the write thread is long-lived but the executor could still swap it out
+            connection = sqlite3.connect(
+                self.sql_path, timeout=BUSY_TIMEOUT, check_same_thread=False
+            )
+            if self.cluster is not None:
+                # only has an effect on a new database, which skips the config migrations
+                connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            connection.execute("PRAGMA journal_mode=WAL")
+            # in WAL mode, NORMAL is still safe from corruption and only fsyncs on checkpoint
+            connection.execute("PRAGMA synchronous=NORMAL")
+            with connection:
+                _create_command_tables(connection)
+                _create_shard_tables(connection)
+                _create_version_table(connection)
+                if self.cluster is not None:
+                    _create_table(connection, [])
+                    _create_rollup_tables(connection)
+                    _create_cluster_table(connection)
+                    # there's nothing from this cluster before now, so earlier minutes aren't
+                    # held back for it
+                    _update_cluster(
+                        connection, self.cluster, to_epoch(datetime.datetime.utcnow()) - 60
+                    )
+            return connection
+
+        self._write_conn = await self._run_write(_connect)
 
-    async def get_last_index(self) -> pd.Timestamp:
+        pool: asyncio.Queue[aiosqlite.Connection] = asyncio.Queue()
+        for _ in range(self.pool_size):
+            conn = await aiosqlite.connect(self.sql_path, timeout=BUSY_TIMEOUT)
+            await conn.execute("PRAGMA query_only=ON")
+            self._read_conns.append(conn)
+            pool.put_nowait(conn)
+        self._pool = pool
+
+    async def close(self) -> None:
+        """Close all connections and shut down the write executor."""
+        self._pool = None
+        for conn in self._read_conns:
+            await conn.close()
+        self._read_conns = []
+
+        if self._write_conn is not None:
+            await self._run_write(self._write_conn.close)
+            self._write_conn = None
+
+        self.sql_write_executor.shutdown(wait=False)
+
+    @asynccontextmanager
+    async def _reader(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Borrow a read connection from the pool."""
+        if self._pool is None:
+            raise RuntimeError("The driver is not connected.")
+        pool = self._pool
+        conn = await pool.get()
+        try:
+            yield conn
+        finally:
+            pool.put_nowait(conn)
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """Open a write transaction. Must be used on the write thread.
+
+        ``BEGIN IMMEDIATE`` takes the write lock up front, so if the database is shared, other
+        processes wait for it instead of failing part way through."""
+        assert self._write_conn is not None
+        with self._write_conn:
+            self._write_conn.execute("BEGIN IMMEDIATE")
+            yield self._write_conn
+
+    async def _run_write(self, func: Callable[..., T], *args: Any) -> T:
+        """Run a function on the write thread."""
+        return await asyncio.get_event_loop().run_in_executor(self.sql_write_executor, func, *args)
+
+    def _written_until(self) -> str:
+        """SQL for the time of the newest row this process has written, so samples that have
+        been written since they were read from the buffer aren't counted twice."""
+        if self.cluster is None:
+            return f"(SELECT IFNULL(MAX(time), -1) FROM {TABLE})"
+        return (
+            f"IFNULL((SELECT time FROM {CLUSTER_TABLE} WHERE cluster = {_literal(self.cluster)} "
+            "ORDER BY time DESC LIMIT 1), -1)"
+        )
+
+    async def get_shards(self, metric: str) -> List[int]:
+        """Get the IDs of the shards that have data stored for a metric.
+
+        Parameters
+        ----------
+        metric : str
+            The per-shard metric, for example ``ping``.
+
+        Returns
+        -------
+        List[int]
+            Sorted shard IDs.
+        """
+        query = f"SELECT shard FROM {SHARD_SERIES} WHERE metric = ? ORDER BY shard"
+        async with self._reader() as conn:
+            async with conn.execute(query, (metric,)) as cursor:
+                rows = await cursor.fetchall()
+        return [row[0] for row in rows]
+
+    async def get_last_index(self, own: bool = False) -> pd.Timestamp:
         """Get the latest index from the database.
 
+        Parameters
+        ----------
+        own : bool, optional
+            If the database is shared, only look at data written by this cluster. By default
+            False.
+
         Returns
         -------
         pd.Timestamp
         """
-        query = 'SELECT "index" FROM main_df ORDER BY "index" DESC LIMIT 1'
-        async with aiosqlite.connect(self.sql_path) as conn:
-            async with conn.execute(query) as cursor:
-                index = await cursor.fetchone()
-        if index is None:
+        if own and self.cluster is not None:
+            query = f"SELECT MAX(time) FROM {CLUSTER_TABLE} WHERE cluster = ?"
+            params: Tuple[Any, ...] = (self.cluster,)
+        else:
+            query = f"SELECT MAX(time) FROM {TABLE}"
+            params = ()
+        async with self._reader() as conn:
+            async with conn.execute(query, params) as cursor:
+                row = await cursor.fetchone()
+        if row is None or row[0] is None:
             return pd.Timestamp(0)
-        return pd.to_datetime(index[0])
+        return pd.Timestamp(row[0], unit="s")
+
+    async def get_data_version(
+        self, delta: datetime.timedelta | None = None, end: datetime.datetime | None = None
+    ) -> int:
+        """Get a number that changes whenever data in a timeframe is written, including by
+        other clusters and for minutes that were already stored.
+
+        Parameters
+        ----------
+        delta : datetime.timedelta, optional
+            Timeframe for data, see `read_partial`.
+
+        end : datetime.datetime, optional
+            Naive UTC upper bound for data, see `read_partial`.
 
-    async def read_all(self) -> pd.DataFrame:
+        Returns
+        -------
+        int
+        """
+        where, params = _time_range(delta, end, 86400)
+        async with self._reader() as conn:
+            async with conn.execute(
+                f"SELECT TOTAL(version) FROM {VERSION_TABLE}{where}", params
+            ) as cursor:
+                row = await cursor.fetchone()
+        return int(row[0])
+
+    async def get_first_index(self, raw: bool = False) -> pd.Timestamp | None:
+        """Get the earliest index from the database.
+
+        Parameters
+        ----------
+        raw : bool, optional
+            Only look at the raw minute data, not the rollups. By default False.
+
+        Returns
+        -------
+        pd.Timestamp, optional
+            None if there is no data.
+        """
+        tables = [TABLE] if raw else [TABLE, *ROLLUPS.values()]
+        query = (
+            "SELECT MIN(t) FROM ("
+            + " UNION ALL ".join(f"SELECT MIN(time) AS t FROM {table}" for table in tables)
+            + ")"
+        )
+        async with self._reader() as conn:
+            async with conn.execute(query) as cursor:
+                row = await cursor.fetchone()
+        if row is None or row[0] is None:
+            return None
+        return pd.Timestamp(row[0], unit="s")
+
+    async def read_all(self, pending: Pending = ()) -> pd.DataFrame:
         """Create a Pandas DataFrame from the whole table.
 
+        Times before the first minute of data, for example after it has been deleted by
+        `compact`, are filled in with the hourly or daily mean of each metric from the rollups.
+
+        Parameters
+        ----------
+        pending : Sequence[Tuple[datetime.datetime, Dict[str, float]]], optional
+            Samples not written yet, to add to the end. Ignored if the database is shared, as
+            the stats table holds the whole fleet.
+
         Returns
         -------
         pd.DataFrame
         """
-        query = "SELECT * FROM main_df"
-        async with aiosqlite.connect(self.sql_path) as conn:
-            async with conn.execute("PRAGMA table_info(main_df)") as cursor:
-                columns = [row[1] for row in await cursor.fetchall()]
+        query = f"SELECT * FROM {TABLE} ORDER BY time"
+        async with self._reader() as conn:
             async with conn.execute(query) as cursor:
+                columns = [col[0] for col in cursor.description]
                 data = await cursor.fetchall()
-        df = pd.DataFrame(data, columns=columns)
-        df.set_index("index", inplace=True)
-        df.index = pd.to_datetime(df.index, infer_datetime_format=True)
-        return df
+            history = await _read_history(conn, columns[1:])
+        df = _to_frame(data, columns)
+        if len(history):
+            df = pd.concat([history, df]) if len(df) else history
+        return self._add_pending(df, pending, data[-1][0] if data else -1)
+
+    async def read_chunks(
+        self, chunk_size: int = CHUNK_SIZE, pending: Pending = ()
+    ) -> AsyncIterator[pd.DataFrame]:
+        """Read the whole table in time order, one DataFrame of up to ``chunk_size`` rows at a
+        time. A read connection is only held while each chunk is fetched.
+
+        Every chunk has the columns the table had when reading started. Like `read_all`, the
+        rollups fill in times before the first minute, as the first chunk.
+
+        Parameters
+        ----------
+        chunk_size : int, optional
+            Maximum rows per chunk, by default 50,000.
+        pending : Sequence[Tuple[datetime.datetime, Dict[str, float]]], optional
+            Samples not written yet, yielded last. See `read_all`.
+
+        Yields
+        ------
+        pd.DataFrame
+        """
+        async with self._reader() as conn:
+            async with conn.execute(f"SELECT * FROM {TABLE} LIMIT 0") as cursor:
+                metrics = [col[0] for col in cursor.description][1:]
+            history = await _read_history(conn, metrics)
+        if len(history):
+            yield history
+
+        query = f"SELECT * FROM {TABLE} WHERE time > ? ORDER BY time LIMIT ?"
+        last = -1
+        while True:
+            async with self._reader() as conn:
+                async with conn.execute(query, (last, chunk_size)) as cursor:
+                    columns = [col[0] for col in cursor.description]
+                    data = await cursor.fetchall()
+            if not data:
+                break
+            yield _to_frame(data, columns).reindex(columns=metrics)
+            last = data[-1][0]
+        df = self._add_pending(_to_frame([], ["time"]), pending, last)
+        if len(df):
+            yield df.reindex(columns=metrics)
+
+    def _add_pending(self, df: pd.DataFrame, pending: Pending, last: int) -> pd.DataFrame:
+        """Add samples after the epoch second ``last`` to the end of a DataFrame from the stats
+        table."""
+        if self.cluster is not None:
+            return df
+        rows = [
+            (time, {k: v for k, v in data.items() if not SHARD_METRIC.match(k)})
+            for time, data in pending
+            if to_epoch(time) > last
+        ]
+        if not rows:
+            return df
+        extra = pd.DataFrame(
+            [data for _, data in rows], index=pd.DatetimeIndex([time for time, _ in rows])
+        )
+        extra.index.name = "index"
+        return pd.concat([df, extra]) if len(df) else extra
 
     async def read_partial(
-        self, metrics: Iterable[str], delta: datetime.timedelta | None = None
+        self,
+        metrics: Iterable[str],
+        delta: datetime.timedelta | None = None,
+        end: datetime.datetime | None = None,
     ) -> pd.DataFrame:
         """Build a SELECT query and execute it, creating a Pandas DataFrame.
 
+        The range is filtered on the indexed ``time`` column, so only the rows in the range are
+        read.
+
         Parameters
         ----------
         metrics : Iterable[str]
             The metric(s) to query
 
         delta : datetime.timedelta, optional
-            Timeframe for data: from now to `delta` ago
+            Timeframe for data: from `end` (or now) to `delta` before that.
             If not given, data returned will be all-time.
 
+        end : datetime.datetime, optional
+            Naive UTC upper bound (inclusive) for data. If not given, there is no upper bound.
+
         Returns
         -------
         pd.DataFrame
         """
-        query = f"""
-        SELECT "index",{",".join(metrics)}
-        FROM main_df
+        metrics = list(metrics)
+        where, params = _time_range(delta, end)
+        query = f"SELECT time,{','.join(map(_quote, metrics))} FROM {TABLE}{where} ORDER BY time"
+
+        async with self._reader() as conn:
+            async with conn.execute(query, params) as cursor:
+                data = await cursor.fetchall()
+        return _to_frame(data, ["time"] + metrics)
+
+    async def read_downsampled(
+        self,
+        metrics: Iterable[str],
+        bucket: datetime.timedelta,
+        delta: datetime.timedelta | None = None,
+        end: datetime.datetime | None = None,
+        aggregates: Iterable[str] = ("min", "mean", "max"),
+        pending: Pending = (),
+    ) -> pd.DataFrame:
+        """Read data aggregated into fixed-size time buckets. The aggregation is done by SQLite,
+        so at most one row per bucket is ever loaded, however much history there is.
+
+        Buckets are aligned to multiples of ``bucket`` since the epoch and indexed by their start.
+        Empty buckets are not returned. If ``bucket`` is a whole number of hours or days, the
+        coarsest rollup table that fits is read instead of the raw minute data. Use
+        `resolve_bucket` to get a bucket size that can be served for a timeframe.
+
+        Parameters
+        ----------
+        metrics : Iterable[str]
+            The metric(s) to query
+
+        bucket : datetime.timedelta
+            Size of each bucket. Must be at least one second.
+
+        delta : datetime.timedelta, optional
+            Timeframe for data, see `read_partial`.
+
+        end : datetime.datetime, optional
+            Naive UTC upper bound (inclusive) for data, see `read_partial`.
+
+        aggregates : Iterable[str], optional
+            Aggregations to compute for each metric, from ``min``, ``mean``, ``max`` and ``sum``.
+            Defaults to min, mean and max.
+
+        pending : Sequence[Tuple[datetime.datetime, Dict[str, float]]], optional
+            Samples not written yet, to include as if they were. Ignored if the database is
+            shared, as the stats table holds the whole fleet.
+
+        Returns
+        -------
+        pd.DataFrame
+            Columns are a MultiIndex of (metric, aggregate).
         """
-        if delta:
-            start_timestamp = (datetime.datetime.now() - delta).strftime("%Y-%m-%d %H:%M:%S")
-            query += f'\nWHERE "index" >= "{start_timestamp}"'
-        async with aiosqlite.connect(self.sql_path) as conn:
+        metrics = list(metrics)
+        aggregates = _check_aggregates(aggregates)
+        bucket_seconds = _bucket_seconds(bucket)
+        if self.cluster is not None:
+            pending = ()
+
+        columns = [(metric, agg) for metric in metrics for agg in aggregates]
+        resolution = max((res for res in ROLLUPS if bucket_seconds % res == 0), default=None)
+        if resolution is None:
+            async with self._reader() as conn:
+                async with conn.execute(f"PRAGMA table_info({TABLE})") as cursor:
+                    stored = {row[1] for row in await cursor.fetchall()}
+                # metrics only in the buffer, or not recorded at all yet, are NULL
+                source = _with_pending(
+                    TABLE,
+                    ["time", *metrics],
+                    [[to_epoch(time), *map(data.get, metrics)] for time, data in pending],
+                    self._written_until(),
+                    stored,
+                )
+                selects = "".join(
+                    f",{AGGREGATES[agg]}({_quote(metric)})" for metric, agg in columns
+                )
+                where, params = _time_range(delta, end)
+                # integer division, so this is the start of the bucket
+                query = (
+                    f"SELECT (time / {bucket_seconds}) * {bucket_seconds} AS bucket{selects} "
+                    f"FROM {source}{where} GROUP BY bucket ORDER BY bucket"
+                )
+                async with conn.execute(query, params) as cursor:
+                    data = await cursor.fetchall()
+        else:
+            data = await self._read_rollup(
+                resolution, metrics, aggregates, bucket_seconds, delta, end, pending
+            )
+        return _to_agg_frame([row[0] for row in data], [row[1:] for row in data], columns)
+
+    async def _read_rollup(
+        self,
+        resolution: int,
+        metrics: List[str],
+        aggregates: List[str],
+        bucket_seconds: int,
+        delta: datetime.timedelta | None,
+        end: datetime.datetime | None,
+        pending: Pending,
+    ) -> List[Any]:
+        """Read buckets from a rollup table, in the same row layout as the raw query in
+        `read_downsampled`."""
+        rows = []
+        for time, data in pending:
+            for metric in metrics:
+                value = data.get(metric)
+                if value is not None:
+                    rows.append([metric, to_epoch(time), value, value, value, 1])
+        source = _with_pending(
+            ROLLUPS[resolution],
+            ["metric", "time", "min", "max", "sum", "count"],
+            rows,
+            self._written_until(),
+        )
+        where, params = _time_range(delta, end, resolution)
+        where = (where + " AND" if where else " WHERE") + (
+            f" metric IN ({','.join('?' * len(metrics))})"
+        )
+        query = (
+            f"SELECT (time / {bucket_seconds}) * {bucket_seconds} AS bucket, metric, "
+            f"MIN(min), TOTAL(sum) / SUM(count), MAX(max), TOTAL(sum) FROM {source}"
+            f"{where} GROUP BY bucket, metric ORDER BY bucket"
+        )
+        async with self._reader() as conn:
+            async with conn.execute(query, params + metrics) as cursor:
+                rows = await cursor.fetchall()
+
+        # pivot from one row per metric to one row per bucket
+        buckets: Dict[int, Dict[str, Dict[str, Any]]] = {}
+        for bucket, metric, *values in rows:
+            buckets.setdefault(bucket, {})[metric] = dict(
+                zip(("min", "mean", "max", "sum"), values)
+            )
+        return [
+            [bucket]
+            + [by_metric.get(metric, {}).get(agg) for metric in metrics for agg in aggregates]
+            for bucket, by_metric in buckets.items()
+        ]
+
+    async def read_shards_downsampled(
+        self,
+        metric: str,
+        bucket: datetime.timedelta,
+        delta: datetime.timedelta | None = None,
+        end: datetime.datetime | None = None,
+        shards: Iterable[int] = (),
+        aggregates: Iterable[str] = ("min", "mean", "max"),
+        pending: Pending = (),
+    ) -> pd.DataFrame:
+        """Read a metric for some shards, aggregated into time buckets like `read_downsampled`.
+
+        Parameters
+        ----------
+        metric : str
+            The per-shard metric, for example ``ping``.
+
+        bucket : datetime.timedelta
+            Size of each bucket, see `read_downsampled`.
+
+        delta : datetime.timedelta, optional
+            Timeframe for data, see `read_partial`.
+
+        end : datetime.datetime, optional
+            Naive UTC upper bound (inclusive) for data, see `read_partial`.
+
+        shards : Iterable[int]
+            IDs of the shards to read.
+
+        aggregates : Iterable[str], optional
+            Aggregations to compute for each shard, see `read_downsampled`.
+
+        pending : Sequence[Tuple[datetime.datetime, Dict[str, float]]], optional
+            Samples not written yet, to include as if they were.
+
+        Returns
+        -------
+        pd.DataFrame
+            Columns are a MultiIndex of (shard metric, aggregate), where the shard metric is
+            named like ``shard0_ping``.
+        """
+        shards = list(shards)
+        aggregates = _check_aggregates(aggregates)
+        filter_ = f"metric = ? AND shard IN ({','.join('?' * len(shards))})"
+        query, params = _shard_buckets(
+            bucket,
+            delta,
+            end,
+            filter_,
+            [metric, *shards],
+            _pending_shards(pending, metric),
+            self._written_until(),
+        )
+        async with self._reader() as conn:
+            async with conn.execute(query + " ORDER BY bucket", params) as cursor:
+                rows = await cursor.fetchall()
+
+        # pivot from one row per shard to one row per bucket
+        buckets: Dict[int, Dict[int, Dict[str, Any]]] = {}
+        for bucket_start, shard, *values in rows:
+            buckets.setdefault(bucket_start, {})[shard] = dict(
+                zip(("min", "mean", "max", "sum"), values)
+            )
+        data = [
+            [by_shard.get(shard, {}).get(agg) for shard in shards for agg in aggregates]
+            for by_shard in buckets.values()
+        ]
+        columns = [(shard_metric(shard, metric), agg) for shard in shards for agg in aggregates]
+        return _to_agg_frame(list(buckets), data, columns)
+
+    async def read_shards_combined(
+        self,
+        metric: str,
+        bucket: datetime.timedelta,
+        delta: datetime.timedelta | None = None,
+        end: datetime.datetime | None = None,
+        aggregates: Iterable[str] = ("min", "mean", "max"),
+        pending: Pending = (),
+    ) -> pd.DataFrame:
+        """Read the highest, average and lowest shard for a metric, in time buckets like
+        `read_downsampled`. Each shard's mean in a bucket is worked out first, then combined
+        across every shard by SQLite, so any number of shards can be read.
+
+        Parameters
+        ----------
+        metric : str
+            The per-shard metric, for example ``ping``.
+
+        bucket : datetime.timedelta
+            Size of each bucket, see `read_downsampled`.
+
+        delta : datetime.timedelta, optional
+            Timeframe for data, see `read_partial`.
+
+        end : datetime.datetime, optional
+            Naive UTC upper bound (inclusive) for data, see `read_partial`.
+
+        aggregates : Iterable[str], optional
+            Aggregations to fill in, see `read_downsampled`. They all have the same value.
+
+        pending : Sequence[Tuple[datetime.datetime, Dict[str, float]]], optional
+            Samples not written yet, to include as if they were.
+
+        Returns
+        -------
+        pd.DataFrame
+            Columns are a MultiIndex of (name, aggregate), where the name is ``shards_max``,
+            ``shards_mean`` or ``shards_min``.
+        """
+        aggregates = _check_aggregates(aggregates)
+        filter_ = f"metric = ? AND shard IN (SELECT shard FROM {SHARD_SERIES} WHERE metric = ?)"
+        query, params = _shard_buckets(
+            bucket,
+            delta,
+            end,
+            filter_,
+            [metric, metric],
+            _pending_shards(pending, metric),
+            self._written_until(),
+        )
+        query = (
+            f"SELECT bucket, MAX(mean), AVG(mean), MIN(mean) FROM ({query}) "
+            "GROUP BY bucket ORDER BY bucket"
+        )
+        async with self._reader() as conn:
+            async with conn.execute(query, params) as cursor:
+                rows = await cursor.fetchall()
+
+        names = ["shards_max", "shards_mean", "shards_min"]
+        data = [[value for value in row[1:] for _ in aggregates] for row in rows]
+        columns = [(name, agg) for name in names for agg in aggregates]
+        return _to_agg_frame([row[0] for row in rows], data, columns)
+
+    async def resolve_bucket(
+        self,
+        bucket: datetime.timedelta,
+        delta: datetime.timedelta | None = None,
+        end: datetime.datetime | None = None,
+    ) -> datetime.timedelta:
+        """Round a bucket size up to the coarsest resolution that can serve it.
+
+        Buckets of at least a day or an hour are rounded up to a whole number of days or hours,
+        so they are read from a rollup table. Smaller buckets are kept as they are. If the
+        timeframe goes back further than the data kept at that resolution, the bucket is rounded
+        up to the next resolution that does go back far enough. If none do, for example soon
+        after the cog is installed, the finest resolution with the most history is used.
+
+        Parameters
+        ----------
+        bucket : datetime.timedelta
+            The wanted bucket size.
+
+        delta : datetime.timedelta, optional
+            Timeframe for data, see `read_partial`.
+
+        end : datetime.datetime, optional
+            Naive UTC upper bound for data, see `read_partial`.
+
+        Returns
+        -------
+        datetime.timedelta
+        """
+        seconds = int(bucket.total_seconds())
+        resolutions = [res for res in TABLES if res <= seconds] or [min(TABLES)]
+        candidates = [res for res in sorted(TABLES) if res >= max(resolutions)]
+
+        query = " UNION ALL ".join(f"SELECT MIN(time) FROM {TABLES[res]}" for res in candidates)
+        async with self._reader() as conn:
             async with conn.execute(query) as cursor:
-                data = await cursor.fetchall()
-        df = pd.DataFrame(data, columns=["index"] + list(metrics))
-        df.set_index("index", inplace=True)
-        df.index = pd.to_datetime(df.index, infer_datetime_format=True)
-        return df
+                firsts = [row[0] for row in await cursor.fetchall()]
+        if all(first is None for first in firsts):
+            return bucket
+
+        start = to_epoch((end or datetime.datetime.utcnow()) - delta) if delta else 0
+        available = [(res, first) for res, first in zip(candidates, firsts) if first is not None]
+        # the finest resolution that goes back far enough. if it doesn't, a coarser one is only
+        # used if it has more history. a rollup's first bucket starts before the first row it
+        # summarises, so that has to be a whole bucket of it before the finer data starts
+        resolution, first = available[0]
+        for other, other_first in available[1:]:
+            if first <= start:
+                break
+            if other_first < first // other * other:
+                resolution, first = other, other_first
+        if resolution == min(TABLES):
+            return bucket
+        return datetime.timedelta(seconds=-(-seconds // resolution) * resolution)
+
+    async def update_rollups(
+        self, start: datetime.datetime, end: datetime.datetime | None = None
+    ) -> None:
+        """Recalculate the rollups for the hours and days from ``start`` to ``end``, from the
+        raw data.
+
+        Parameters
+        ----------
+        start : datetime.datetime
+            Naive UTC time of the oldest new raw data.
+        end : datetime.datetime, optional
+            Naive UTC time of the newest new raw data. Defaults to ``start``.
+        """
+        lo = to_epoch(start)
+        hi = to_epoch(end or start) + 1
+
+        def _update():
+            with self._transaction() as conn:
+                _rollup(conn, lo, hi)
+
+        await self._run_write(_update)
+
+    async def compact(
+        self, cutoffs: Dict[int, datetime.datetime], batch_size: int = COMPACT_BATCH_SIZE
+    ) -> Tuple[int, int]:
+        """Delete expired data and give the space back to the filesystem.
+
+        This is done in small batches, each a separate job on the write thread, so other writes
+        can run between them.
+
+        Parameters
+        ----------
+        cutoffs : Dict[int, datetime.datetime]
+            Resolution in seconds (see `TABLES`) to the naive UTC time to delete data before. This
+            should be at the start of a day, so the data that is kept always covers whole
+            rollup buckets. Resolutions not given are kept forever.
+        batch_size : int, optional
+            Rows to delete, or pages to free, per batch. By default 5,000.
+
+        Returns
+        -------
+        Tuple[int, int]
+            Rows deleted, and pages freed.
+        """
+
+        def _delete(table: str, epoch: int) -> int:
+            # WITHOUT ROWID tables are deleted by primary key
+            key = {TABLE: "time", CLUSTER_TABLE: "time, cluster"}.get(table, "metric, time")
+            if table in COMMAND_TABLES.values():
+                key = "time, command"
+            where = "time < ?"
+            if table in SHARD_TABLES.values():
+                key = "metric, shard, time"
+                where = f"{ALL_SERIES} AND {where}"
+            with self._transaction() as conn:
+                return conn.execute(
+                    f"DELETE FROM {table} WHERE ({key}) IN "
+                    f"(SELECT {key} FROM {table} WHERE {where} LIMIT ?)",
+                    (epoch, batch_size),
+                ).rowcount
+
+        def _vacuum() -> int:
+            assert self._write_conn is not None
+            before = self._write_conn.execute("PRAGMA freelist_count").fetchone()[0]
+            # execute() only steps the pragma once, freeing one page. executescript() runs it all
+            self._write_conn.executescript(f"PRAGMA incremental_vacuum({int(batch_size)});")
+            return before - self._write_conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+        def _checkpoint() -> None:
+            assert self._write_conn is not None
+            # move the freed pages out of the WAL so the database file actually shrinks
+            self._write_conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+        tables = [
+            (table, to_epoch(before))
+            for resolution, before in cutoffs.items()
+            for table in (
+                TABLES[resolution],
+                SHARD_TABLES[resolution],
+                COMMAND_TABLES.get(resolution),
+            )
+            if table is not None
+        ]
+        if self.cluster is not None and min(TABLES) in cutoffs:
+            # each cluster's minute data, which the stats table is made from
+            tables.append((CLUSTER_TABLE, to_epoch(cutoffs[min(TABLES)])))
+
+        deleted = 0
+        for table, epoch in tables:
+            while True:
+                count = await self._run_write(_delete, table, epoch)
+                deleted += count
+                if count < batch_size:
+                    break
+                await asyncio.sleep(COMPACT_BATCH_DELAY)
+
+        freed = 0
+        while True:
+            count = await self._run_write(_vacuum)
+            freed += count
+            if count < batch_size:
+                break
+            await asyncio.sleep(COMPACT_BATCH_DELAY)
+
+        if freed:
+            await self._run_write(_checkpoint)
+
+        return deleted, freed
+
+    async def enable_incremental_vacuum(self) -> None:
+        """Switch the database to incremental auto-vacuum, so `compact` can free space without
+        rewriting the whole file. This rewrites the whole file once."""
+
+        def _enable():
+            assert self._write_conn is not None
+            self._write_conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            self._write_conn.execute("VACUUM")  # needed for the change to take effect
+
+        await self._run_write(_enable)
 
     async def write(self, df: pd.DataFrame) -> None:
         """Write a DataFrame to the database. This is a write operation, so it will **replace**
@@ -98,21 +898,25 @@ class StatTrackSQLiteDriver:
         df : pd.DataFrame
             DataFrame to write
         """
-        # yes im crazy mixing aiosqlite and sqlite3 :aha:
-        # writes do block all other operations on the database
+        # writes only ever happen on the write thread, so they don't block the readers
         def _write():
-            connection = sqlite3.connect(self.sql_path)
-            try:
-                df.to_sql("main_df", con=connection, if_exists="replace")
-                connection.commit()
-            finally:
-                connection.close()
+            with self._transaction() as conn:
+                conn.execute(f"DROP TABLE IF EXISTS {TABLE}")
+                _create_table(conn, [c for c in df.columns if not SHARD_METRIC.match(c)])
+                _insert(conn, df)
+                if len(df):
+                    times = pd.DatetimeIndex(df.index)
+                    _rollup(conn, to_epoch(times.min()), to_epoch(times.max()) + 1)
+                    _bump_versions(conn, to_epoch(times.min()), to_epoch(times.max()))
 
-        await asyncio.get_event_loop().run_in_executor(self.sql_write_executor, _write)
+        await self._run_write(_write)
 
     async def append(self, df: pd.DataFrame) -> None:
         """Append a DataFrame to the database.
 
+        Any columns that are not in the database yet are added first, without touching existing
+        rows.
+
         Parameters
         ----------
         df : pd.DataFrame
@@ -120,11 +924,678 @@ class StatTrackSQLiteDriver:
         """
         # see comments above in write()
         def _append():
-            connection = sqlite3.connect(self.sql_path)
-            try:
-                df.to_sql("main_df", con=connection, if_exists="append")
-                connection.commit()
-            finally:
-                connection.close()
-
-        await asyncio.get_event_loop().run_in_executor(self.sql_write_executor, _append)
+            with self._transaction() as conn:
+                _add_columns(conn, [c for c in df.columns if not SHARD_METRIC.match(c)])
+                _insert(conn, df)
+                if len(df):
+                    times = pd.DatetimeIndex(df.index)
+                    _bump_versions(conn, to_epoch(times.min()), to_epoch(times.max()))
+
+        await self._run_write(_append)
+
+    async def append_rows(
+        self, rows: Iterable[Tuple[datetime.datetime, Dict[str, float]]]
+    ) -> None:
+        """Append rows of metrics to the database, without going through pandas.
+
+        Any columns that are not in the database yet are added first, and metrics missing from a
+        row are NULL. Per-shard metrics, named like ``shard0_ping``, go in the shard table.
+
+        If the database is shared, the rows are stored for this cluster. The stats table is then
+        recalculated from every cluster for those times, up to the last minute that every
+        running cluster has written. Later minutes are added when the other clusters catch up.
+
+        Parameters
+        ----------
+        rows : Iterable[Tuple[datetime.datetime, Dict[str, float]]]
+            Naive UTC time and the metrics for that time.
+        """
+        rows = list(rows)
+        if not rows:
+            return
+        columns = list(dict.fromkeys(name for _, data in rows for name in data))
+        times = [to_epoch(time) for time, _ in rows]
+        values = [[data.get(name) for name in columns] for _, data in rows]
+        columns, values, shard_rows = _split_shards(columns, times, values)
+
+        def _append():
+            with self._transaction() as conn:
+                # shards don't overlap between clusters, so these are never combined
+                _insert_shard_rows(conn, shard_rows)
+                _add_columns(conn, columns)
+                if self.cluster is None:
+                    _insert_rows(conn, columns, times, values)
+                    _bump_versions(conn, min(times), max(times))
+                    return
+                _add_columns(conn, columns, CLUSTER_TABLE)
+                _insert_rows(
+                    conn,
+                    ["cluster"] + columns,
+                    times,
+                    [[self.cluster] + row for row in values],
+                    CLUSTER_TABLE,
+                )
+                _update_cluster(conn, self.cluster, max(times))
+                start, end = _complete_range(conn, min(times))
+                if start <= end:
+                    _combine_clusters(conn, start, end)
+                    _bump_versions(conn, start, end)
+
+        await self._run_write(_append)
+
+    async def append_command_stats(
+        self, time: datetime.datetime, stats: Dict[str, Sequence[float]]
+    ) -> None:
+        """Add command stats for a minute, from `CommandTimings.pop`. If a command already has
+        stats for that minute, they are added together. The hourly sums are updated too.
+
+        Parameters
+        ----------
+        time : datetime.datetime
+            Naive UTC time of the minute.
+        stats : Dict[str, Sequence[float]]
+            Qualified command name to count, errors, total milliseconds and histogram buckets.
+        """
+        epoch = to_epoch(time)
+        columns = COMMAND_COLUMNS + _bucket_columns()
+        query = (
+            f"INSERT INTO {COMMAND_TABLE} (time, command, {', '.join(columns)}) "
+            f"VALUES (?, ?{', ?' * len(columns)}) ON CONFLICT (time, command) DO UPDATE SET "
+            + ", ".join(f"{c} = {c} + excluded.{c}" for c in columns)
+        )
+
+        def _append():
+            with self._transaction() as conn:
+                conn.executemany(
+                    query, ([epoch, command, *values] for command, values in stats.items())
+                )
+                _rollup_commands(conn, epoch, epoch + 1)
+                _bump_versions(conn, epoch, epoch)
+
+        await self._run_write(_append)
+
+    async def read_command_histograms(
+        self,
+        bucket: datetime.timedelta,
+        delta: datetime.timedelta | None = None,
+        end: datetime.datetime | None = None,
+        command: str | None = None,
+        pending: PendingCommands = (),
+    ) -> pd.DataFrame:
+        """Read command stats summed into fixed-size time buckets, like `read_downsampled`.
+
+        If ``bucket`` is a whole number of hours, the hourly sums are read instead of the minute
+        rows, so they still work after the minute rows are pruned.
+
+        Parameters
+        ----------
+        bucket : datetime.timedelta
+            Size of each bucket. Must be at least one second.
+        delta : datetime.timedelta, optional
+            Timeframe for data, see `read_partial`.
+        end : datetime.datetime, optional
+            Naive UTC upper bound (inclusive) for data, see `read_partial`.
+        command : str, optional
+            Qualified name of a command to read. By default, all commands are added together.
+        pending : Sequence[Tuple[datetime.datetime, Dict[str, Sequence[float]]]], optional
+            Command stats not written yet, to include as if they were.
+
+        Returns
+        -------
+        pd.DataFrame
+            Columns are ``count``, ``errors``, ``total_ms`` then ``b0``, ``b1``... for each
+            histogram bucket.
+        """
+        bucket_seconds = _bucket_seconds(bucket)
+        resolution = max(
+            (res for res in COMMAND_TABLES if bucket_seconds % res == 0),
+            default=min(COMMAND_TABLES),
+        )
+        columns = COMMAND_COLUMNS + _bucket_columns()
+        where, params = _time_range(delta, end, resolution)
+        if command is not None:
+            where += (" AND" if where else " WHERE") + " command = ?"
+            params.append(command)  # type:ignore
+        query = (
+            f"SELECT (time / {bucket_seconds}) * {bucket_seconds} AS bucket"
+            + "".join(f", TOTAL({c})" for c in columns)
+            + f" FROM {_with_pending_commands(COMMAND_TABLES[resolution], pending)}{where} "
+            "GROUP BY bucket ORDER BY bucket"
+        )
+        async with self._reader() as conn:
+            async with conn.execute(query, params) as cursor:
+                data = await cursor.fetchall()
+        return _to_frame(list(data), ["time"] + columns)
+
+    async def read_command_totals(
+        self,
+        delta: datetime.timedelta | None = None,
+        end: datetime.datetime | None = None,
+        pending: PendingCommands = (),
+    ) -> pd.DataFrame:
+        """Read command stats summed for each command over a timeframe.
+
+        If the timeframe starts before the oldest minute rows, the hourly sums are read instead,
+        so the start is rounded down to the hour.
+
+        Parameters
+        ----------
+        delta : datetime.timedelta, optional
+            Timeframe for data, see `read_partial`.
+        end : datetime.datetime, optional
+            Naive UTC upper bound (inclusive) for data, see `read_partial`.
+        pending : Sequence[Tuple[datetime.datetime, Dict[str, Sequence[float]]]], optional
+            Command stats not written yet, to include as if they were.
+
+        Returns
+        -------
+        pd.DataFrame
+            Indexed by qualified command name, most used first. Columns are as in
+            `read_command_histograms`.
+        """
+        columns = COMMAND_COLUMNS + _bucket_columns()
+        async with self._reader() as conn:
+            async with conn.execute(f"SELECT MIN(time) FROM {COMMAND_TABLE}") as cursor:
+                first = (await cursor.fetchone())[0]
+            start = to_epoch((end or datetime.datetime.utcnow()) - delta) if delta else 0
+            resolution = 60 if first is not None and first <= start else 3600
+
+            where, params = _time_range(delta, end, resolution)
+            query = (
+                "SELECT command"
+                + "".join(f", TOTAL({c})" for c in columns)
+                + f" FROM {_with_pending_commands(COMMAND_TABLES[resolution], pending)}{where} "
+                "GROUP BY command ORDER BY TOTAL(count) DESC"
+            )
+            async with conn.execute(query, params) as cursor:
+                data = await cursor.fetchall()
+        return pd.DataFrame(list(data), columns=["command"] + columns).set_index("command")
+
+    async def migrate_command_rollups(self) -> None:
+        """Fill the hourly command stats from all existing minute rows."""
+
+        def _migrate():
+            with self._transaction() as conn:
+                _rollup_commands(conn, 0, 2**62)
+
+        await self._run_write(_migrate)
+
+    async def migrate_to_epoch(self) -> None:
+        """Move data from the old ``main_df`` table, which used text timestamps and had no usable
+        index, to the ``stats`` table keyed by epoch seconds. Does nothing for new installs."""
+
+        def _migrate():
+            assert self._write_conn is not None
+            conn = self._write_conn
+            old = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'main_df'").fetchone()
+            if old is None:
+                with conn:
+                    _create_table(conn, [])
+                return
+
+            columns = [
+                row[1]
+                for row in conn.execute("PRAGMA table_info(main_df)").fetchall()
+                if row[1] != "index"
+            ]
+            quoted = ",".join(map(_quote, columns))
+            with conn:
+                conn.execute(f"DROP TABLE IF EXISTS {TABLE}")
+                _create_table(conn, columns)
+                conn.execute(
+                    f"INSERT OR REPLACE INTO {TABLE} (time{',' if columns else ''}{quoted}) "
+                    "SELECT CAST(strftime('%s', \"index\") AS INTEGER) AS epoch"
+                    f"{',' if columns else ''}{quoted} FROM main_df "
+                    "WHERE epoch IS NOT NULL ORDER BY epoch"
+                )
+                conn.execute("DROP TABLE main_df")
+            conn.execute("VACUUM")  # the old table was the whole database, so reclaim it
+
+        await self._run_write(_migrate)
+
+    async def migrate_to_rollups(self) -> None:
+        """Create the rollup tables and fill them from all existing raw data."""
+
+        def _migrate():
+            assert self._write_conn is not None
+            with self._write_conn:
+                _rollup(self._write_conn, 0, 2**62)
+
+        await self._run_write(_migrate)
+
+
+def to_epoch(dt: datetime.datetime) -> int:
+    """Convert a naive UTC datetime to epoch seconds."""
+    return calendar.timegm(dt.utctimetuple())
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _time_range(
+    delta: datetime.timedelta | None, end: datetime.datetime | None, resolution: int = 1
+) -> tuple[str, list[int]]:
+    """Build a WHERE clause (or an empty string) and its parameters for a time range. The start
+    is rounded down to the resolution, to include the bucket it falls in."""
+    clauses = []
+    params = []
+    if delta:
+        start = (end or datetime.datetime.utcnow()) - delta
+        clauses.append("time >= ?")
+        params.append(to_epoch(start) // resolution * resolution)
+    if end:
+        clauses.append("time <= ?")
+        params.append(to_epoch(end))
+    if not clauses:
+        return "", params
+    return " WHERE " + " AND ".join(clauses), params
+
+
+def _literal(value: Any) -> str:
+    if value is None:
+        return "NULL"
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    if isinstance(value, (bool, int)):
+        return str(int(value))
+    value = float(value)
+    return repr(value) if math.isfinite(value) else "NULL"
+
+
+def _with_pending(
+    table: str,
+    columns: List[str],
+    rows: Sequence[Sequence[Any]],
+    after: str,
+    stored: Collection[str] | None = None,
+) -> str:
+    """Build a subquery of ``columns`` from ``table``, with rows that haven't been written yet
+    added if their ``time`` is after the SQL expression ``after``. If ``stored`` is given,
+    columns not in it are read from the table as NULL.
+
+    The rows are written into the query rather than bound, as there can be more values than
+    SQLite allows parameters. They are only ever numbers and names from StatTrack itself."""
+    query = "SELECT " + ", ".join(
+        _quote(c) if stored is None or c in stored else f"NULL AS {_quote(c)}" for c in columns
+    )
+    query += f" FROM {table}"
+    if rows:
+        values = ", ".join("(" + ", ".join(map(_literal, row)) + ")" for row in rows)
+        query += (
+            f" UNION ALL SELECT * FROM (WITH pending ({', '.join(map(_quote, columns))}) AS "
+            f"(VALUES {values}) SELECT * FROM pending WHERE time > {after})"
+        )
+    return f"({query})"
+
+
+def _with_pending_commands(table: str, pending: PendingCommands) -> str:
+    columns = ["time", "command"] + COMMAND_COLUMNS + _bucket_columns()
+    rows = [
+        [to_epoch(time), command, *values]
+        for time, stats in pending
+        for command, values in stats.items()
+    ]
+    return _with_pending(
+        table, columns, rows, f"(SELECT IFNULL(MAX(time), -1) FROM {COMMAND_TABLE})"
+    )
+
+
+def _pending_shards(pending: Pending, metric: str) -> List[Tuple[str, int, int, Any]]:
+    """Get (metric, shard, time, value) rows for one metric from samples, see `_split_shards`."""
+    rows = []
+    for time, data in pending:
+        epoch = to_epoch(time)
+        for name, value in data.items():
+            match = SHARD_METRIC.match(name)
+            if match and match.group(2) == metric and value is not None:
+                rows.append((metric, int(match.group(1)), epoch, value))
+    return rows
+
+
+def _bucket_seconds(bucket: datetime.timedelta) -> int:
+    seconds = int(bucket.total_seconds())
+    if seconds < 1:
+        raise ValueError("bucket must be at least one second")
+    return seconds
+
+
+def _check_aggregates(aggregates: Iterable[str]) -> List[str]:
+    aggregates = list(aggregates)
+    for agg in aggregates:
+        if agg not in AGGREGATES:
+            raise ValueError(f"Unknown aggregate {agg!r}")
+    return aggregates
+
+
+def _shard_buckets(
+    bucket: datetime.timedelta,
+    delta: datetime.timedelta | None,
+    end: datetime.datetime | None,
+    filter_: str,
+    filter_params: List[Any],
+    pending: List[Tuple[str, int, int, Any]],
+    written_until: str,
+) -> Tuple[str, List[Any]]:
+    """Build a query for the min, mean, max and sum of each shard series matching ``filter_``
+    in each bucket, from the coarsest shard table that fits the bucket. The columns are bucket,
+    shard, min, mean, max and sum. ``pending`` rows from `_pending_shards` are included."""
+    bucket_seconds = _bucket_seconds(bucket)
+    resolution = max(
+        (res for res in SHARD_ROLLUPS if bucket_seconds % res == 0), default=min(SHARD_TABLES)
+    )
+    if resolution in SHARD_ROLLUPS:
+        selects = "MIN(min) AS min, TOTAL(sum) / SUM(count) AS mean, MAX(max) AS max, TOTAL(sum)"
+        source = _with_pending(
+            SHARD_TABLES[resolution],
+            ["metric", "shard", "time", "min", "max", "sum", "count"],
+            [
+                [metric, shard, time, value, value, value, 1]
+                for metric, shard, time, value in pending
+            ],
+            written_until,
+        )
+    else:
+        selects = "MIN(value) AS min, AVG(value) AS mean, MAX(value) AS max, TOTAL(value)"
+        source = _with_pending(
+            SHARD_TABLE, ["metric", "shard", "time", "value"], pending, written_until
+        )
+    where, params = _time_range(delta, end, resolution)
+    where = (where + " AND " if where else " WHERE ") + filter_
+    query = (
+        f"SELECT (time / {bucket_seconds}) * {bucket_seconds} AS bucket, shard, {selects} "
+        f"FROM {source}{where} GROUP BY bucket, shard"
+    )
+    return query, [*params, *filter_params]
+
+
+def _create_table(conn: sqlite3.Connection, columns: Iterable[str]) -> None:
+    # INTEGER PRIMARY KEY is an alias for the rowid, so rows are stored in time order and range
+    # queries are a B-tree seek. NUMERIC keeps integers as integers.
+    cols = "".join(f", {_quote(c)} NUMERIC" for c in columns)
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {TABLE} (time INTEGER PRIMARY KEY{cols})")
+
+
+def _add_columns(conn: sqlite3.Connection, columns: Iterable[str], table: str = TABLE) -> None:
+    # ADD COLUMN only changes the schema, existing rows read the new column as NULL
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})").fetchall()}
+    for column in columns:
+        if column not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {_quote(column)} NUMERIC")
+
+
+def _create_cluster_table(conn: sqlite3.Connection) -> None:
+    # keyed by time first, so combining the clusters for a range of times is a B-tree seek
+    conn.execute(
+        f"CREATE TABLE IF NOT EXISTS {CLUSTER_TABLE} (time INTEGER NOT NULL, cluster TEXT NOT "
+        "NULL, PRIMARY KEY (time, cluster)) WITHOUT ROWID"
+    )
+    conn.execute(
+        f"CREATE TABLE IF NOT EXISTS {CLUSTERS_TABLE} (cluster TEXT PRIMARY KEY, time INTEGER "
+        "NOT NULL) WITHOUT ROWID"
+    )
+
+
+def _create_version_table(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        f"CREATE TABLE IF NOT EXISTS {VERSION_TABLE} (time INTEGER PRIMARY KEY, version INTEGER "
+        "NOT NULL)"
+    )
+
+
+def _update_cluster(conn: sqlite3.Connection, cluster: str, time: int) -> None:
+    conn.execute(
+        f"INSERT INTO {CLUSTERS_TABLE} VALUES (?, ?) ON CONFLICT (cluster) DO UPDATE SET "
+        "time = MAX(time, excluded.time)",
+        (cluster, time),
+    )
+
+
+def _complete_range(conn: sqlite3.Connection, start: int) -> Tuple[int, int]:
+    """Get the epoch seconds ``[start, end]`` to recalculate in the stats table after a cluster
+    writes rows from ``start``.
+
+    This ends at the last minute every running cluster has written, and goes back to the first
+    minute not in the stats table yet if that's earlier, for when a cluster held them back."""
+    lasts = [row[0] for row in conn.execute(f"SELECT time FROM {CLUSTERS_TABLE}")]
+    newest = max(lasts)
+    end = min(last for last in lasts if last >= newest - CLUSTER_TIMEOUT)
+    combined = conn.execute(f"SELECT MAX(time) FROM {TABLE}").fetchone()[0]
+    if combined is not None:
+        start = min(start, combined + 1)
+    return start, end
+
+
+def _bump_versions(conn: sqlite3.Connection, start: int, end: int) -> None:
+    """Mark the data for every day in ``[start, end]`` epoch seconds as changed."""
+    conn.executemany(
+        f"INSERT INTO {VERSION_TABLE} VALUES (?, 1) ON CONFLICT (time) DO UPDATE SET "
+        "version = version + 1",
+        ((day,) for day in range(start // 86400 * 86400, end + 1, 86400)),
+    )
+
+
+def _combine_clusters(conn: sqlite3.Connection, start: int, end: int) -> None:
+    """Recalculate the stats table from every cluster for ``[start, end]`` epoch seconds. Must
+    be called inside a transaction."""
+    columns = [
+        row[1]
+        for row in conn.execute(f"PRAGMA table_info({CLUSTER_TABLE})").fetchall()
+        if row[1] not in ("time", "cluster")
+    ]
+    _add_columns(conn, columns)
+    quoted = [_quote(c) for c in columns]
+    selects = "".join(f", {FLEET_AGGREGATES.get(c, 'SUM')}({q})" for c, q in zip(columns, quoted))
+    conn.execute(
+        f"INSERT OR REPLACE INTO {TABLE} (time{''.join(', ' + q for q in quoted)}) "
+        f"SELECT time{selects} FROM {CLUSTER_TABLE} WHERE time >= ? AND time <= ? GROUP BY time",
+        (start, end),
+    )
+
+
+def _create_shard_tables(conn: sqlite3.Connection) -> None:
+    # keyed by series first, so reading a few shards over a range is a B-tree seek per shard
+    conn.execute(
+        f"CREATE TABLE IF NOT EXISTS {SHARD_TABLE} (metric TEXT NOT NULL, shard INTEGER NOT NULL, "
+        "time INTEGER NOT NULL, value NUMERIC, PRIMARY KEY (metric, shard, time)) WITHOUT ROWID"
+    )
+    for table in SHARD_ROLLUPS.values():
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} (metric TEXT NOT NULL, shard INTEGER NOT NULL, "
+            "time INTEGER NOT NULL, min NUMERIC, max NUMERIC, sum NUMERIC, count INTEGER, "
+            "PRIMARY KEY (metric, shard, time)) WITHOUT ROWID"
+        )
+    conn.execute(
+        f"CREATE TABLE IF NOT EXISTS {SHARD_SERIES} (metric TEXT NOT NULL, shard INTEGER NOT "
+        "NULL, PRIMARY KEY (metric, shard)) WITHOUT ROWID"
+    )
+
+
+def _create_rollup_tables(conn: sqlite3.Connection) -> None:
+    # keyed by metric first, so reading a few metrics over a range is a B-tree seek per metric
+    for table in ROLLUPS.values():
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} (metric TEXT NOT NULL, time INTEGER NOT NULL, "
+            "min NUMERIC, max NUMERIC, sum NUMERIC, count INTEGER, PRIMARY KEY (metric, time)) "
+            "WITHOUT ROWID"
+        )
+
+
+def _bucket_columns() -> List[str]:
+    return [f"b{i}" for i in range(BUCKET_COUNT)]
+
+
+def _create_command_tables(conn: sqlite3.Connection) -> None:
+    # a fixed set of integer columns, one per histogram bucket, so each row is small
+    buckets = "".join(f", {c} INTEGER NOT NULL DEFAULT 0" for c in _bucket_columns())
+    for table in COMMAND_TABLES.values():
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} (time INTEGER NOT NULL, command TEXT NOT NULL, "
+            f"count INTEGER NOT NULL, errors INTEGER NOT NULL, total_ms REAL NOT NULL{buckets}, "
+            "PRIMARY KEY (time, command)) WITHOUT ROWID"
+        )
+
+
+def _rollup_commands(conn: sqlite3.Connection, start: int, end: int) -> None:
+    """Recalculate the hourly command stats overlapping ``[start, end)`` epoch seconds. Must be
+    called inside a transaction."""
+    lo = start // 3600 * 3600
+    hi = -(-end // 3600) * 3600
+    columns = COMMAND_COLUMNS + _bucket_columns()
+    conn.execute(
+        f"INSERT OR REPLACE INTO {COMMAND_ROLLUP} (time, command, {', '.join(columns)}) "
+        "SELECT (time / 3600) * 3600 AS bucket, command"
+        + "".join(f", SUM({c})" for c in columns)
+        + f" FROM {COMMAND_TABLE} WHERE time >= ? AND time < ? GROUP BY bucket, command",
+        (lo, hi),
+    )
+
+
+def _rollup(conn: sqlite3.Connection, start: int, end: int) -> None:
+    """Recalculate every rollup bucket overlapping ``[start, end)`` epoch seconds.
+
+    Each rollup is built from the next finer one (the raw data for the first), so only the
+    buckets touched are read. Must be called inside a transaction."""
+    _create_rollup_tables(conn)
+    _create_shard_tables(conn)
+    columns = [
+        row[1]
+        for row in conn.execute(f"PRAGMA table_info({TABLE})").fetchall()
+        if row[1] != "time"
+    ]
+
+    source = None
+    for resolution, table in sorted(ROLLUPS.items()):
+        lo = start // resolution * resolution
+        hi = -(-end // resolution) * resolution
+        bucket = f"(time / {resolution}) * {resolution}"
+        if source is None:
+            # one pass over the raw rows for every column, then split into a row per metric
+            selects = "".join(
+                f", MIN({q}), MAX({q}), TOTAL({q}), COUNT({q})" for q in map(_quote, columns)
+            )
+            rows = conn.execute(
+                f"SELECT {bucket} AS bucket{selects} FROM {TABLE} "
+                "WHERE time >= ? AND time < ? GROUP BY bucket",
+                (lo, hi),
+            ).fetchall()
+            conn.executemany(
+                f"INSERT OR REPLACE INTO {table} VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    (column, row[0], *row[i : i + 4])
+                    for row in rows
+                    for column, i in zip(columns, range(1, len(row), 4))
+                    if row[i + 3]  # no values for this metric in the bucket
+                ),
+            )
+        else:
+            conn.execute(
+                f"INSERT OR REPLACE INTO {table} SELECT metric, {bucket} AS bucket, MIN(min), "
+                f"MAX(max), TOTAL(sum), SUM(count) FROM {source} "
+                "WHERE time >= ? AND time < ? GROUP BY metric, bucket",
+                (lo, hi),
+            )
+        source = table
+
+    source = SHARD_TABLE
+    for resolution, table in sorted(SHARD_ROLLUPS.items()):
+        lo = start // resolution * resolution
+        hi = -(-end // resolution) * resolution
+        if source == SHARD_TABLE:
+            selects = "MIN(value), MAX(value), TOTAL(value), COUNT(value)"
+        else:
+            selects = "MIN(min), MAX(max), TOTAL(sum), SUM(count)"
+        conn.execute(
+            f"INSERT OR REPLACE INTO {table} SELECT metric, shard, (time / {resolution}) * "
+            f"{resolution} AS bucket, {selects} FROM {source} WHERE {ALL_SERIES} "
+            "AND time >= ? AND time < ? GROUP BY metric, shard, bucket",
+            (lo, hi),
+        )
+        source = table
+
+
+def _insert(conn: sqlite3.Connection, df: pd.DataFrame) -> None:
+    times = pd.DatetimeIndex(df.index).values.astype("datetime64[s]").astype("int64").tolist()
+    values = df.astype(object).where(df.notna(), None).values.tolist()
+    columns, values, shard_rows = _split_shards(list(df.columns), times, values)
+    _insert_rows(conn, columns, times, values)
+    _insert_shard_rows(conn, shard_rows)
+
+
+def _split_shards(
+    columns: List[str], times: List[int], values: List[List[Any]]
+) -> Tuple[List[str], List[List[Any]], List[Tuple[str, int, int, Any]]]:
+    """Take per-shard metrics out of rows for the stats table, as (metric, shard, time, value)
+    rows for the shard table."""
+    matches = [SHARD_METRIC.match(column) for column in columns]
+    keep = [i for i, match in enumerate(matches) if match is None]
+    shard_rows = [
+        (match.group(2), int(match.group(1)), time, row[i])
+        for time, row in zip(times, values)
+        for i, match in enumerate(matches)
+        if match is not None and row[i] is not None
+    ]
+    if len(keep) == len(columns):
+        return columns, values, shard_rows
+    return [columns[i] for i in keep], [[row[i] for i in keep] for row in values], shard_rows
+
+
+def _insert_shard_rows(conn: sqlite3.Connection, rows: List[Tuple[str, int, int, Any]]) -> None:
+    conn.executemany(f"INSERT OR REPLACE INTO {SHARD_TABLE} VALUES (?, ?, ?, ?)", rows)
+    conn.executemany(
+        f"INSERT OR IGNORE INTO {SHARD_SERIES} VALUES (?, ?)",
+        dict.fromkeys((metric, shard) for metric, shard, _, _ in rows),
+    )
+
+
+def _insert_rows(
+    conn: sqlite3.Connection,
+    columns: List[str],
+    times: List[int],
+    values: List[List[Any]],
+    table: str = TABLE,
+) -> None:
+    query = (
+        f"INSERT OR REPLACE INTO {table} (time{''.join(', ' + _quote(c) for c in columns)}) "
+        f"VALUES (?{', ?' * len(columns)})"
+    )
+    conn.executemany(query, ([t] + v for t, v in zip(times, values)))
+
+
+def _to_agg_frame(
+    buckets: List[int], data: List[Any], columns: List[Tuple[str, str]]
+) -> pd.DataFrame:
+    df = pd.DataFrame(data, columns=pd.MultiIndex.from_tuples(columns))
+    df.index = pd.to_datetime(buckets, unit="s")
+    df.index.name = "index"
+    return df
+
+
+async def _read_history(conn: aiosqlite.Connection, metrics: List[str]) -> pd.DataFrame:
+    """Read the mean of each metric from each rollup table, for the times before the data at
+    every finer resolution starts, as a DataFrame with ``metrics`` as the columns."""
+    query = []
+    finer = [f"(SELECT MIN(time) FROM {TABLE})"]
+    for table in ROLLUPS.values():  # finest first
+        # sum is an integer if every value was, so make it a float to avoid integer division
+        query.append(
+            f"SELECT time, metric, sum * 1.0 / count FROM {table} "
+            f"WHERE time < COALESCE({', '.join(finer)}, {2 ** 63 - 1})"
+        )
+        finer.insert(0, f"(SELECT MIN(time) FROM {table})")
+    async with conn.execute(" UNION ALL ".join(query) + " ORDER BY time") as cursor:
+        data = await cursor.fetchall()
+
+    df = pd.DataFrame(data, columns=["time", "metric", "value"])
+    df = df.pivot(index="time", columns="metric", values="value").reindex(columns=metrics)
+    df.columns.name = None
+    df.index = pd.to_datetime(df.index, unit="s")
+    df.index.name = "index"
+    return df
+
+
+def _to_frame(data: List[Any], columns: List[str]) -> pd.DataFrame:
+    df = pd.DataFrame(data, columns=columns)
+    df.index = pd.to_datetime(df.pop("time"), unit="s")
+    df.index.name = "index"
+    return df
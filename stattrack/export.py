@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import gzip
+import io
+import tempfile
+from typing import IO, Optional
+
+import pandas as pd
+
+# pyarrow is a big install, so it's optional and only needed for Parquet export/import
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    use_pyarrow = True
+except ImportError:
+    use_pyarrow = False
+
+INDEX = "index"
+
+
+class ParquetExporter:
+    """Write DataFrame chunks from `StatTrackSQLiteDriver.read_chunks` to a compressed Parquet
+    file in memory. Chunks must all have the same columns.
+
+    The methods are blocking, so should be run in an executor.
+    """
+
+    def __init__(self) -> None:
+        self.fp = io.BytesIO()
+        self._writer: Optional[pq.ParquetWriter] = None
+        self._schema: Optional[pa.Schema] = None
+
+    def write(self, df: pd.DataFrame) -> None:
+        """Write a chunk."""
+        if self._writer is None:
+            # all metrics are stored as floats, so a chunk with only NULLs in a column has the
+            # same schema as the rest
+            self._schema = pa.schema(
+                [(INDEX, pa.timestamp("s"))] + [(col, pa.float64()) for col in df.columns]
+            )
+            self._writer = pq.ParquetWriter(self.fp, self._schema, compression="zstd")
+        table = pa.Table.from_pandas(
+            df.astype("float64"), schema=self._schema, preserve_index=True, safe=False
+        )
+        self._writer.write_table(table)
+
+    def close(self) -> io.BytesIO:
+        """Finish the file and return it, ready to be read. Returns an empty file if no chunks
+        were written."""
+        if self._writer is not None:
+            self._writer.close()
+        self.fp.seek(0)
+        return self.fp
+
+
+class CSVExporter:
+    """Write DataFrame chunks from `StatTrackSQLiteDriver.read_chunks` to a gzipped CSV in a
+    temporary file, so only one chunk is in memory at a time. Chunks must all have the same
+    columns.
+
+    The methods are blocking, so should be run in an executor.
+    """
+
+    def __init__(self) -> None:
+        self.fp: IO[bytes] = tempfile.TemporaryFile()
+        self._gzip = gzip.GzipFile(fileobj=self.fp, mode="wb")
+        self._text = io.TextIOWrapper(self._gzip, encoding="utf-8", newline="")
+        self._header = True
+        self._size: Optional[int] = None
+
+    @property
+    def size(self) -> int:
+        """Compressed bytes written to the file so far."""
+        if self._size is not None:
+            return self._size
+        return self.fp.tell()
+
+    def write(self, df: pd.DataFrame) -> None:
+        """Write a chunk."""
+        df.to_csv(self._text, header=self._header)
+        self._header = False
+
+    def close(self) -> IO[bytes]:
+        """Finish the file and return it, ready to be read. The file is deleted when it is
+        closed."""
+        self._text.flush()
+        self._text.detach()
+        self._gzip.close()  # does not close fp
+        self._size = self.fp.tell()
+        self.fp.seek(0)
+        return self.fp
+
+
+def read_parquet(data: bytes) -> pd.DataFrame:
+    """Read a file made by `ParquetExporter` into a DataFrame. Blocking."""
+    df = pq.read_table(pa.BufferReader(data)).to_pandas()
+    if INDEX in df.columns:  # the index is stored as a normal column if it was unnamed
+        df = df.set_index(INDEX)
+    df.index = pd.DatetimeIndex(df.index)
+    return df
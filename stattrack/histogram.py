@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+from bisect import bisect_left
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+# upper bound of each histogram bucket, in milliseconds. there is one more bucket for anything
+# slower than the last bound
+BUCKET_BOUNDS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+BUCKET_COUNT = len(BUCKET_BOUNDS_MS) + 1
+
+# count, errors, total_ms, then each bucket
+CommandStats = List[float]
+
+
+class CommandTimings:
+    """Invocation counts and execution time histograms for each command, since the last `pop`.
+
+    These only hold the current minute, so they stay tiny. Each minute is written to the
+    database as one row per command that was used.
+    """
+
+    def __init__(self) -> None:
+        self._stats: Dict[str, CommandStats] = {}
+
+    def __len__(self) -> int:
+        return len(self._stats)
+
+    def record(self, command: str, seconds: float, error: bool = False) -> None:
+        """Record one invocation of a command, by its qualified name."""
+        stats = self._stats.get(command)
+        if stats is None:
+            stats = self._stats[command] = [0, 0, 0.0] + [0] * BUCKET_COUNT
+        ms = seconds * 1000
+        stats[0] += 1
+        stats[1] += error
+        stats[2] += ms
+        stats[3 + bisect_left(BUCKET_BOUNDS_MS, ms)] += 1
+
+    def pop(self) -> Dict[str, CommandStats]:
+        """Get the stats for each command and start again."""
+        stats, self._stats = self._stats, {}
+        return stats
+
+
+def percentiles(buckets: np.ndarray, quantiles: Sequence[float]) -> np.ndarray:
+    """Estimate percentiles from rows of histogram bucket counts.
+
+    Like Prometheus' ``histogram_quantile``, values are interpolated linearly within the bucket
+    the percentile falls in. Anything in the last bucket is reported as the last bound, since
+    it has no upper limit.
+
+    Parameters
+    ----------
+    buckets : np.ndarray
+        Shape (rows, BUCKET_COUNT), the counts in each bucket.
+    quantiles : Sequence[float]
+        Between 0 and 1, for example ``(0.5, 0.95, 0.99)``.
+
+    Returns
+    -------
+    np.ndarray
+        Shape (rows, len(quantiles)), in milliseconds. NaN for rows with no invocations.
+    """
+    buckets = np.asarray(buckets, dtype="float64").reshape(-1, BUCKET_COUNT)
+    cumulative = np.cumsum(buckets, axis=1)
+    totals = cumulative[:, -1:]
+    lower_bounds = np.array((0,) + BUCKET_BOUNDS_MS, dtype="float64")
+    upper_bounds = np.array(BUCKET_BOUNDS_MS + (BUCKET_BOUNDS_MS[-1],), dtype="float64")
+
+    out = np.full((len(buckets), len(quantiles)), np.nan)
+    rows = np.arange(len(buckets))
+    for i, q in enumerate(quantiles):
+        rank = totals[:, 0] * q
+        # first bucket where the cumulative count reaches the rank
+        index = np.minimum((cumulative < rank[:, None]).sum(axis=1), BUCKET_COUNT - 1)
+        below = np.where(index > 0, cumulative[rows, index - 1], 0.0)
+        in_bucket = buckets[rows, index]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            fraction = np.where(in_bucket > 0, (rank - below) / in_bucket, 1.0)
+        lo = lower_bounds[index]
+        out[:, i] = lo + (upper_bounds[index] - lo) * fraction
+    out[totals[:, 0] == 0] = np.nan
+    return out
@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import asyncio
+import gc
+import time
+from array import array
+from typing import Dict, Optional
+
+import numpy as np
+
+# seconds between event loop wakeups. lag is how much later than this the wakeup happens
+LAG_INTERVAL = 0.1
+
+
+class LagMonitor:
+    """Measure event loop lag and garbage collection pauses, summarised each minute.
+
+    Lag is sampled by a task that sleeps for `LAG_INTERVAL` and measures how late it wakes up,
+    so a stall shows up as one large sample. GC pauses are timed with ``gc.callbacks``,
+    and pause the whole interpreter, not just the event loop.
+    """
+
+    def __init__(self, interval: float = LAG_INTERVAL) -> None:
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+        # milliseconds, since the last pop
+        self._lags = array("d")
+        self._gc_pauses = array("d")
+        self._gc_start: Optional[float] = None
+
+    def start(self) -> None:
+        """Start sampling lag and timing GC pauses. Must be called from the event loop."""
+        if self._task is not None:
+            return
+        self._task = asyncio.get_event_loop().create_task(self._sample_lag())
+        gc.callbacks.append(self._gc_callback)
+
+    def stop(self) -> None:
+        """Stop sampling."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._gc_callback in gc.callbacks:
+            gc.callbacks.remove(self._gc_callback)
+
+    def pop(self) -> Dict[str, float]:
+        """Get the max and p99 lag and GC pause, in milliseconds, since the last pop and start
+        again. Stats with no samples are 0."""
+        lags, self._lags = self._lags, array("d")
+        pauses, self._gc_pauses = self._gc_pauses, array("d")
+        data = {}
+        for name, values in (("loop_lag", lags), ("gc_pause", pauses)):
+            arr = np.frombuffer(values, dtype="float64") if values else np.zeros(1)
+            data[f"{name}_max_ms"] = round(float(arr.max()), 2)
+            data[f"{name}_p99_ms"] = round(float(np.percentile(arr, 99)), 2)
+        data["gc_collections"] = len(pauses)
+        return data
+
+    async def _sample_lag(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self._lags.append(max(0.0, loop.time() - expected) * 1000)
+
+    def _gc_callback(self, phase: str, info: dict) -> None:
+        # can be called from any thread, but only one collection runs at a time
+        if phase == "start":
+            self._gc_start = time.perf_counter()
+        elif self._gc_start is not None:
+            self._gc_pauses.append((time.perf_counter() - self._gc_start) * 1000)
+            self._gc_start = None
@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import re
+from typing import Callable, Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+from stattrack.buffer import Sample
+from stattrack.consts import SHARD_METRIC
+from stattrack.driver import to_epoch
+
+from .vexutils import get_vex_logger
+
+_log = get_vex_logger(__name__)
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+PREFIX = "stattrack_"
+
+METRIC_HELP = {
+    "ping": "Latency to Discord in milliseconds",
+    "loop_time_s": "Time the last StatTrack loop took in seconds",
+    "loop_lag_max_ms": "Longest event loop lag in the last minute in milliseconds",
+    "loop_lag_p99_ms": "99th percentile event loop lag in the last minute in milliseconds",
+    "gc_pause_max_ms": "Longest garbage collection pause in the last minute in milliseconds",
+    "gc_pause_p99_ms": "99th percentile garbage collection pause in the last minute in "
+    "milliseconds",
+    "gc_collections": "Garbage collections in the last minute",
+    "users_unique": "Unique users",
+    "users_total": "Users, counted once for each server they share with the bot",
+    "users_humans": "Unique users that are not bots",
+    "users_bots": "Unique users that are bots",
+    "guilds": "Servers",
+    "channels_total": "Channels of all types",
+    "channels_text": "Text channels",
+    "channels_voice": "Voice channels",
+    "channels_stage": "Stage channels",
+    "channels_cat": "Channel categories",
+    "sys_mem": "System memory usage as a percentage",
+    "sys_cpu": "System CPU usage as a percentage",
+    "command_count": "Commands run in the last minute",
+    "message_count": "Messages seen in the last minute",
+    "status_online": "Unique users that are online",
+    "status_idle": "Unique users that are idle",
+    "status_offline": "Unique users that are offline",
+    "status_dnd": "Unique users that are on do not disturb",
+    "shard_ping": "Latency of each shard to Discord in milliseconds",
+    "shard_guilds": "Servers on each shard",
+    "shard_members": "Members of the servers on each shard",
+}
+
+
+def format_openmetrics(sample: Optional[Sample]) -> str:
+    """Format a sample as OpenMetrics text, with each metric as a gauge timestamped with the
+    time of the sample.
+
+    If there is no sample yet, only the end of the exposition is sent, which is still valid.
+    """
+    # per-shard metrics become one family, with the shard as a label
+    families: Dict[str, List[Tuple[str, float]]] = {}
+    timestamp = 0
+    if sample is not None:
+        time, data = sample
+        timestamp = to_epoch(time)
+        for metric, value in data.items():
+            match = SHARD_METRIC.match(metric)
+            if match:
+                families.setdefault(f"shard_{match.group(2)}", []).append(
+                    (f'{{shard="{match.group(1)}"}}', value)
+                )
+            else:
+                families.setdefault(metric, []).append(("", value))
+
+    lines = []
+    for family, samples in families.items():
+        name = PREFIX + re.sub(r"[^a-zA-Z0-9_]", "_", family)
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"# HELP {name} {METRIC_HELP.get(family, family)}")
+        for labels, value in samples:
+            lines.append(f"{name}{labels} {float(value)!r} {timestamp}")
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """A small web server for Prometheus or anything else that can scrape OpenMetrics.
+
+    Metrics are served at ``/metrics`` from the latest sample in memory, so scrapes don't touch
+    the database.
+    """
+
+    def __init__(self, get_sample: Callable[[], Optional[Sample]]) -> None:
+        self.get_sample = get_sample
+        self.runner: Optional[web.AppRunner] = None
+        self.address: Optional[str] = None
+
+    async def metrics(self, request: web.Request) -> web.Response:
+        return web.Response(
+            body=format_openmetrics(self.get_sample()).encode("utf-8"),
+            headers={"Content-Type": CONTENT_TYPE},
+        )
+
+    async def start(self, host: str, port: int) -> None:
+        """Start the server, stopping it first if it's already running.
+
+        Raises
+        ------
+        OSError
+            If the server can't listen on the host and port.
+        """
+        await self.stop()
+
+        app = web.Application()
+        app.add_routes([web.get("/metrics", self.metrics)])
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, host=host, port=port).start()
+        except OSError:
+            await runner.cleanup()
+            raise
+
+        self.runner = runner
+        self.address = f"http://{host}:{port}/metrics"
+        _log.info(f"StatTrack metrics server has started at {self.address}")
+
+    async def stop(self) -> None:
+        """Stop the server, if it's running."""
+        if self.runner is None:
+            return
+        await self.runner.cleanup()
+        self.runner = None
+        self.address = None
+        _log.info("StatTrack metrics server has stopped.")
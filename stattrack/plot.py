@@ -1,13 +1,21 @@
 import functools
-import io
+import multiprocessing
+import os
+import site
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from concurrent.futures.thread import ThreadPoolExecutor
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Any, List, NamedTuple, Optional, Tuple
 
-import discord
+import numpy as np
 import pandas as pd
 from plotly import express as px
 
+from stattrack import pngplot
 from stattrack.abc import MixinMeta
+from stattrack.consts import STATUS_COLOURS, friendly_name
+
+from .vexutils import get_vex_logger
 
 if TYPE_CHECKING:
     from plotly.graph_objs._figure import Figure
@@ -17,89 +25,148 @@ else:
 # supported by mypy
 
 
+log = get_vex_logger(__name__)
+
 ONE_DAY_SECONDS = 86400
 
-TRACE_FRIENDLY_NAMES = {
-    "ping": "Latency",
-    "loop_time_s": "Loop time",
-    "users_unique": "Unique",
-    "users_total": "Total",
-    "users_humans": "Humans",
-    "users_bots": "Bots",
-    "guilds": "Servers",
-    "channels_total": "Total",
-    "channels_text": "Text",
-    "channels_voice": "Voice",
-    "channels_stage": "Stage",
-    "channels_cat": "Categories",
-    "sys_mem": "Memory usage",
-    "sys_cpu": "CPU Usage",
-    "command_count": "Commands",
-    "message_count": "Messages",
-    "status_online": "Online",
-    "status_idle": "Idle",
-    "status_offline": "Offline",
-    "status_dnd": "DnD",
-}
+# the directory the cog was loaded from. Red loads cogs without adding it to sys.path, so worker
+# processes need it added before they can import this module
+COG_PARENT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+GRAPH_CACHE_SIZE = 32
+
+
+class CachedGraph(NamedTuple):
+    png: bytes
+    fields: List[Tuple[str, Any]]  # embed fields (name, value)
+    points: int
+    frequency: int
+    mins: float
 
 
 class StatPlot(MixinMeta):
     def __init__(self) -> None:
         self.plot_executor = ThreadPoolExecutor(5, "stattrack_plot")
+        self.plot_process_pool: Optional[ProcessPoolExecutor] = None
+        self.plot_processes = 0
+        self.plot_renderer = "plotly"
+
+    def set_plot_processes(self, processes: int) -> None:
+        """Start a pool of worker processes to plot in, or stop it if ``processes`` is 0."""
+        if self.plot_process_pool is not None:
+            self.plot_process_pool.shutdown(wait=False)
+            self.plot_process_pool = None
+        self.plot_processes = processes
+        if processes > 0:
+            # don't fork the bot's process, its event loop and connections would be copied.
+            # the initializer is from the standard library, so it can run before the cog is
+            # importable
+            pool = ProcessPoolExecutor(
+                processes,
+                multiprocessing.get_context("spawn"),
+                initializer=site.addsitedir,
+                initargs=(COG_PARENT,),
+            )
+            # start every worker now, with plotly imported and kaleido running, instead of when
+            # the first graphs are made
+            for _ in range(processes):
+                pool.submit(_warm_up)
+            self.plot_process_pool = pool
+
+    async def plot(self, df: pd.DataFrame, ylabel: str, status_colours: bool) -> bytes:
+        """Plot the standard dataframe to the specified parameters. Returns PNG bytes"""
+        pool = self.plot_process_pool
+        if pool is not None:
+            # plain arrays pickle as raw buffers, much smaller and faster than a DataFrame
+            func = functools.partial(
+                _plot_arrays,
+                index=df.index.values.astype("datetime64[ns]").view("int64"),
+                columns=list(df.columns),
+                values=df.to_numpy(dtype="float64"),
+                ylabel=ylabel,
+                status_colours=status_colours,
+                renderer=self.plot_renderer,
+            )
+            try:
+                return await self.bot.loop.run_in_executor(pool, func)
+            except BrokenProcessPool:
+                # a worker died, for example from running out of memory. plot this graph here and
+                # start new workers for the next, unless another graph already has
+                log.warning(
+                    "A plot process stopped unexpectedly, so the processes are being restarted.",
+                    exc_info=True,
+                )
+                if self.plot_process_pool is pool:
+                    self.set_plot_processes(self.plot_processes)
 
-    async def plot(self, df: pd.DataFrame, ylabel: str, status_colours: bool) -> discord.File:
-        """Plot the standard dataframe to the specified parameters. Returns a discord file"""
         func = functools.partial(
-            self._plot,
+            _plot,
             df=df,
             ylabel=ylabel,
             status_colours=status_colours,
+            renderer=self.plot_renderer,
         )
 
         return await self.bot.loop.run_in_executor(self.plot_executor, func)
 
-    def _plot(
-        self,
-        df: pd.DataFrame,
-        ylabel: str,
-        status_colours: bool,
-    ) -> discord.File:
-        """Do not use on own - blocking."""
-        colour_map = (
-            {
-                "status_online": "#3ba55d",
-                "status_idle": "#FAA81A",
-                "status_offline": "#747f8d",
-                "status_dnd": "#ed4245",
-            }
-            if status_colours
-            else None
-        )
-        fig: Figure = px.line(
-            df,
-            template="plotly_dark",
-            labels={"index": "Date", "value": ylabel, "variable": "Metric"},
-            color_discrete_map=colour_map,
-        )
-        fig.update_layout(
-            title_x=0.5,
-            font_size=14,
-            legend={
-                "orientation": "h",
-                "yanchor": "bottom",
-                "y": 1.02,
-                "xanchor": "right",
-                "x": 1,
-            },
-        )
 
-        # rename the legend item of each trace in fig
-        for trace in fig.data:
-            trace.name = TRACE_FRIENDLY_NAMES[trace.name]  # type:ignore
+def _plot(
+    df: pd.DataFrame,
+    ylabel: str,
+    status_colours: bool,
+    renderer: str = "plotly",
+) -> bytes:
+    """Do not use on own - blocking."""
+    colour_map = STATUS_COLOURS if status_colours else None
+
+    # plotly is always used for anything the native renderer can't draw
+    if renderer == "native" and pngplot.can_plot(df):
+        names = {column: friendly_name(column) for column in df.columns}
+        return pngplot.line_chart(df, ylabel, colour_map, names)
+    fig: Figure = px.line(
+        df,
+        template="plotly_dark",
+        labels={"index": "Date", "value": ylabel, "variable": "Metric"},
+        color_discrete_map=colour_map,
+    )
+    fig.update_layout(
+        title_x=0.5,
+        font_size=14,
+        legend={
+            "orientation": "h",
+            "yanchor": "bottom",
+            "y": 1.02,
+            "xanchor": "right",
+            "x": 1,
+        },
+    )
+
+    # rename the legend item of each trace in fig
+    for trace in fig.data:
+        trace.name = friendly_name(trace.name)  # type:ignore
+
+    return fig.to_image(format="png", width=800, height=500, scale=1)
+
+
+def _plot_arrays(
+    index: np.ndarray,
+    columns: List[str],
+    values: np.ndarray,
+    ylabel: str,
+    status_colours: bool,
+    renderer: str,
+) -> bytes:
+    """Rebuild the DataFrame in a worker process and plot it. Blocking."""
+    df = pd.DataFrame(
+        values, index=pd.DatetimeIndex(index.view("datetime64[ns]")), columns=columns
+    )
+    df.index.name = "index"
+    return _plot(df, ylabel, status_colours, renderer)
+
 
-        bytes = fig.to_image(format="png", width=800, height=500, scale=1)
-        buffer = io.BytesIO(bytes)
-        buffer.seek(0)
-        file = discord.File(buffer, filename="plot.png")
-        buffer.close()
-        return file
+def _warm_up() -> None:
+    """Plot once in a new worker process, so plotly is imported and kaleido is running before
+    the first real plot."""
+    df = pd.DataFrame({"ping": [0.0, 1.0]}, index=pd.date_range("2000-01-01", periods=2))
+    df.index.name = "index"
+    _plot(df, "", False)
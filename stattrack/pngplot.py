@@ -0,0 +1,211 @@
+"""A small line chart renderer using Pillow, much faster and lighter than plotly + kaleido.
+
+It only does what StatTrack needs: one or more lines over time on a single axis, styled to look
+like the ``plotly_dark`` template.
+"""
+from __future__ import annotations
+
+import datetime
+import io
+import math
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+# Pillow is optional, plotly is used if it's not installed. 10.1+ is needed for a default font
+# that can be resized
+try:
+    from PIL import Image, ImageDraw, ImageFont
+
+    use_pillow = isinstance(ImageFont.load_default(size=14), ImageFont.FreeTypeFont)
+except (ImportError, TypeError):
+    use_pillow = False
+
+WIDTH = 800
+HEIGHT = 500
+# left, top, right, bottom
+MARGINS = (80, 70, 25, 70)
+
+BACKGROUND = "#111111"
+GRID = "#283442"
+TEXT = "#f2f5fa"
+# plotly's default colour sequence
+COLOURS = [
+    "#636efa",
+    "#EF553B",
+    "#00cc96",
+    "#ab63fa",
+    "#FFA15A",
+    "#19d3f3",
+    "#FF6692",
+    "#B6E880",
+    "#FF97FF",
+    "#FECB52",
+]
+
+Point = Tuple[float, float]
+
+
+def can_plot(df: pd.DataFrame) -> bool:
+    """Whether the DataFrame is simple enough for `line_chart`. If not, use plotly."""
+    return use_pillow and 0 < len(df.columns) <= len(COLOURS) and len(df) > 0
+
+
+def line_chart(
+    df: pd.DataFrame,
+    ylabel: str,
+    colour_map: Optional[Dict[str, str]],
+    names: Dict[str, str],
+) -> bytes:
+    """Draw each column of a DataFrame with a DatetimeIndex as a line. Blocking.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The data. NaN values leave a gap in the line.
+    ylabel : str
+        Label for the y axis.
+    colour_map : Dict[str, str], optional
+        Colour for each column. Otherwise, plotly's default colours are used.
+    names : Dict[str, str]
+        Legend names for each column.
+
+    Returns
+    -------
+    bytes
+        PNG image.
+    """
+    font = ImageFont.load_default(size=14)
+    img = Image.new("RGB", (WIDTH, HEIGHT), BACKGROUND)
+    draw = ImageDraw.Draw(img)
+
+    left, top, right, bottom = MARGINS[0], MARGINS[1], WIDTH - MARGINS[2], HEIGHT - MARGINS[3]
+
+    x = df.index.values.astype("datetime64[s]").astype("float64")
+    values = df.to_numpy(dtype="float64")
+    x_min, x_max = float(x[0]), float(x[-1])
+    if x_max == x_min:
+        x_max = x_min + 1
+
+    y_ticks = _nice_ticks(np.nanmin(values), np.nanmax(values))
+    y_min, y_max = y_ticks[0], y_ticks[-1]
+
+    def to_px(xs: np.ndarray, ys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        px = left + (xs - x_min) / (x_max - x_min) * (right - left)
+        py = bottom - (ys - y_min) / (y_max - y_min) * (bottom - top)
+        return px, py
+
+    # y grid and labels
+    for tick in y_ticks:
+        _, py = to_px(np.array([x_min]), np.array([tick]))
+        draw.line([(left, py[0]), (right, py[0])], fill=GRID, width=1)
+        label = _format_number(tick)
+        draw.text((left - 8, py[0]), label, fill=TEXT, font=font, anchor="rm")
+
+    # x grid and labels
+    for tick, label in _time_ticks(x_min, x_max):
+        px, _ = to_px(np.array([tick]), np.array([y_min]))
+        draw.line([(px[0], top), (px[0], bottom)], fill=GRID, width=1)
+        draw.multiline_text(
+            (px[0], bottom + 6), label, fill=TEXT, font=font, anchor="ma", align="center"
+        )
+
+    # axis titles
+    draw.text(((left + right) / 2, HEIGHT - 4), "Date", fill=TEXT, font=font, anchor="md")
+    ylabel_img = Image.new("RGB", (bottom - top, 20), BACKGROUND)
+    ImageDraw.Draw(ylabel_img).text(
+        ((bottom - top) / 2, 10), ylabel, fill=TEXT, font=font, anchor="mm"
+    )
+    img.paste(ylabel_img.rotate(90, expand=True), (4, top))
+
+    # lines, and the legend above the plot
+    legend_x = float(right)
+    for i, column in enumerate(reversed(list(df.columns))):
+        col_index = len(df.columns) - 1 - i
+        colour = (colour_map or {}).get(column) or COLOURS[col_index % len(COLOURS)]
+        px, py = to_px(x, values[:, col_index])
+        for segment in _segments(px, py):
+            if len(segment) == 1:
+                draw.point(segment, fill=colour)
+            else:
+                draw.line(segment, fill=colour, width=2, joint="curve")
+
+        name = names.get(column, column)
+        legend_x -= draw.textlength(name, font=font)
+        draw.text((legend_x, top - 20), name, fill=TEXT, font=font, anchor="lm")
+        legend_x -= 36
+        draw.line([(legend_x, top - 20), (legend_x + 28, top - 20)], fill=colour, width=2)
+        legend_x -= 16
+
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def _segments(px: np.ndarray, py: np.ndarray) -> List[List[Point]]:
+    """Split a line into the parts between NaN values."""
+    valid = ~np.isnan(py)
+    if not valid.any():
+        return []
+    # indices where a run of valid points starts or stops
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], valid.view(np.int8), [0]))))
+    points = np.column_stack((px, py))
+    return [
+        [tuple(p) for p in points[start:stop]]  # type:ignore
+        for start, stop in zip(edges[::2], edges[1::2])
+    ]
+
+
+def _nice_ticks(lo: float, hi: float, target: int = 5) -> List[float]:
+    """Round tick values covering lo to hi, in steps of 1, 2 or 5 times a power of 10."""
+    if math.isnan(lo) or math.isnan(hi):
+        lo, hi = 0.0, 1.0
+    if hi == lo:
+        lo, hi = lo - 1, hi + 1
+    raw_step = (hi - lo) / target
+    magnitude = 10 ** math.floor(math.log10(raw_step))
+    step = next(m * magnitude for m in (1, 2, 5, 10) if m * magnitude >= raw_step)
+    start = math.floor(lo / step) * step
+    stop = math.ceil(hi / step) * step
+    return [start + i * step for i in range(round((stop - start) / step) + 1)]
+
+
+def _format_number(value: float) -> str:
+    if abs(value) >= 1_000_000:
+        return f"{value / 1_000_000:g}M"
+    if abs(value) >= 1000:
+        return f"{value / 1000:g}k"
+    return f"{round(value, 6):g}"
+
+
+# tick spacing in seconds, and label format
+_TIME_STEPS = [
+    (60 * 10, "%H:%M"),
+    (60 * 30, "%H:%M"),
+    (3600, "%H:%M"),
+    (3600 * 3, "%H:%M\n%b %d"),
+    (3600 * 6, "%H:%M\n%b %d"),
+    (3600 * 12, "%H:%M\n%b %d"),
+    (86400, "%b %d"),
+    (86400 * 2, "%b %d"),
+    (86400 * 7, "%b %d\n%Y"),
+    (86400 * 14, "%b %d\n%Y"),
+    (86400 * 30, "%b %Y"),
+    (86400 * 91, "%b %Y"),
+    (86400 * 182, "%b %Y"),
+    (86400 * 365, "%Y"),
+]
+
+
+def _time_ticks(start: float, end: float, target: int = 6) -> List[Tuple[float, str]]:
+    """Evenly spaced time ticks between two epoch times, with labels."""
+    span = end - start
+    step, fmt = next(
+        ((step, fmt) for step, fmt in _TIME_STEPS if span / step <= target), _TIME_STEPS[-1]
+    )
+    first = math.ceil(start / step) * step
+    return [
+        (tick, datetime.datetime.utcfromtimestamp(tick).strftime(fmt))
+        for tick in np.arange(first, end + 1, step)
+    ]
@@ -1,21 +1,31 @@
 import asyncio
 import datetime
 import json
+import math
 import time
-from typing import Dict, Optional, Set
+import weakref
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
 
 import discord
 import pandas
 import psutil
+from cachetools import LRUCache
 from redbot.core import Config, commands
 from redbot.core.bot import Red
 from redbot.core.data_manager import cog_data_path
 from redbot.core.utils import AsyncIter
 
 from stattrack.abc import CompositeMetaClass
+from stattrack.buffer import Sample, SampleBuffer
 from stattrack.commands import StatTrackCommands
+from stattrack.consts import shard_metric
+from stattrack.counter import MemberCounter
 from stattrack.driver import StatTrackSQLiteDriver
-from stattrack.plot import StatPlot
+from stattrack.histogram import CommandStats, CommandTimings
+from stattrack.lag import LagMonitor
+from stattrack.openmetrics import MetricsServer
+from stattrack.plot import GRAPH_CACHE_SIZE, StatPlot
 
 from .vexutils import format_help, format_info, get_vex_logger
 from .vexutils.chat import humanize_bytes
@@ -23,6 +33,23 @@ from .vexutils.loop import VexLoop
 
 _log = get_vex_logger(__name__)
 
+# loop iterations (minutes) between rebuilding member counts from the cache
+RECONCILE_INTERVAL = 60
+
+# seconds between deleting expired data and freeing space
+COMPACT_INTERVAL = 3600
+
+# config key for the retention of each resolution
+RETENTION_KEYS = {
+    60: "raw_retention_days",
+    3600: "hourly_retention_days",
+    86400: "daily_retention_days",
+}
+
+# samples to buffer before writing them to the database. graphs and exports write any buffered
+# samples first, so this doesn't make them out of date
+FLUSH_INTERVAL = 5
+
 
 def snapped_utcnow():
     return datetime.datetime.utcnow().replace(microsecond=0, second=0)
@@ -37,25 +64,61 @@ class StatTrack(commands.Cog, StatTrackCommands, StatPlot, metaclass=CompositeMe
     Data can also be exported with `[p]stattrack export` into a few different formats.
     """
 
-    __version__ = "1.9.1"
+    __version__ = "2.0.0"
     __author__ = "Vexed#0714"
 
     def __init__(self, bot: Red) -> None:
+        super().__init__()  # StatPlot sets up the plot executor
         self.bot = bot
 
         self.cmd_count = 0
         self.msg_count = 0
 
         self.config = Config.get_conf(self, identifier=418078199982063626, force_registration=True)
-        self.config.register_global(version=1, maxpoints=25_000)
+        self.config.register_global(
+            version=1,
+            maxpoints=25_000,
+            raw_retention_days=14,
+            hourly_retention_days=-1,
+            daily_retention_days=-1,
+            compact_counting=False,
+            plot_processes=0,
+            plot_renderer="plotly",
+            metrics_host="127.0.0.1",
+            metrics_port=0,  # disabled
+            shared_db_path=None,  # a database shared with other bot processes
+            cluster_id=None,
+        )
         self.config.register_global(main_df={})  # deprecated
 
         self.last_loop_time = "Loop not ran yet"
+        self.last_compact = "Not ran yet"
+        self.compact_task: Optional[asyncio.Task] = None
         self.last_loop_raw: Optional[float] = None
 
         self.last_plot_debug = None
 
+        # rendered graphs, see StatTrackCommands.all_in_one
+        self.graph_cache: LRUCache = LRUCache(maxsize=GRAPH_CACHE_SIZE)
+        self.graph_cache_hits = 0
+        self.graph_cache_misses = 0
+
+        self.members = MemberCounter()
+        self.loops_since_reconcile: Optional[int] = None  # None until counted once
+
         self.driver = StatTrackSQLiteDriver()
+        self.samples = SampleBuffer(str(cog_data_path(raw_name="StatTrack") / "samples.journal"))
+        self.flush_lock = asyncio.Lock()
+
+        # per-command timings for the current minute, and minutes waiting to be written
+        self.command_timings = CommandTimings()
+        self.command_stats: List[Tuple[datetime.datetime, Dict[str, CommandStats]]] = []
+        self.command_starts: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+        self.lag_monitor = LagMonitor()
+
+        self.latest_sample: Optional[Sample] = None
+        self.metrics_server = MetricsServer(lambda: self.latest_sample)
 
         bot.add_dev_env_value("stattrack", lambda _: self)
 
@@ -70,16 +133,93 @@ class StatTrack(commands.Cog, StatTrackCommands, StatPlot, metaclass=CompositeMe
     def cog_unload(self) -> None:
         if self.loop:
             self.loop.cancel()
+        if self.compact_task:
+            self.compact_task.cancel()
+        self.lag_monitor.stop()
 
         self.plot_executor.shutdown(wait=False)
-        self.driver.sql_write_executor.shutdown(wait=False)
+        self.set_plot_processes(0)
+        # the journal must be let go of before a reloaded cog loads it, which happens before
+        # _close_storage gets to run
+        self.samples.close()
+        self.bot.loop.create_task(self._close_storage())
+        self.bot.loop.create_task(self.metrics_server.stop())
 
         try:
             self.bot.remove_dev_env_value("stattrack")
         except KeyError:
             pass
 
+    async def _close_storage(self) -> None:
+        try:
+            await self.flush_samples()
+        except Exception:
+            _log.exception("Unable to save buffered samples, they will be saved on next load.")
+        await self.driver.close()
+
+    async def flush_samples(self) -> None:
+        """Write all buffered samples to the database, and update the rollups."""
+        async with self.flush_lock:
+            samples = self.samples.peek()
+            if samples:
+                # new columns (metrics) are added by the driver
+                await self.driver.append_rows(samples)
+                await self.driver.update_rollups(samples[0][0], samples[-1][0])
+                self.samples.drop(len(samples))
+
+            while self.command_stats:
+                await self.driver.append_command_stats(*self.command_stats[0])
+                self.command_stats.pop(0)
+
+    async def compact_storage(self) -> None:
+        """Delete data older than the retention for each resolution, and free the space."""
+        await self.flush_samples()  # so rollups are up to date before minute data is deleted
+
+        # whole days only, so the data left always covers complete rollup buckets
+        today = snapped_utcnow().replace(hour=0, minute=0)
+        cutoffs = {}
+        for resolution, key in RETENTION_KEYS.items():
+            days = await self.config.get_raw(key)
+            if days != -1:
+                cutoffs[resolution] = today - datetime.timedelta(days=days)
+
+        start = time.monotonic()
+        deleted, freed = await self.driver.compact(cutoffs)
+        if deleted:
+            self.graph_cache.clear()
+        self.last_compact = (
+            f"{datetime.datetime.utcnow():%Y-%m-%d %H:%M} UTC, deleted {deleted} rows and freed "
+            f"{freed} pages in {round(time.monotonic() - start, 3)} seconds"
+        )
+        _log.debug(f"Compaction finished: {self.last_compact}")
+
+    async def compact_loop(self) -> None:
+        await self.bot.wait_until_red_ready()
+        await asyncio.sleep(60)  # let the bot finish starting up first
+
+        while True:
+            try:
+                await self.compact_storage()
+            except Exception as e:
+                _log.exception(
+                    "Something went wrong compacting the StatTrack database. It will be tried "
+                    "again later.",
+                    exc_info=e,
+                )
+            await asyncio.sleep(COMPACT_INTERVAL)
+
     async def async_init(self) -> None:
+        shared_path = await self.config.shared_db_path()
+        if shared_path:
+            self.driver = StatTrackSQLiteDriver(
+                path=shared_path, cluster=await self.config.cluster_id()
+            )
+        await self.driver.connect()
+
+        self.members.set_compact(await self.config.compact_counting())
+        self.set_plot_processes(await self.config.plot_processes())
+        self.plot_renderer = await self.config.plot_renderer()
+
         if await self.config.version() < 2:
             _log.info("Migrating StatTrack config from 1 to 2.")
             df_conf = await self.config.main_df()
@@ -93,9 +233,53 @@ class StatTrack(commands.Cog, StatTrackCommands, StatPlot, metaclass=CompositeMe
             await self.config.version.set(2)
             _log.info("Done.")
 
+        if await self.config.version() < 3:
+            _log.info("Migrating StatTrack database from 2 to 3. This may take a while.")
+            await self.driver.migrate_to_epoch()
+            await self.config.version.set(3)
+            _log.info("Done.")
+
+        if await self.config.version() < 4:
+            _log.info("Migrating StatTrack database from 3 to 4. This may take a while.")
+            await self.driver.migrate_to_rollups()
+            if await self.driver.get_first_index(raw=True) is not None:
+                # minute data was always kept forever before, so don't start deleting it
+                await self.config.raw_retention_days.set(-1)
+                _log.info(
+                    "StatTrack can now delete old minute-by-minute data and keep hourly and daily "
+                    "summaries instead. Your existing data will be kept forever unless you set a "
+                    "retention with `[p]stattrack retention`."
+                )
+            await self.config.version.set(4)
+            _log.info("Done.")
+
+        if await self.config.version() < 5:
+            _log.info("Migrating StatTrack database from 4 to 5. This may take a while.")
+            await self.driver.enable_incremental_vacuum()
+            await self.config.version.set(5)
+            _log.info("Done.")
+
+        if await self.config.version() < 6:
+            _log.info("Migrating StatTrack database from 5 to 6.")
+            await self.driver.migrate_command_rollups()
+            await self.config.version.set(6)
+            _log.info("Done.")
+
+        self.samples.load()
+
+        self.lag_monitor.start()
         self.loop = self.bot.loop.create_task(self.stattrack_loop())
+        self.compact_task = self.bot.loop.create_task(self.compact_loop())
         self.loop_meta = VexLoop("StatTrack loop", 60.0)
 
+        port = await self.config.metrics_port()
+        if port:
+            host = await self.config.metrics_host()
+            try:
+                await self.metrics_server.start(host, port)
+            except OSError as e:
+                _log.error(f"Unable to start the StatTrack metrics server on {host}:{port}: {e}")
+
     async def migrate_v1_to_v2(self, data: dict) -> None:
         # a big dataset can take 1 second to write as JSON, so better make it not blocking
 
@@ -119,11 +303,28 @@ class StatTrack(commands.Cog, StatTrackCommands, StatPlot, metaclass=CompositeMe
                 loops=[self.loop_meta] if self.loop_meta else [],
                 extras={
                     "Loop time": f"{self.last_loop_time}",
+                    "Graph cache": self.graph_cache_stats(),
+                    "Last compaction": self.last_compact,
+                    "Metrics server": self.metrics_server.address or "Disabled",
+                    "Database": (
+                        f"Shared as cluster {self.driver.cluster}"
+                        if self.driver.cluster is not None
+                        else "Local"
+                    ),
                 },
             )
             + f"\nDisk usage (SQLite database): {humanize_bytes(self.driver.storage_usage())}"
         )
 
+    def graph_cache_stats(self) -> str:
+        total = self.graph_cache_hits + self.graph_cache_misses
+        if not total:
+            return "No graphs yet"
+        return (
+            f"{self.graph_cache_hits} hits, {self.graph_cache_misses} misses "
+            f"({self.graph_cache_hits / total:.0%} hit rate)"
+        )
+
     @commands.command(hidden=True)
     async def stattrackloop(self, ctx: commands.Context):
         if not self.loop_meta:
@@ -139,6 +340,46 @@ class StatTrack(commands.Cog, StatTrackCommands, StatPlot, metaclass=CompositeMe
     async def on_command(self, ctx: commands.Context):
         if ctx.author != self.bot.user:
             self.cmd_count += 1
+            self.command_starts[ctx] = time.monotonic()
+
+    @commands.Cog.listener()
+    async def on_command_completion(self, ctx: commands.Context):
+        self._record_command(ctx, False)
+
+    @commands.Cog.listener()
+    async def on_command_error(self, ctx: commands.Context, error: commands.CommandError):
+        self._record_command(ctx, True)
+
+    def _record_command(self, ctx: commands.Context, error: bool) -> None:
+        start = self.command_starts.pop(ctx, None)
+        if start is not None and ctx.command is not None:  # None if on_command didn't fire
+            self.command_timings.record(
+                ctx.command.qualified_name, time.monotonic() - start, error
+            )
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member: discord.Member):
+        self.members.add(member)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member: discord.Member):
+        self.members.remove(member)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before: discord.Member, after: discord.Member):
+        self.members.update(after)  # discord.py 1.x sends status changes here
+
+    @commands.Cog.listener()
+    async def on_presence_update(self, before: discord.Member, after: discord.Member):
+        self.members.update(after)
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild: discord.Guild):
+        self.members.add_guild(guild)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild: discord.Guild):
+        self.members.remove_guild(guild)
 
     async def stattrack_loop(self):
         await asyncio.sleep(1)
@@ -166,8 +407,9 @@ class StatTrack(commands.Cog, StatTrackCommands, StatPlot, metaclass=CompositeMe
         cpu = psutil.cpu_percent(interval=None, percpu=False)
 
         now = snapped_utcnow()
-        if (
-            now == await self.driver.get_last_index()
+        if now in (
+            self.samples.last_time,
+            await self.driver.get_last_index(own=True),
         ):  # just reloaded and this min's data collected
             _log.debug("Skipping this loop - cog was likely recently reloaded")
             return
@@ -186,7 +428,6 @@ class StatTrack(commands.Cog, StatTrackCommands, StatPlot, metaclass=CompositeMe
         # data["users_unique"] = len(self.bot.users)
         # discord cache is broken, has been for a while. got to manually count users from guilds
         data["guilds"] = len(self.bot.guilds)
-        data["users_total"] = 0
         data["channels_total"] = 0
         data["channels_text"] = 0
         data["channels_voice"] = 0
@@ -194,57 +435,61 @@ class StatTrack(commands.Cog, StatTrackCommands, StatPlot, metaclass=CompositeMe
         data["channels_stage"] = 0
         data["sys_mem"] = psutil.virtual_memory().percent
         data["sys_cpu"] = cpu
+        data.update(self.lag_monitor.pop())
         data["command_count"] = self.cmd_count
         data["message_count"] = self.msg_count
         self.cmd_count, self.msg_count = 0, 0
 
-        count: Dict[str, Set[int]] = {  # can't use defaultdict, got to have these set
-            "status_online": set(),
-            "status_idle": set(),
-            "status_offline": set(),
-            "status_dnd": set(),
-            "users_humans": set(),
-            "users_bots": set(),
-            "users_unique": set(),
-        }
+        if (
+            self.members.compact
+            or self.loops_since_reconcile is None
+            or self.loops_since_reconcile >= RECONCILE_INTERVAL
+        ):
+            await self.members.reconcile(self.bot.guilds)
+            self.loops_since_reconcile = 0
+        else:
+            self.loops_since_reconcile += 1
+        data.update(self.members.counts())
+
+        # only with more than one shard, otherwise these would be the same as the totals
+        sharded = (self.bot.shard_count or 1) > 1
+        shard_guilds: Counter[int] = Counter()
+        shard_members: Counter[int] = Counter()
+
         guild: discord.Guild
-        member: discord.Member
         async for guild in AsyncIter(self.bot.guilds, steps=50):
-            async for member in AsyncIter(guild.members, steps=50):
-                data["users_total"] += 1
-                id = member.id
-                count[f"status_{member.raw_status}"].add(id)
-                count["users_bots"].add(id) if member.bot else count["users_humans"].add(id)
-                count["users_unique"].add(id)
             data["channels_total"] += len(guild.channels)
             data["channels_text"] += len(guild.text_channels)
             data["channels_voice"] += len(guild.voice_channels)
             data["channels_cat"] += len(guild.categories)
             data["channels_stage"] += len(guild.stage_channels)
-
-        count_lens = {k: len(v) for k, v in count.items()}
-        data.update(count_lens)
-
-        df = pandas.DataFrame(data, index=[snapped_utcnow()])
+            if sharded:
+                shard_guilds[guild.shard_id] += 1
+                shard_members[guild.shard_id] += guild.member_count or 0
+
+        if sharded:
+            for shard_id, shard_latency in self.bot.latencies:
+                if math.isfinite(shard_latency):  # INF if the shard isn't connected
+                    data[shard_metric(shard_id, "ping")] = round(shard_latency * 1000)
+                data[shard_metric(shard_id, "guilds")] = shard_guilds[shard_id]
+                data[shard_metric(shard_id, "members")] = shard_members[shard_id]
+
+        self.samples.add(now, data)
+        self.latest_sample = (now, data)
+        if self.command_timings:
+            self.command_stats.append((now, self.command_timings.pop()))
 
         end = time.monotonic()
         main_time = round((end - start), 3)
         _log.debug(f"Loop finished in {main_time} seconds")
 
-        try:
+        save_time = 0.0
+        if len(self.samples) >= FLUSH_INTERVAL:
             start = time.monotonic()
-            await self.driver.append(df)
-            end = time.monotonic()
-            save_time = round(end - start, 3)
-            _log.debug(f"SQLite append operation took {save_time} seconds")
-        except Exception:  # could be new schema (columns)
-            start = time.monotonic()
-            old_df = await self.driver.read_all()
-            df = pandas.concat([old_df, df], sort=False)
-            await self.driver.write(df)
+            await self.flush_samples()
             end = time.monotonic()
             save_time = round(end - start, 3)
-            _log.debug(f"SQLite write operation took {save_time} seconds")
+            _log.debug(f"SQLite flush operation took {save_time} seconds")
 
         total_time = main_time + save_time
         self.last_loop_raw = total_time
@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+import warnings
+from typing import Dict, NamedTuple
+
+import numpy as np
+import pandas as pd
+
+
+class Summary(NamedTuple):
+    series: pd.DataFrame  # what to plot, one column per metric
+    min: np.ndarray
+    max: np.ndarray
+    mean: np.ndarray  # of the plotted series
+    total: np.ndarray
+
+
+def summarise(agg_df: pd.DataFrame, window: int = 1) -> Summary:
+    """Get the series to plot and summary stats for each metric from the output of
+    `StatTrackSQLiteDriver.read_downsampled`, in one pass with NumPy.
+
+    Parameters
+    ----------
+    agg_df : pd.DataFrame
+        Must have the ``min``, ``mean`` and ``max`` aggregates, and ``sum`` for totals.
+    window : int, optional
+        Points in the rolling average of the plotted series, by default 1 (no average). Like
+        pandas' ``rolling(window, min_periods=1)``, NaNs are skipped.
+
+    Returns
+    -------
+    Summary
+        Stats are arrays with one value per metric, NaN if a metric has no data.
+    """
+    metrics = list(agg_df.columns.get_level_values(0).unique())
+    aggs: Dict[str, np.ndarray] = {
+        agg: agg_df.xs(agg, axis=1, level=1)[metrics].to_numpy(dtype="float64")
+        for agg in agg_df.columns.get_level_values(1).unique()
+    }
+
+    series = aggs["mean"]
+    if window > 1:
+        series = _rolling_mean(series, window)
+
+    with warnings.catch_warnings():  # all-NaN columns warn, but NaN is the right answer
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return Summary(
+            series=pd.DataFrame(series, index=agg_df.index, columns=metrics),
+            min=np.nanmin(aggs["min"], axis=0),
+            max=np.nanmax(aggs["max"], axis=0),
+            mean=np.nanmean(series, axis=0),
+            total=np.nansum(aggs["sum"], axis=0) if "sum" in aggs else np.full(len(metrics), 0.0),
+        )
+
+
+def _rolling_mean(values: np.ndarray, window: int) -> np.ndarray:
+    # rolling sums and counts from the difference of cumulative sums, ignoring NaNs
+    valid = ~np.isnan(values)
+    sums = np.cumsum(np.where(valid, values, 0.0), axis=0)
+    counts = np.cumsum(valid, axis=0)
+    sums[window:] = sums[window:] - sums[:-window].copy()
+    counts[window:] = counts[window:] - counts[:-window].copy()
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, sums / counts, np.nan)
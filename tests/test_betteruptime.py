@@ -0,0 +1,193 @@
+import asyncio
+import datetime
+import importlib
+import json
+import sqlite3
+from types import SimpleNamespace
+
+import pandas as pd
+
+from betteruptime import driver as driver_module
+from betteruptime.consts import DISCONNECTED, UNLOADED
+from betteruptime.driver import BetterUptimeSQLiteDriver
+from betteruptime.loop import BULoop
+from betteruptime.utils import Outage, Utils, outages_by_day
+
+
+class FakeValue:
+    """Just enough of a Red config value."""
+
+    def __init__(self, value):
+        self.value = value
+
+    async def __call__(self):
+        return self.value
+
+    async def set(self, value):
+        self.value = value
+
+    async def clear(self):
+        self.value = {}
+
+
+def make_driver(monkeypatch, tmp_path, table="daily"):
+    monkeypatch.setattr(driver_module, "cog_data_path", lambda **_: tmp_path)
+    bot = SimpleNamespace(loop=asyncio.get_running_loop())
+    return BetterUptimeSQLiteDriver(bot, "BetterUptime", "uptime.db", table)
+
+
+def days(*numbers):
+    return pd.DatetimeIndex([datetime.datetime(2022, 1, d) for d in numbers])
+
+
+def test_import():
+    importlib.import_module("betteruptime.betteruptime")
+    importlib.import_module("betteruptime")
+
+
+def test_upsert_and_read_range(monkeypatch, tmp_path):
+    async def run():
+        driver = make_driver(monkeypatch, tmp_path)
+        try:
+            # creates the table
+            await driver.upsert(pd.DataFrame({"connected": [1.0, 2.0]}, index=days(1, 2)))
+            # updates a row, inserts a row and adds a column
+            await driver.upsert(
+                pd.DataFrame({"connected": [3.0, 4.0], "cog_loaded": [5.0, 6.0]}, index=days(2, 3))
+            )
+            await driver.upsert(pd.DataFrame())  # nothing to do
+
+            everything = await driver.read()
+            middle = await driver.read_range(days(2)[0], days(3)[0])
+            after = await driver.read_range(days(2)[0], columns=["cog_loaded"])
+            missing = await driver.read_range(table="nothing")
+
+            # reopened after closing
+            await driver.close()
+            reopened = await driver.read()
+            return everything, middle, after, missing, reopened
+        finally:
+            await driver.close()
+
+    everything, middle, after, missing, reopened = asyncio.run(run())
+    assert list(everything.index) == list(days(1, 2, 3))
+    assert list(everything["connected"]) == [1.0, 3.0, 4.0]
+    assert list(everything["cog_loaded"].iloc[1:]) == [5.0, 6.0]
+    assert pd.isna(everything["cog_loaded"].iloc[0])
+
+    # start is inclusive, end exclusive
+    assert list(middle.index) == list(days(2))
+    assert list(after.columns) == ["cog_loaded"]
+    assert list(after.index) == list(days(2, 3))
+    assert missing.empty
+    assert reopened.equals(everything)
+
+
+# tables written before the index was stored as epochs have text timestamps
+def test_migrate_index(monkeypatch, tmp_path):
+    old = pd.DataFrame({"connected": [1.0, 2.0]}, index=days(1, 2))
+    with sqlite3.connect(str(tmp_path / "uptime.db")) as conn:
+        old.to_sql("daily", conn)
+        conn.execute("INSERT INTO daily VALUES ('not a time', 3.0)")
+        conn.execute("INSERT INTO daily VALUES (NULL, 4.0)")
+
+    async def run():
+        driver = make_driver(monkeypatch, tmp_path)
+        try:
+            await driver.append(pd.DataFrame({"connected": [5.0]}, index=days(3)))
+            return await driver.read(), await driver.read_range(days(2)[0])
+        finally:
+            await driver.close()
+
+    df, later = asyncio.run(run())
+    # rows with no valid time are skipped
+    assert list(df.index) == list(days(1, 2, 3))
+    assert list(df["connected"]) == [1.0, 2.0, 5.0]
+    assert list(later["connected"]) == [2.0, 5.0]
+    with sqlite3.connect(str(tmp_path / "uptime.db")) as conn:
+        types = conn.execute('SELECT DISTINCT typeof("index") FROM daily').fetchall()
+    assert sorted(types) == [("integer",), ("null",)]
+
+
+def test_migrate_v3_to_v4(monkeypatch, tmp_path):
+    monkeypatch.setattr("betteruptime.loop.cog_data_path", lambda _: tmp_path)
+    config = SimpleNamespace(
+        version=FakeValue(3),
+        cog_loaded=FakeValue({"2022-01-01": 86400.0, "2022-01-02": 43200.0}),
+        connected=FakeValue({"2022-01-01": 86000.0}),
+    )
+
+    async def run():
+        driver = make_driver(monkeypatch, tmp_path)
+        cog = SimpleNamespace(
+            cog_loaded_cache=pd.Series([86400.0, 43200.0], index=days(1, 2)),
+            connected_cache=pd.Series([86000.0], index=days(1)),
+            driver=driver,
+            config=config,
+            bot=SimpleNamespace(loop=asyncio.get_running_loop()),
+        )
+        try:
+            await BULoop.migrate_v3_to_v4(cog)
+            return await driver.read()
+        finally:
+            await driver.close()
+
+    df = asyncio.run(run())
+    assert list(df.index) == list(days(1, 2))
+    assert list(df["cog_loaded"]) == [86400.0, 43200.0]
+    assert df["connected"].iloc[0] == 86000.0
+    assert pd.isna(df["connected"].iloc[1])
+
+    assert config.version.value == 4
+    assert config.cog_loaded.value == {} and config.connected.value == {}
+    with open(tmp_path / "v3_to_v4_backup.json") as fp:
+        assert json.load(fp)["connected"] == {"2022-01-01": 86000.0}
+
+
+def test_outages_by_day():
+    start = datetime.datetime(2022, 1, 1, 23)
+    outages = [
+        Outage(start, start + datetime.timedelta(days=1, hours=2), DISCONNECTED),
+        Outage(start - datetime.timedelta(hours=2), start - datetime.timedelta(hours=1), UNLOADED),
+    ]
+    by_day = outages_by_day(outages)
+
+    first, second, third = days(1, 2, 3)
+    assert list(by_day) == [first, second, third]
+    assert [o.seconds for o in by_day[first]] == [3600, 3600]
+    assert [o.kind for o in by_day[first]] == [DISCONNECTED, UNLOADED]
+    assert by_day[second][0].seconds == 86400
+    assert by_day[third][0] == Outage(third, third + datetime.timedelta(hours=1), DISCONNECTED)
+
+
+# outages are logged by their end, and cut to the range they are read for
+def test_outage_log(monkeypatch, tmp_path):
+    def epoch(day, hour):
+        return (
+            datetime.datetime(2022, 1, day, hour).replace(tzinfo=datetime.timezone.utc).timestamp()
+        )
+
+    async def run():
+        driver = make_driver(monkeypatch, tmp_path)
+        cog = SimpleNamespace(driver=driver, disconnected_since=None)
+        try:
+            await BULoop.migrate_v4_to_v5(
+                SimpleNamespace(
+                    driver=driver,
+                    config=SimpleNamespace(outages_since=FakeValue(None), version=FakeValue(4)),
+                )
+            )
+            await BULoop.log_outage(cog, epoch(1, 22), epoch(2, 1), UNLOADED)
+            await BULoop.log_outage(cog, epoch(2, 5), epoch(2, 6), DISCONNECTED)
+            await BULoop.log_outage(cog, epoch(3, 5), epoch(3, 5), DISCONNECTED)  # not an outage
+            return await Utils.get_outages(
+                cog, datetime.datetime(2022, 1, 2), datetime.datetime(2022, 1, 3)
+            )
+        finally:
+            await driver.close()
+
+    outages = asyncio.run(run())
+    assert outages == [
+        Outage(datetime.datetime(2022, 1, 2), datetime.datetime(2022, 1, 2, 1), UNLOADED),
+        Outage(datetime.datetime(2022, 1, 2, 5), datetime.datetime(2022, 1, 2, 6), DISCONNECTED),
+    ]
@@ -0,0 +1,840 @@
+import asyncio
+import datetime
+import gc
+import gzip
+import importlib
+import importlib.util
+import io
+import json
+import socket
+import sqlite3
+import time
+from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from pathlib import Path
+from types import SimpleNamespace
+
+import aiohttp
+import numpy as np
+import pandas as pd
+import pytest
+from cachetools import LRUCache
+
+from stattrack import plot as plot_module
+from stattrack import pngplot
+from stattrack.buffer import SampleBuffer
+from stattrack.commands import StatTrackCommands
+from stattrack.counter import MemberCounter, count_members
+from stattrack.driver import StatTrackSQLiteDriver, to_epoch
+from stattrack.export import CSVExporter, ParquetExporter, read_parquet
+from stattrack.histogram import BUCKET_COUNT, CommandTimings, percentiles
+from stattrack.lag import LagMonitor
+from stattrack.openmetrics import CONTENT_TYPE, MetricsServer, format_openmetrics
+from stattrack.summary import _rolling_mean, summarise
+
+
+# catches import cycles between the cog's modules, which stop it loading at all
+def test_import():
+    importlib.import_module("stattrack.stattrack")
+    importlib.import_module("stattrack")
+
+
+# more shards than SQLite allows columns in a table, if each were a column
+def test_many_shards(tmp_path):
+    async def run():
+        driver = StatTrackSQLiteDriver(path=str(tmp_path / "timeseries.db"), cluster="0")
+        await driver.connect()
+        try:
+            start = datetime.datetime(2022, 1, 1)
+            rows = []
+            for minute in range(10):
+                data = {"ping": 0.1}
+                for shard_id in range(700):
+                    for metric in ("ping", "guilds", "members"):
+                        data[f"shard{shard_id}_{metric}"] = shard_id
+                rows.append((start + datetime.timedelta(minutes=minute), data))
+            await driver.append_rows(rows)
+            await driver.update_rollups(rows[0][0], rows[-1][0])
+
+            end = rows[-1][0]
+            delta = datetime.timedelta(hours=1)
+            bucket = datetime.timedelta(minutes=5)
+            shards = await driver.read_shards_downsampled("guilds", bucket, delta, end, [2, 5])
+            combined = await driver.read_shards_combined("ping", bucket, delta, end)
+            hourly = await driver.read_shards_combined(
+                "ping", datetime.timedelta(hours=1), delta, end
+            )
+            return await driver.get_shards("members"), shards, combined, hourly
+        finally:
+            await driver.close()
+
+    available, shards, combined, hourly = asyncio.run(run())
+    assert available == list(range(700))
+    assert list(shards[("shard5_guilds", "max")]) == [5, 5]
+    assert list(combined[("shards_max", "mean")]) == [699, 699]
+    assert list(combined[("shards_mean", "mean")]) == [349.5, 349.5]
+    assert list(hourly[("shards_min", "mean")]) == [0]
+
+
+# a minute is only in the fleet totals once every running cluster has written it
+def test_clusters_partial_minutes(tmp_path):
+    async def run():
+        path = str(tmp_path / "timeseries.db")
+        first = StatTrackSQLiteDriver(path=path, cluster="0")
+        second = StatTrackSQLiteDriver(path=path, cluster="1")
+        await first.connect()
+        await second.connect()
+        try:
+            start = datetime.datetime.utcnow().replace(second=0, microsecond=0)
+            times = [start + datetime.timedelta(minutes=minute) for minute in range(10)]
+            await first.append_rows([(time, {"guilds": 100}) for time in times])
+            await second.append_rows([(time, {"guilds": 100}) for time in times[:5]])
+            partial = await first.read_partial(["guilds"])
+            version = await first.get_data_version()
+
+            await second.append_rows([(time, {"guilds": 100}) for time in times[5:]])
+            full = await first.read_partial(["guilds"])
+            return partial, full, version, await first.get_data_version()
+        finally:
+            await first.close()
+            await second.close()
+
+    partial, full, version, new_version = asyncio.run(run())
+    assert list(partial["guilds"]) == [200] * 5
+    assert list(full["guilds"]) == [200] * 10
+    assert new_version != version
+
+
+# command stats are summed into hours, which are kept after the minute rows are pruned
+def test_command_stats_compaction(tmp_path):
+    async def run():
+        driver = StatTrackSQLiteDriver(path=str(tmp_path / "timeseries.db"))
+        await driver.connect()
+        await driver.migrate_to_epoch()  # creates the stats table on a new database
+        try:
+            start = datetime.datetime(2022, 1, 1)
+            stats = [2, 1, 30.0] + [1] * 2 + [0] * 11
+            for minute in (0, 30, 90):
+                await driver.append_command_stats(
+                    start + datetime.timedelta(minutes=minute), {"ping": stats}
+                )
+            deleted, _ = await driver.compact({60: start + datetime.timedelta(days=1)})
+            hist = await driver.read_command_histograms(datetime.timedelta(hours=1))
+            return deleted, hist, await driver.read_command_totals()
+        finally:
+            await driver.close()
+
+    deleted, hist, totals = asyncio.run(run())
+    assert deleted == 3
+    assert list(hist["count"]) == [4, 2]
+    assert list(hist["b1"]) == [2, 1]
+    assert totals.loc["ping", "total_ms"] == 90
+
+
+# samples still in the buffer are read with the stored ones, without counting any twice
+def test_read_pending(tmp_path):
+    async def run():
+        driver = StatTrackSQLiteDriver(path=str(tmp_path / "timeseries.db"))
+        await driver.connect()
+        await driver.migrate_to_epoch()
+        await driver.migrate_to_rollups()
+        try:
+            start = datetime.datetime(2022, 1, 1)
+            times = [start + datetime.timedelta(minutes=minute) for minute in range(4)]
+            await driver.append_rows([(time, {"ping": 1}) for time in times[:2]])
+            await driver.update_rollups(times[0], times[1])
+            # the first was written after being read from the buffer
+            pending = [(times[1], {"ping": 1}), (times[2], {"ping": 2}), (times[3], {"ping": 3})]
+            end = times[-1]
+            delta = datetime.timedelta(hours=1)
+            minutes = await driver.read_downsampled(
+                ["ping"], datetime.timedelta(minutes=1), delta, end, pending=pending
+            )
+            hours = await driver.read_downsampled(
+                ["ping"], datetime.timedelta(hours=1), delta, end, pending=pending
+            )
+            return minutes, hours, await driver.read_all(pending)
+        finally:
+            await driver.close()
+
+    minutes, hours, everything = asyncio.run(run())
+    assert list(minutes[("ping", "mean")]) == [1, 1, 2, 3]
+    assert list(hours[("ping", "mean")]) == [1.75]
+    assert list(everything["ping"]) == [1, 1, 2, 3]
+
+
+def test_journal_reload(tmp_path):
+    path = str(tmp_path / "samples.journal")
+    t0 = datetime.datetime(2023, 1, 1)
+
+    old = SampleBuffer(path)
+    old.load()
+    old.add(t0, {"ping": 1.0})
+    old.close()  # cog unloaded, its flush is still running
+
+    new = SampleBuffer(path)
+    new.load()
+    assert [t for t, _ in new.peek()] == [t0]
+
+    old.drop(1)  # the old flush finishes after the new cog loaded the journal
+    new.add(t0 + datetime.timedelta(minutes=1), {"ping": 2.0})
+    new.close()
+
+    reloaded = SampleBuffer(path)
+    reloaded.load()
+    assert [d["ping"] for _, d in reloaded.peek()] == [1.0, 2.0]
+
+
+def test_export_history(tmp_path):
+    async def run():
+        driver = StatTrackSQLiteDriver(path=str(tmp_path / "test.db"))
+        await driver.connect()
+        await driver.migrate_to_epoch()
+        await driver.migrate_to_rollups()
+        t0 = datetime.datetime(2023, 1, 1)
+        rows = [(t0 + datetime.timedelta(minutes=m), {"ping": m % 2}) for m in range(3 * 1440)]
+        await driver.append_rows(rows)
+        await driver.update_rollups(rows[0][0], rows[-1][0])
+        # minute data kept for the last day, hourly for the last two
+        await driver.compact(
+            {60: t0 + datetime.timedelta(days=2), 3600: t0 + datetime.timedelta(days=1)}
+        )
+
+        df = await driver.read_all()
+        chunks = [chunk async for chunk in driver.read_chunks(chunk_size=1000)]
+        await driver.close()
+        return df, chunks
+
+    df, chunks = asyncio.run(run())
+    assert list(df.index[:2]) == [datetime.datetime(2023, 1, 1), datetime.datetime(2023, 1, 2)]
+    assert df.index[24] == datetime.datetime(2023, 1, 2, 23)
+    assert df.index[25] == datetime.datetime(2023, 1, 3)
+    assert len(df) == 1 + 24 + 1440
+    assert df["ping"].iloc[0] == 0.5
+    assert df.index.is_monotonic_increasing
+    assert pd.concat(chunks).equals(df)
+    assert all(list(chunk.columns) == ["ping"] for chunk in chunks)
+
+
+# installs from before 1.x stored the index as text in main_df
+def test_migrate_to_epoch(tmp_path):
+    path = str(tmp_path / "timeseries.db")
+    old = pd.DataFrame(
+        {"ping": [0.1, 0.2], "guilds": [10.0, 11.0]},
+        index=pd.DatetimeIndex(
+            [datetime.datetime(2022, 1, 1, 0, 1), datetime.datetime(2022, 1, 1)]
+        ),
+    )
+    with sqlite3.connect(path) as conn:
+        old.to_sql("main_df", conn)
+        conn.execute("INSERT INTO main_df VALUES ('not a time', 1, 1)")
+
+    async def run():
+        driver = StatTrackSQLiteDriver(path=path)
+        await driver.connect()
+        try:
+            await driver.migrate_to_epoch()
+            await driver.migrate_to_rollups()
+            return await driver.read_all()
+        finally:
+            await driver.close()
+
+    df = asyncio.run(run())
+    assert list(df.index) == [datetime.datetime(2022, 1, 1), datetime.datetime(2022, 1, 1, 0, 1)]
+    assert list(df["ping"]) == [0.2, 0.1]
+    assert list(df["guilds"]) == [11.0, 10.0]
+    with sqlite3.connect(path) as conn:
+        assert (
+            conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'main_df'").fetchone() is None
+        )
+
+
+# graphs use the finest data that covers their timespan, or that has the most history if none do
+def test_resolve_bucket(tmp_path):
+    end = datetime.datetime(2022, 1, 4, 0, 30)
+    minute = datetime.timedelta(minutes=1)
+    hour = datetime.timedelta(hours=1)
+    day = datetime.timedelta(days=1)
+
+    async def run():
+        driver = StatTrackSQLiteDriver(path=str(tmp_path / "timeseries.db"))
+        await driver.connect()
+        try:
+            await driver.migrate_to_epoch()
+            await driver.migrate_to_rollups()
+            results = {}
+
+            # a new install, with 2 hours of data
+            rows = [(end - m * minute, {"ping": 0.1}) for m in range(120)][::-1]
+            await driver.append_rows(rows)
+            await driver.update_rollups(rows[0][0], rows[-1][0])
+            results["new"] = await driver.resolve_bucket(minute, day, end)
+            df = await driver.read_downsampled(["ping"], minute, day, end)
+            results["new_rows"] = len(df)
+
+            # 72 hours of data
+            rows = [(end - m * minute, {"ping": 0.1}) for m in range(120, 72 * 60)][::-1]
+            await driver.append_rows(rows)
+            await driver.update_rollups(rows[0][0], rows[-1][0])
+            results["week"] = await driver.resolve_bucket(2 * minute, 7 * day, end)
+            results["all"] = await driver.resolve_bucket(minute, None, end)
+
+            # minute data deleted from before the last day
+            await driver.compact({60: datetime.datetime(2022, 1, 3)})
+            results["pruned_week"] = await driver.resolve_bucket(2 * minute, 7 * day, end)
+            results["pruned_day"] = await driver.resolve_bucket(minute, hour * 20, end)
+            results["long_bucket"] = await driver.resolve_bucket(day * 2, 7 * day, end)
+            return results
+        finally:
+            await driver.close()
+
+    results = asyncio.run(run())
+    assert results["new"] == minute
+    assert results["new_rows"] == 120
+    assert results["week"] == 2 * minute
+    assert results["all"] == minute
+    assert results["pruned_week"] == hour
+    assert results["pruned_day"] == minute
+    assert results["long_bucket"] == day * 2
+
+
+# more reads than there are pooled connections wait for one, and none are left open on close
+def test_read_pool(tmp_path):
+    path = str(tmp_path / "timeseries.db")
+
+    async def run():
+        driver = StatTrackSQLiteDriver(path=path)
+        await driver.connect()
+        await driver.connect()  # already connected, so no extra connections are opened
+        try:
+            await driver.migrate_to_epoch()
+            await driver.migrate_to_rollups()
+            start = datetime.datetime(2022, 1, 1)
+            await driver.append_rows(
+                [(start + datetime.timedelta(minutes=m), {"ping": m}) for m in range(10)]
+            )
+            reads = await asyncio.gather(*(driver.read_all() for _ in range(driver.pool_size * 3)))
+            pooled = len(driver._read_conns)
+        finally:
+            await driver.close()
+        with pytest.raises(RuntimeError):
+            await driver.read_all()
+        return reads, pooled
+
+    reads, pooled = asyncio.run(run())
+    assert all(list(df["ping"]) == list(range(10)) for df in reads)
+    assert pooled == 4
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+
+# buckets are aligned to the epoch and empty ones are left out
+def test_read_downsampled(tmp_path):
+    async def run():
+        driver = StatTrackSQLiteDriver(path=str(tmp_path / "timeseries.db"))
+        await driver.connect()
+        try:
+            await driver.migrate_to_epoch()
+            await driver.migrate_to_rollups()
+            start = datetime.datetime(2022, 1, 1, 0, 3)
+            minutes = list(range(10)) + list(range(20, 25))
+            rows = [(start + datetime.timedelta(minutes=m), {"ping": m}) for m in minutes]
+            await driver.append_rows(rows)
+            await driver.update_rollups(rows[0][0], rows[-1][0])
+
+            end = rows[-1][0]
+            delta = datetime.timedelta(hours=1)
+            five = await driver.read_downsampled(
+                ["ping"], datetime.timedelta(minutes=5), delta, end
+            )
+            hour = await driver.read_downsampled(
+                ["ping"], datetime.timedelta(hours=1), delta, end, aggregates=["sum", "max"]
+            )
+            return five, hour
+        finally:
+            await driver.close()
+
+    five, hour = asyncio.run(run())
+    assert list(five.index.minute) == [0, 5, 10, 20, 25]
+    assert list(five[("ping", "min")]) == [0, 2, 7, 20, 22]
+    assert list(five[("ping", "max")]) == [1, 6, 9, 21, 24]
+    assert list(five[("ping", "mean")]) == [0.5, 4, 8, 20.5, 23]
+    assert list(hour.columns) == [("ping", "sum"), ("ping", "max")]
+    assert list(hour.index) == [datetime.datetime(2022, 1, 1)]
+    assert list(hour[("ping", "sum")]) == [sum(range(10)) + sum(range(20, 25))]
+
+
+# metrics added by a later version are new columns, NULL for the rows from before
+def test_append_new_columns(tmp_path):
+    async def run():
+        driver = StatTrackSQLiteDriver(path=str(tmp_path / "timeseries.db"))
+        await driver.connect()
+        try:
+            await driver.migrate_to_epoch()
+            await driver.migrate_to_rollups()
+            start = datetime.datetime(2022, 1, 1)
+            times = [start + datetime.timedelta(minutes=m) for m in range(3)]
+            await driver.append(pd.DataFrame({"ping": [0.1]}, index=pd.DatetimeIndex(times[:1])))
+            await driver.append(
+                pd.DataFrame({"ping": [0.2], "guilds": [10]}, index=pd.DatetimeIndex(times[1:2]))
+            )
+            await driver.append_rows([(times[2], {"users": 5})])
+            return await driver.read_all()
+        finally:
+            await driver.close()
+
+    df = asyncio.run(run())
+    assert list(df.columns) == ["ping", "guilds", "users"]
+    assert df["ping"].tolist()[:2] == [0.1, 0.2]
+    assert df["guilds"].isna().tolist() == [True, False, True]
+    assert df["users"].isna().tolist() == [True, True, False]
+
+
+# counts follow member events, with users in several guilds counted once
+def test_member_counter():
+    def member(id, status, bot=False):
+        return SimpleNamespace(id=id, raw_status=status, bot=bot)
+
+    counter = MemberCounter()
+    first = SimpleNamespace(
+        members=[member(1, "online"), member(2, "idle"), member(3, "dnd", True)]
+    )
+    counter.add_guild(first)
+    counter.add(member(1, "online"))  # joined a second guild
+    counter.update(member(2, "offline"))
+    counter.update(member(5, "online"))  # not counted, so ignored
+    assert counter.counts() == {
+        "status_online": 1,
+        "status_idle": 0,
+        "status_offline": 1,
+        "status_dnd": 1,
+        "users_total": 4,
+        "users_unique": 3,
+        "users_bots": 1,
+        "users_humans": 2,
+    }
+
+    counter.remove(member(1, "online"))  # still in the other guild
+    counter.remove(member(3, "dnd", True))
+    counter.remove(member(3, "dnd", True))  # already gone
+    counts = counter.counts()
+    assert counts["users_total"] == 2
+    assert counts["users_unique"] == 2
+    assert counts["users_bots"] == 0
+    assert counts["status_online"] == 1
+    assert counts["status_dnd"] == 0
+
+    # a missed event is fixed by rebuilding from the cache
+    counter.add(member(6, "idle"))
+    asyncio.run(counter.reconcile([first]))
+    counts = counter.counts()
+    assert counts["users_total"] == 3
+    assert counts["status_idle"] == 1
+
+    counter.remove_guild(first)
+    assert counter.counts()["users_total"] == 0
+
+
+def test_count_members():
+    def member(id, status, bot=False):
+        return SimpleNamespace(id=id, raw_status=status, bot=bot)
+
+    guilds = [
+        SimpleNamespace(members=[member(1, "online"), member(2, "idle"), member(3, "dnd", True)]),
+        # the status from the first guild a user is found in is used
+        SimpleNamespace(members=[member(1, "offline"), member(4, "streaming")]),
+        SimpleNamespace(members=[]),
+    ]
+    counter = MemberCounter()
+    for guild in guilds:
+        counter.add_guild(guild)
+
+    counts = asyncio.run(count_members(guilds))
+    assert counts == counter.counts()
+    assert counts["users_total"] == 5
+    assert counts["users_unique"] == 4
+    assert counts["users_bots"] == 1
+    assert counts["status_online"] == 1
+    assert asyncio.run(count_members([])) == MemberCounter().counts()
+
+    # compact mode ignores events and only counts on reconcile
+    counter.set_compact(True)
+    counter.add(member(5, "online"))
+    assert counter.counts() == {}
+    asyncio.run(counter.reconcile(guilds))
+    assert counter.counts() == counts
+
+
+# chunks with a column of only NULLs still fit the schema of the first
+def test_parquet_roundtrip():
+    pytest.importorskip("pyarrow")
+    # shaped like the chunks from read_chunks
+    index = pd.date_range(datetime.datetime(2022, 1, 1), periods=4, freq="min", name="index")
+    df = pd.DataFrame({"ping": [0.1, 0.2, 0.3, 0.4], "guilds": [1, 2, None, None]}, index=index)
+
+    exporter = ParquetExporter()
+    exporter.write(df.iloc[:2])
+    exporter.write(df.iloc[2:])
+    result = read_parquet(exporter.close().read())
+
+    assert list(result.index) == list(index)
+    assert list(result.columns) == ["ping", "guilds"]
+    assert result["ping"].tolist() == [0.1, 0.2, 0.3, 0.4]
+    assert result["guilds"].iloc[:2].tolist() == [1, 2]
+    assert result["guilds"].iloc[2:].isna().all()
+    assert ParquetExporter().close().read() == b""
+
+
+# the header is only written for the first chunk
+def test_csv_export():
+    index = pd.date_range(datetime.datetime(2022, 1, 1), periods=4, freq="min", name="index")
+    df = pd.DataFrame({"ping": [0.1, 0.2, 0.3, 0.4], "guilds": [1, 2, None, 4]}, index=index)
+
+    exporter = CSVExporter()
+    exporter.write(df.iloc[:2])
+    exporter.write(df.iloc[2:])
+    fp = exporter.close()
+    try:
+        data = fp.read()
+    finally:
+        fp.close()
+
+    assert exporter.size == len(data)
+    result = pd.read_csv(io.BytesIO(gzip.decompress(data)), index_col="index", parse_dates=True)
+    assert list(result.index) == list(index)
+    assert result["ping"].tolist() == [0.1, 0.2, 0.3, 0.4]
+    assert result["guilds"].isna().tolist() == [False, False, True, False]
+
+
+# the same graph is only plotted again once something in its timespan is written
+def test_graph_cache(tmp_path):
+    class Context:
+        clean_prefix = "!"
+        command = SimpleNamespace(name="ping")
+
+        def __init__(self):
+            self.sent = []
+
+        async def send(self, content=None, **kwargs):
+            self.sent.append(content or kwargs["file"].fp.read())
+            return SimpleNamespace(id=len(self.sent))
+
+        async def embed_colour(self):
+            return 0
+
+        @asynccontextmanager
+        async def typing(self):
+            yield
+
+    async def plot(df, ylabel, status_colours):
+        plotted.append(df)
+        return b"png %d" % len(plotted)
+
+    async def maxpoints():
+        return 25
+
+    async def run():
+        driver = StatTrackSQLiteDriver(path=str(tmp_path / "timeseries.db"))
+        await driver.connect()
+        try:
+            await driver.migrate_to_epoch()
+            await driver.migrate_to_rollups()
+            now = datetime.datetime.utcnow().replace(second=0, microsecond=0)
+            rows = [(now - datetime.timedelta(minutes=m), {"ping": 0.1}) for m in range(10, 0, -1)]
+            await driver.append_rows(rows)
+
+            cog = SimpleNamespace(
+                samples=SimpleNamespace(peek=list, last_time=None),
+                config=SimpleNamespace(maxpoints=maxpoints),
+                driver=driver,
+                graph_cache=LRUCache(maxsize=32),
+                graph_cache_hits=0,
+                graph_cache_misses=0,
+                plot=plot,
+            )
+            ctx = Context()
+            delta = datetime.timedelta(hours=1)
+            for _ in range(2):
+                await StatTrackCommands.all_in_one(cog, ctx, delta, "ping", "Latency")
+            await driver.append_rows([(now, {"ping": 0.2})])
+            await StatTrackCommands.all_in_one(cog, ctx, delta, "ping", "Latency")
+            return cog, ctx
+        finally:
+            await driver.close()
+
+    plotted = []
+    cog, ctx = asyncio.run(run())
+    assert ctx.sent == [b"png 1", b"png 1", b"png 2"]
+    assert (cog.graph_cache_hits, cog.graph_cache_misses) == (1, 2)
+    assert len(cog.graph_cache) == 2
+    assert cog.last_plot_debug["cache_hit"] is False
+
+
+# a graph is plotted in the bot's process if a worker died, and the workers are restarted
+def test_plot_broken_pool(monkeypatch):
+    class BrokenPool:
+        def submit(self, *args, **kwargs):
+            raise BrokenProcessPool
+
+    def _plot(df, ylabel, status_colours, renderer="plotly"):
+        plotted.append(df)
+        return b"png"
+
+    monkeypatch.setattr(plot_module, "_plot", _plot)
+    plotted = []
+    restarted = []
+    pool = BrokenPool()
+    executor = ThreadPoolExecutor(1)
+    index = pd.date_range(datetime.datetime(2022, 1, 1), periods=3, freq="min", name="index")
+    df = pd.DataFrame({"ping": [0.1, 0.2, 0.3]}, index=index)
+
+    async def run():
+        cog = SimpleNamespace(
+            bot=SimpleNamespace(loop=asyncio.get_running_loop()),
+            plot_executor=executor,
+            plot_process_pool=pool,
+            plot_processes=2,
+            plot_renderer="plotly",
+            set_plot_processes=restarted.append,
+        )
+        return await plot_module.StatPlot.plot(cog, df, "Latency", False)
+
+    try:
+        assert asyncio.run(run()) == b"png"
+    finally:
+        executor.shutdown()
+    assert restarted == [2]
+    assert plotted[0].equals(df)
+
+    # what the workers are sent is turned back into the same DataFrame
+    png = plot_module._plot_arrays(
+        index.values.view("int64"), ["ping"], df.to_numpy(), "Latency", False, "plotly"
+    )
+    assert png == b"png"
+    assert plotted[1].equals(df)
+    assert plotted[1].index.name == "index"
+
+
+def test_pillow_line_chart():
+    if not pngplot.use_pillow:
+        pytest.skip("Pillow 10.1+ is not installed")
+    from PIL import Image
+
+    index = pd.date_range(datetime.datetime(2022, 1, 1), periods=60, freq="min", name="index")
+    df = pd.DataFrame({"online": range(60), "idle": [5.0] * 60}, index=index)
+    df.iloc[20:30, 0] = None  # a gap in the line
+    colours = {"online": "#43b581", "idle": "#faa61a"}
+    assert pngplot.can_plot(df)
+    assert not pngplot.can_plot(df.iloc[:0])
+    assert not pngplot.can_plot(pd.DataFrame({i: [1] for i in range(11)}, index=index[:1]))
+
+    names = {"online": "Online", "idle": "Idle"}
+    png = pngplot.line_chart(df, "Users", colours, names)
+    img = Image.open(io.BytesIO(png))
+    assert img.format == "PNG"
+    assert img.size == (pngplot.WIDTH, pngplot.HEIGHT)
+    used = {colour for _, colour in img.convert("RGB").getcolors(pngplot.WIDTH * pngplot.HEIGHT)}
+    assert (0x43, 0xB5, 0x81) in used
+    assert (0xFA, 0xA6, 0x1A) in used
+
+    # a single point, and a flat line, don't divide by a zero range
+    for single in (df.iloc[:1], df[["idle"]]):
+        Image.open(io.BytesIO(pngplot.line_chart(single, "", None, names))).verify()
+
+
+def test_rolling_mean():
+    values = np.array([[1.0, np.nan], [np.nan, np.nan], [3.0, 2.0], [5.0, 4.0], [7.0, np.nan]])
+    expected = pd.DataFrame(values).rolling(2, min_periods=1).mean().to_numpy()
+    np.testing.assert_allclose(_rolling_mean(values, 2), expected)
+    np.testing.assert_allclose(_rolling_mean(values, 10), pd.DataFrame(values).expanding().mean())
+
+
+def test_summarise():
+    columns = pd.MultiIndex.from_product([["ping", "guilds"], ["min", "mean", "max", "sum"]])
+    df = pd.DataFrame(
+        [
+            [1.0, 2.0, 3.0, 4.0, np.nan, np.nan, np.nan, np.nan],
+            [0.0, 4.0, 9.0, 8.0, np.nan, np.nan, np.nan, np.nan],
+        ],
+        columns=columns,
+        index=pd.DatetimeIndex([datetime.datetime(2022, 1, 1), datetime.datetime(2022, 1, 2)]),
+    )
+    summary = summarise(df, window=2)
+    assert list(summary.series.columns) == ["ping", "guilds"]
+    assert list(summary.series["ping"]) == [2.0, 3.0]
+    assert summary.min[0] == 0.0 and summary.max[0] == 9.0
+    assert summary.mean[0] == 2.5 and summary.total[0] == 12.0
+    # no data for a metric is NaN, except the total
+    assert np.isnan([summary.min[1], summary.max[1], summary.mean[1]]).all()
+    assert summary.total[1] == 0.0
+
+    no_sum = summarise(df.drop(columns="sum", level=1))
+    assert list(no_sum.total) == [0.0, 0.0]
+
+
+# each resolution is deleted up to its own cutoff, and resolutions without one are kept
+def test_compact_cutoffs(tmp_path):
+    path = str(tmp_path / "timeseries.db")
+    start = datetime.datetime(2022, 1, 1)
+    day = datetime.timedelta(days=1)
+
+    async def run():
+        driver = StatTrackSQLiteDriver(path=path)
+        await driver.connect()
+        try:
+            await driver.migrate_to_epoch()
+            await driver.migrate_to_rollups()
+            await driver.enable_incremental_vacuum()
+            rows = [
+                (start + datetime.timedelta(minutes=m), {"ping": 1, "shard0_ping": 2})
+                for m in range(4 * 1440)
+            ]
+            await driver.append_rows(rows)
+            await driver.update_rollups(rows[0][0], rows[-1][0])
+            # small batches, so deleting and vacuuming take more than one
+            return await driver.compact({60: start + 3 * day, 3600: start + 2 * day}, 1000)
+        finally:
+            await driver.close()
+
+    deleted, freed = asyncio.run(run())
+    with sqlite3.connect(path) as conn:
+
+        def first(table):
+            return conn.execute(f"SELECT MIN(time), COUNT(*) FROM {table}").fetchone()
+
+        assert first("stats") == (to_epoch(start + 3 * day), 1440)
+        assert first("shard_stats") == (to_epoch(start + 3 * day), 1440)
+        assert first("stats_1h") == (to_epoch(start + 2 * day), 48)
+        assert first("shard_stats_1h")[0] == to_epoch(start + 2 * day)
+        assert first("stats_1d") == (to_epoch(start), 4)
+    # the minute and hourly rows of both tables
+    assert deleted == 2 * (3 * 1440 + 2 * 24)
+    assert freed > 0
+
+
+def test_format_openmetrics():
+    assert format_openmetrics(None) == "# EOF\n"
+
+    time = datetime.datetime(2022, 1, 1)
+    text = format_openmetrics((time, {"ping": 0.5, "shard0_ping": 1, "shard1_ping": 2.5}))
+    assert text.splitlines() == [
+        "# TYPE stattrack_ping gauge",
+        "# HELP stattrack_ping Latency to Discord in milliseconds",
+        "stattrack_ping 0.5 1640995200",
+        "# TYPE stattrack_shard_ping gauge",
+        "# HELP stattrack_shard_ping Latency of each shard to Discord in milliseconds",
+        'stattrack_shard_ping{shard="0"} 1.0 1640995200',
+        'stattrack_shard_ping{shard="1"} 2.5 1640995200',
+        "# EOF",
+    ]
+
+
+def test_metrics_server():
+    sample = (datetime.datetime(2022, 1, 1), {"ping": 0.5})
+
+    async def run():
+        server = MetricsServer(lambda: sample)
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+            # the port is in use
+            with pytest.raises(OSError):
+                await server.start("127.0.0.1", port)
+        await server.start("127.0.0.1", port)
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(server.address) as resp:
+                    return resp.headers["Content-Type"], await resp.text()
+        finally:
+            await server.stop()
+            assert server.runner is None
+
+    content_type, text = asyncio.run(run())
+    assert content_type == CONTENT_TYPE
+    assert text == format_openmetrics(sample)
+
+
+def test_command_timings():
+    timings = CommandTimings()
+    timings.record("ping", 0.005)
+    timings.record("ping", 0.010)  # a bound is in the bucket below it
+    timings.record("ping", 100, error=True)
+    timings.record("stattrack ping", 0.03)
+    assert len(timings) == 2
+
+    stats = timings.pop()
+    assert len(timings) == 0
+    assert stats["ping"][:3] == [3, 1, 100015.0]
+    assert stats["ping"][3:] == [2] + [0] * (BUCKET_COUNT - 2) + [1]
+    assert stats["stattrack ping"][3:6] == [0, 0, 1]
+
+
+def test_percentiles():
+    buckets = np.zeros((4, BUCKET_COUNT))
+    buckets[0, 0] = 10  # all under 10ms
+    buckets[1, [0, 1]] = 1  # one under 10ms, one 10-25ms
+    buckets[2, -1] = 5  # all slower than the last bound
+    # row 3 has no invocations
+
+    result = percentiles(buckets, (0.5, 1.0))
+    assert list(result[0]) == [5.0, 10.0]
+    assert list(result[1]) == [10.0, 25.0]
+    assert list(result[2]) == [60000.0, 60000.0]
+    assert np.isnan(result[3]).all()
+
+
+# a blocking call shows up as one late wakeup
+def test_lag_monitor():
+    monitor = LagMonitor(interval=0.01)
+
+    async def run():
+        monitor.start()
+        monitor.start()  # already started
+        try:
+            await asyncio.sleep(0.05)
+            time.sleep(0.2)
+            await asyncio.sleep(0.05)
+            gc.collect()
+            return monitor.pop()
+        finally:
+            monitor.stop()
+
+    data = asyncio.run(run())
+    assert data["loop_lag_max_ms"] >= 150
+    assert data["loop_lag_p99_ms"] <= data["loop_lag_max_ms"]
+    assert data["gc_collections"] >= 1
+    assert monitor._gc_callback not in gc.callbacks
+
+    gc.collect()
+    assert monitor.pop() == {
+        "loop_lag_max_ms": 0,
+        "loop_lag_p99_ms": 0,
+        "gc_pause_max_ms": 0,
+        "gc_pause_p99_ms": 0,
+        "gc_collections": 0,
+    }
+
+
+# the benchmarks still run against the current cog, at the smallest sizes
+def test_benchmarks(tmp_path, capsys):
+    path = Path(__file__).parent.parent / "benchmarks" / "bench_stattrack.py"
+    spec = importlib.util.spec_from_file_location("bench_stattrack", path)
+    bench = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bench)
+
+    baseline = str(tmp_path / "baseline.json")
+    args = Namespace(members=[100], days=[1], repeat=1, json=baseline, compare=None)
+    assert asyncio.run(bench.main(args)) == 0
+    with open(baseline, encoding="utf-8") as fp:
+        results = json.load(fp)
+    assert results
+    assert all(result["median_ms"] > 0 for result in results.values())
+
+    # every benchmark is slower than a thousandth of its baseline
+    args = Namespace(
+        members=[100], days=[1], repeat=1, json=None, compare=baseline, threshold=0.001
+    )
+    assert asyncio.run(bench.main(args)) == 1
+    assert "Slower than 0.001x the baseline" in capsys.readouterr().out